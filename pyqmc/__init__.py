@@ -8,7 +8,12 @@ from pyqmc.multislater import MultiSlater
 from pyqmc.jastrowspin import JastrowSpin
 from pyqmc.manybody_jastrow import J3
 
-from pyqmc.accumulators import EnergyAccumulator, PGradTransform, LinearTransform
+from pyqmc.accumulators import (
+    EnergyAccumulator,
+    PGradTransform,
+    LinearTransform,
+    ChunkedAccumulator,
+)
 from pyqmc.func3d import (
     PolyPadeFunction,
     PadeFunction,
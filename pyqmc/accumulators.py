@@ -1,5 +1,9 @@
+import copy
+import functools
 import numpy as np
 import pyqmc.energy as energy
+import pyqmc.eval_ecp as eval_ecp
+import pyqmc.memory as memory
 from pyqmc.ewald import Ewald
 
 
@@ -7,16 +11,27 @@ class EnergyAccumulator:
     """returns energy of each configuration in a dictionary. 
   Keys and their meanings can be found in energy.energy """
 
-    def __init__(self, mol, threshold=10, **kwargs):
+    def __init__(
+        self, mol, threshold=10, ecp_tolerance=1e-8, ecp_quadrature=None, **kwargs
+    ):
+        """
+        threshold: passed to eval_ecp.ECPEvaluator, see eval_ecp.ecp_mask().
+        ecp_tolerance: nonlocal ECP channels smaller than this are skipped; see eval_ecp.ECPEvaluator.
+        ecp_quadrature: quadrature rules of the nonlocal ECP per species or channel; see eval_ecp.ECPEvaluator.
+        kwargs: passed to Ewald for periodic systems.
+        """
         self.mol = mol
         self.threshold = threshold
+        self.ecp = eval_ecp.ECPEvaluator(
+            mol, threshold, tolerance=ecp_tolerance, quadrature=ecp_quadrature
+        )
         if hasattr(mol, "a"):
             print("EnergyAccumulator using Ewald\n", kwargs)
             self.ewald = Ewald(mol, **kwargs)
 
             def compute_energy(mol, configs, wf, threshold):
                 ee, ei, ii = self.ewald.energy(configs)
-                ecp_val = energy.get_ecp(mol, configs, wf, threshold)
+                ecp_val = self.ecp(configs, wf)
                 ke = energy.kinetic(configs, wf)
                 return {
                     "ke": ke,
@@ -27,7 +42,7 @@ class EnergyAccumulator:
 
             self.compute_energy = compute_energy
         else:
-            self.compute_energy = energy.energy
+            self.compute_energy = functools.partial(energy.energy, ecp=self.ecp)
 
     def __call__(self, configs, wf):
         return self.compute_energy(self.mol, configs, wf, self.threshold)
@@ -38,6 +53,61 @@ class EnergyAccumulator:
             d[k] = np.mean(it, axis=0)
         return d
 
+    def nonlocal_tmoves(self, configs, wf, e):
+        """ Quadrature points of the nonlocal ECP for electron e; see eval_ecp.ECPEvaluator.nonlocal_tmoves() """
+        return self.ecp.nonlocal_tmoves(configs, wf, e)
+
+
+class ChunkedAccumulator:
+    """
+    Evaluates another accumulator on chunks of walkers so that its temporary arrays 
+    fit in max_bytes. Each chunk gets a copy of the wave function with the state of its 
+    walkers only (memory.walker_subset(), or a recompute if the wave function has no 
+    resample()), so wf itself is not changed. This trades time for memory and is only 
+    worth it when the full evaluation would not fit. 
+
+    If chunk_size is not given, it is determined on the first call with memory.memory_model().
+    """
+
+    def __init__(self, accumulator, max_bytes=None, chunk_size=None):
+        self.accumulator = accumulator
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+
+    def _chunks(self, configs, wf):
+        nconf = configs.configs.shape[0]
+        if self.chunk_size is None and self.max_bytes is not None and nconf > 1:
+            model = memory.memory_model(wf, configs, {"acc": self.accumulator})
+            self.chunk_size = memory.chunk_size(self.max_bytes, *model["acc"])
+        return memory.walker_chunks(nconf, self.chunk_size)
+
+    def _evaluate(self, configs, wf, f):
+        chunks = self._chunks(configs, wf)
+        if len(chunks) == 1:
+            return [f(configs, wf)], [configs.configs.shape[0]]
+        results = []
+        for chunk in chunks:
+            sub = configs.mask(chunk)
+            if hasattr(wf, "resample"):
+                chunk_wf = memory.walker_subset(wf, np.arange(chunk.start, chunk.stop))
+            else:
+                chunk_wf = copy.deepcopy(wf)
+                chunk_wf.recompute(sub)
+            results.append(f(sub, chunk_wf))
+            del chunk_wf
+        return results, [chunk.stop - chunk.start for chunk in chunks]
+
+    def __call__(self, configs, wf):
+        results, sizes = self._evaluate(configs, wf, self.accumulator)
+        return {k: np.concatenate([r[k] for r in results]) for k in results[0]}
+
+    def avg(self, configs, wf):
+        results, sizes = self._evaluate(configs, wf, self.accumulator.avg)
+        return {
+            k: np.average([r[k] for r in results], axis=0, weights=sizes)
+            for k in results[0]
+        }
+
 
 class LinearTransform:
     """
@@ -4,6 +4,63 @@ from pyqmc.pbc import enforce_pbc
 import copy
 
 
+class WalkerPool:
+    """
+    Preallocated storage for arrays that are indexed by walker, so that resampling the 
+    walkers (possibly to a different number of them) does not allocate new arrays. 
+    Each array is double-buffered, with the walker axis first and a capacity that 
+    grows geometrically by growth when the population outgrows it.
+
+    Arrays returned by take() are views of the pool, and are overwritten by the 
+    take() after the next one with the same key. They belong to the object that owns 
+    the pool, which must replace the array it passed with the one returned and not 
+    hand it out; take() raises a ValueError if it is given an older array of the pool.
+    Arrays that callers may keep, such as the configurations, should not be pooled.
+    """
+
+    def __init__(self, growth=1.5):
+        self.growth = growth
+        self._buffers = {}
+        self._latest = {}
+
+    def __deepcopy__(self, memo):
+        """ The buffers are scratch space, so a copy starts with none """
+        return WalkerPool(self.growth)
+
+    def take(self, key, array, newinds, axis=0):
+        """ Equivalent to np.take(array, newinds, axis=axis), written into the pool """
+        stale = [
+            b
+            for b in self._buffers.get(key, [])
+            if b is not self._latest.get(key) and np.may_share_memory(b, array)
+        ]
+        if stale:
+            raise ValueError(
+                "WalkerPool.take(): " + key + " is an array that the pool has reused"
+            )
+        n = len(newinds)
+        moved = np.moveaxis(array, axis, 0)
+        buffers = self._buffers.get(key, [])
+        buffers = [
+            b for b in buffers if b.shape[1:] == moved.shape[1:] and b.dtype == array.dtype
+        ]
+        capacity = buffers[0].shape[0] if buffers else 0
+        if n > capacity or not buffers:
+            capacity = max(n, int(np.ceil(self.growth * capacity)))
+            buffers = [
+                np.empty((capacity, *moved.shape[1:]), dtype=array.dtype)
+                for i in range(2)
+            ]
+        elif len(buffers) < 2:
+            buffers.append(np.empty_like(buffers[0]))
+        self._buffers[key] = buffers
+        latest = [b for b in buffers if not np.may_share_memory(b, array)][0]
+        self._latest[key] = latest
+        out = latest[:n]
+        np.take(moved, newinds, axis=0, out=out)
+        return np.moveaxis(out, 0, axis)
+
+
 class OpenConfigs:
     def __init__(self, configs):
         self.configs = configs
@@ -24,6 +81,14 @@ class OpenConfigs:
         """
         return OpenConfigs(vec)
 
+    def make_irreducible_all(self, vec):
+        """ 
+          Input: 
+            vec: a (nconfig, nelec, 3) vector 
+          Output: OpenConfigs object with all electrons
+        """
+        return OpenConfigs(vec)
+
     def move(self, e, new, accept):
         """
         Change coordinates of one electron
@@ -34,11 +99,22 @@ class OpenConfigs:
         """
         self.configs[accept, e, :] = new.configs[accept, :]
 
+    def move_all(self, new, accept):
+        """
+        Change coordinates of all electrons
+        Args:
+          new: OpenConfigs with (nconfig, nelec, 3) new coordinates
+          accept: (nconfig,) boolean for which configs to update
+        """
+        self.configs[accept] = new.configs[accept]
+
     def resample(self, newinds):
         """
-        Resample configs by new indices (e.g. for DMC branching)
+        Resample configs by new indices (e.g. for DMC branching). 
+        The number of walkers may change. The new arrays are not kept in a WalkerPool, 
+        since callers may hold on to configs.configs.
         Args:
-          newinds: (nconfigs,) array of indices
+          newinds: array of indices
         """
         self.configs = self.configs[newinds]
 
@@ -88,6 +164,14 @@ class PeriodicConfigs:
             currentwrap = currentwrap[:, np.newaxis]
         return PeriodicConfigs(epos, self.lvecs, wrap=wrap + currentwrap)
 
+    def make_irreducible_all(self, vec):
+        """ 
+         Input: a (nconfig, nelec, 3) vector 
+         Output: PeriodicConfigs object with all electrons wrapped into the cell
+        """
+        epos, wrap = enforce_pbc(self.lvecs, vec)
+        return PeriodicConfigs(epos, self.lvecs, wrap=wrap + self.wrap)
+
     def move(self, e, new, accept):
         """
         Change coordinates of one electron
@@ -99,11 +183,23 @@ class PeriodicConfigs:
         self.configs[accept, e, :] = new.configs[accept, :]
         self.wrap[accept, e, :] = new.wrap[accept, :]
 
+    def move_all(self, new, accept):
+        """
+        Change coordinates of all electrons
+        Args:
+          new: PeriodicConfigs with (nconfig, nelec, 3) new coordinates
+          accept: (nconfig,) boolean for which configs to update
+        """
+        self.configs[accept] = new.configs[accept]
+        self.wrap[accept] = new.wrap[accept]
+
     def resample(self, newinds):
         """
-        Resample configs by new indices (e.g. for DMC branching)
+        Resample configs by new indices (e.g. for DMC branching). 
+        The number of walkers may change. The new arrays are not kept in a WalkerPool, 
+        since callers may hold on to configs.configs.
         Args:
-          newinds: (nconfigs,) array of indices
+          newinds: array of indices
         """
         self.configs = self.configs[newinds]
         self.wrap = self.wrap[newinds]
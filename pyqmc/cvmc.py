@@ -1,6 +1,7 @@
 import pyqmc
 import numpy as np
 import h5py
+import pyqmc.hdftools as hdftools
 
 
 class DescriptorFromOBDM:
@@ -220,6 +221,7 @@ def cvmc_optimize(
         attr["objective_" + k] = it
     for k, it in forcing.items():
         attr["forcing_" + k] = it
+    writer = hdftools.HDFWriter(hdf_file, attr, buffer_size=1)
 
     def get_obj_deriv(x):
         nonlocal configs
@@ -264,48 +266,56 @@ def cvmc_optimize(
 
     x0 = acc.transform.serialize_parameters(wf.parameters)
 
-    df = []
-    for it in range(iters):
-        grad, Sij = get_obj_deriv(x0)
-        grad["iteration"] = it
-        grad["parameters"] = x0.copy()
-        for k, force in forcing.items():
-            print(k, grad["avg" + k], grad["dp" + k], flush=True)
-        xfit = []
-        yfit = []
-
-        taus = np.linspace(0, tstep, npts + 1)
-        taus[0] = -tstep / (npts - 1)
-        params = [x0 + update(grad["objderiv"], Sij, tau, **update_kws) for tau in taus]
-        stepsdata = lm(wf, configs, params, acc, **lmoptions)
-
-        for data, p, tau in zip(stepsdata, params, taus):
-            en = np.mean(data["total"] * data["weight"]) / np.mean(data["weight"])
-
-            qavg = {}
-            distfromobj = 0.0
-            objfunc = en
+    try:
+        df = []
+        for it in range(iters):
+            grad, Sij = get_obj_deriv(x0)
+            grad["iteration"] = it
+            grad["parameters"] = x0.copy()
             for k, force in forcing.items():
-                qavg[k] = np.mean(data[k] * data["weight"]) / np.mean(data["weight"])
-                distobj = qavg[k] - objective[k]
-                distfromobj += distobj
-                objfunc += force * distobj ** 2
-
-            xfit.append(tau)
-            yfit.append(objfunc)
-
-        est_min = pyqmc.linemin.stable_fit(xfit, yfit)
-        x0 = x0 + update(grad["objderiv"], Sij, est_min, **update_kws)
-
-        grad["yfit"] = yfit
-        grad["taus"] = xfit
-        pyqmc.linemin.opt_hdf(
-            hdf_file, grad, attr, configs, acc.transform.deserialize(x0)
-        )
-
-        df.append(grad)
-        if datafile is not None:
-            pd.DataFrame(df).to_json(datafile)
+                print(k, grad["avg" + k], grad["dp" + k], flush=True)
+            xfit = []
+            yfit = []
+
+            taus = np.linspace(0, tstep, npts + 1)
+            taus[0] = -tstep / (npts - 1)
+            params = [
+                x0 + update(grad["objderiv"], Sij, tau, **update_kws) for tau in taus
+            ]
+            stepsdata = lm(wf, configs, params, acc, **lmoptions)
+
+            for data, p, tau in zip(stepsdata, params, taus):
+                en = np.mean(data["total"] * data["weight"]) / np.mean(data["weight"])
+
+                qavg = {}
+                distfromobj = 0.0
+                objfunc = en
+                for k, force in forcing.items():
+                    qavg[k] = np.mean(data[k] * data["weight"]) / np.mean(
+                        data["weight"]
+                    )
+                    distobj = qavg[k] - objective[k]
+                    distfromobj += distobj
+                    objfunc += force * distobj ** 2
+
+                xfit.append(tau)
+                yfit.append(objfunc)
+
+            est_min = pyqmc.linemin.stable_fit(xfit, yfit)
+            x0 = x0 + update(grad["objderiv"], Sij, est_min, **update_kws)
+
+            grad["yfit"] = yfit
+            grad["taus"] = xfit
+            writer.append(
+                grad,
+                pyqmc.linemin.opt_checkpoint(configs, acc.transform.deserialize(x0)),
+            )
+
+            df.append(grad)
+            if datafile is not None:
+                pd.DataFrame(df).to_json(datafile)
+    finally:
+        writer.close()
 
     for k, p in acc.transform.deserialize(x0).items():
         wf.parameters[k] = p
@@ -5,6 +5,7 @@ import pandas as pd
 import h5py
 import pyqmc
 import pyqmc.optimize_orthogonal
+import pyqmc.hdftools
 os.environ["MKL_NUM_THREADS"] = "1"
 os.environ["NUMEXPR_NUM_THREADS"] = "1"
 os.environ["OMP_NUM_THREADS"] = "1"
@@ -47,45 +48,54 @@ def distvmc(
     if npartitions is None:
         npartitions = sum([x for x in client.nthreads().values()])
     allruns = []
-    niterations = int(nsteps / nsteps_per)
-    coord = coords.split(npartitions)
-    alldata = []
-    for epoch in range(niterations):
-        wfs = []
-        thiscoord = []
-        for i in range(npartitions):
-            wfs.append(wf)
-            thiscoord.append(coord[i])
-        runs = client.map(
-            pyqmc.vmc,
-            wfs,
-            thiscoord,
-            **{"nsteps": nsteps_per, "accumulators": accumulators, "stepoffset": epoch*nsteps_per},
-            **kwargs
-        )
-        iterdata = []
-        for i, r in enumerate(runs):
-            res = r.result()
-            iterdata.extend(res[0])
-            coord[i] = res[1]
-
-        collected_data = (
-            pd.DataFrame(iterdata)
-            .groupby("step", as_index=False)
-            .apply(lambda x: x.stack().groupby(level=1).apply(np.mean, axis=0)) #Added for array returns, e.g. obdm, tbdm
-            .to_dict("records")
-        )
-        if verbose:
-            print("epoch", epoch, "finished", flush=True)
-
-        coords.join(coord)
-        alldata.extend(collected_data)
-        for d in collected_data:
-            pyqmc.mc.vmc_file(hdf_file, d, kwargs, coords)
+    writer = pyqmc.hdftools.HDFWriter(hdf_file, kwargs, buffer_size=nsteps_per)
+    try:
+        niterations = int(nsteps / nsteps_per)
+        coord = coords.split(npartitions)
+        alldata = []
+        for epoch in range(niterations):
+            wfs = []
+            thiscoord = []
+            for i in range(npartitions):
+                wfs.append(wf)
+                thiscoord.append(coord[i])
+            runs = client.map(
+                pyqmc.vmc,
+                wfs,
+                thiscoord,
+                **{"nsteps": nsteps_per, "accumulators": accumulators, "stepoffset": epoch*nsteps_per},
+                **kwargs
+            )
+            iterdata = []
+            for i, r in enumerate(runs):
+                res = r.result()
+                iterdata.extend(res[0])
+                coord[i] = res[1]
+
+            collected_data = _merge_vmc(iterdata)
+            if verbose:
+                print("epoch", epoch, "finished", flush=True)
+
+            coords.join(coord)
+            alldata.extend(collected_data)
+            for d in collected_data:
+                writer.append(d, {"configs": coords.configs})
+    finally:
+        writer.close()
 
     return alldata, coords
 
 
+def _merge_vmc(iterdata):
+    """ Average the vmc() steps of all partitions, step by step """
+    return (
+        pd.DataFrame(iterdata)
+        .groupby("step", as_index=False)
+        .apply(lambda x: x.stack().groupby(level=1).apply(np.mean, axis=0)) #Added for array returns, e.g. obdm, tbdm
+        .to_dict("records")
+    )
+
+
 def dist_lm_sampler(
     wf, configs, params, pgrad_acc, npartitions=None, client=None, lm_sampler=None
 ):
@@ -122,10 +132,15 @@ def dist_lm_sampler(
     for r in allruns:
         stepresults.append(r.result())
 
+    return _merge_lm(stepresults, len(params))
+
+
+def _merge_lm(stepresults, nparams):
+    """ Concatenate the lm_sampler() results of all partitions """
     keys = stepresults[0][0].keys()
     # This will be a list of dictionaries
     final_results = []
-    for p in range(len(params)):
+    for p in range(nparams):
         df = {}
         for k in keys:
             # print(k,flush=True)
@@ -185,7 +200,14 @@ def distdmc_propagate(wf, configs, weights, *args, client, npartitions=None, **k
     configs.join([x[1] for x in allresults])
     coordret = configs
     weightret = np.vstack([x[2] for x in allresults])
-    df = pd.concat([pd.DataFrame(x[0]) for x in allresults])
+    df = _merge_dmc([x[0] for x in allresults])
+    print(df)
+    return df, coordret, weightret
+
+
+def _merge_dmc(dfs):
+    """ Average the dmc_propagate() steps of all partitions, weighted by the average weight of each """
+    df = pd.concat([pd.DataFrame(x) for x in dfs])
     notavg = ["weight", "weightvar", "weightmin", "weightmax", "acceptance", "step"]
     # Here we reweight the averages since each step on each node
     # was done with a different average weight.
@@ -197,10 +219,232 @@ def distdmc_propagate(wf, configs, weights, *args, client, npartitions=None, **k
     for k in df.keys():
         if k not in notavg:
             df[k] = df[k] / df["weight"]
-    print(df)
-    return df, coordret, weightret
+    return df
+
+
+def _comb_teeth(weightsums, nconfig):
+    """
+    Global stochastic reconfiguration: place nconfig evenly spaced teeth with one random 
+    offset over the total weight, and return for each partition the positions of the teeth 
+    that fall in its share of the weight, measured from the start of that share.
+    """
+    cumulative = np.concatenate([[0.0], np.cumsum(weightsums)])
+    teeth = (np.random.rand() + np.arange(nconfig)) / nconfig * cumulative[-1]
+    part = np.searchsorted(cumulative, teeth, side="right") - 1
+    part = np.clip(part, 0, len(weightsums) - 1)
+    return [teeth[part == p] - cumulative[p] for p in range(len(weightsums))]
+
+
+def _transfer_plan(counts, target):
+    """ List of (source, destination, number) walker moves that bring every partition to target walkers """
+    surplus = [[p, n - target] for p, n in enumerate(counts) if n > target]
+    deficit = [[p, target - n] for p, n in enumerate(counts) if n < target]
+    plan = []
+    while surplus and deficit:
+        n = min(surplus[-1][1], deficit[-1][1])
+        plan.append((surplus[-1][0], deficit[-1][0], n))
+        surplus[-1][1] -= n
+        deficit[-1][1] -= n
+        if surplus[-1][1] == 0:
+            surplus.pop()
+        if deficit[-1][1] == 0:
+            deficit.pop()
+    return plan
+
+
+def _merge_walkers(exported):
+    """ Concatenate several results of DMCWorker.export() """
+    return {k: np.concatenate([w[k] for w in exported]) for k in exported[0]}
+
+
+class DMCWorker:
+    """
+    One partition of DMC walkers, kept on a dask worker as an actor together with its 
+    wave function state and local energies. Used by distdmc().
+    """
+
+    def __init__(self, wf, configs, weights, accumulators, ekey, **kwargs):
+        self.wf = wf
+        self.configs = configs
+        self.weights = weights
+        self.accumulators = accumulators
+        self.ekey = ekey
+        self.kwargs = kwargs
+        self.eloc = None
+
+    def propagate(self, tstep, branchcut_start, branchcut_stop, eref, nsteps, stepoffset):
+        """ Runs dmc_propagate() on the resident walkers and returns the step data and 
+        the sum of the weights, which the client needs to branch """
+        import pyqmc.dmc
+
+        df, self.configs, self.weights, self.eloc = pyqmc.dmc.dmc_propagate(
+            self.wf,
+            self.configs,
+            self.weights,
+            tstep,
+            branchcut_start,
+            branchcut_stop,
+            eref,
+            nsteps=nsteps,
+            stepoffset=stepoffset,
+            accumulators=self.accumulators,
+            ekey=self.ekey,
+            eloc=self.eloc,
+            return_eloc=True,
+            **self.kwargs
+        )
+        return df, np.sum(self.weights)
+
+    def comb(self, teeth, weight):
+        """ Resample the walkers at the local teeth positions from _comb_teeth(); 
+        all new walkers get weight. Returns the new number of walkers. """
+        cumulative = np.cumsum(self.weights)
+        newinds = np.searchsorted(cumulative, teeth)
+        newinds = np.minimum(newinds, len(self.weights) - 1)
+        self._resample(newinds)
+        self.weights = np.full(len(newinds), weight)
+        return len(newinds)
+
+    def export(self, n):
+        """ Remove the last n walkers and return them with their local energies """
+        nconf = self.configs.configs.shape[0]
+        walkers = {
+            "configs": self.configs.configs[nconf - n :].copy(),
+            "eloc": self.eloc[nconf - n :].copy(),
+        }
+        if hasattr(self.configs, "wrap"):
+            walkers["wrap"] = self.configs.wrap[nconf - n :].copy()
+        self._resample(np.arange(nconf - n))
+        self.weights = self.weights[: nconf - n]
+        return walkers
+
+    def receive(self, walkers, weight):
+        """ Add walkers from export(), or several of them merged by _merge_walkers(), 
+        and recompute the wave function """
+        self.configs.configs = np.concatenate([self.configs.configs, walkers["configs"]])
+        if hasattr(self.configs, "wrap"):
+            self.configs.wrap = np.concatenate([self.configs.wrap, walkers["wrap"]])
+        self.eloc = np.concatenate([self.eloc, walkers["eloc"]])
+        self.weights = np.concatenate(
+            [self.weights, np.full(len(walkers["eloc"]), weight)]
+        )
+        self.wf.recompute(self.configs)
 
+    def gather(self):
+        return self.configs, self.weights
 
+    def _resample(self, newinds):
+        self.configs.resample(newinds)
+        self.wf.resample(newinds)
+        self.eloc = self.eloc[newinds]
+
+
+def distdmc(
+    wf,
+    configs,
+    weights=None,
+    tstep=0.01,
+    nsteps=1000,
+    branchtime=5,
+    stepoffset=0,
+    branchcut_start=3,
+    branchcut_stop=6,
+    verbose=False,
+    accumulators=None,
+    ekey=("energy", "total"),
+    feedback=1.0,
+    hdf_file=None,
+    client=None,
+    npartitions=None,
+    **kwargs
+):
+    """
+    DMC with walkers that stay resident on the dask workers, as DMCWorker actors.
+
+    Between branches each worker only reports the sum of its weights, along with its step 
+    data. Branching is a global stochastic reconfiguration: the client decides how many 
+    copies fall in each partition, the workers resample locally (resampling their wave 
+    function state with wf.resample()), and then only the walkers needed to balance the 
+    partitions are moved between workers, together with their local energies. Only 
+    workers that receive walkers recompute their wave function. The calls to the workers 
+    are all submitted before their results are gathered, so they run concurrently.
+
+    The steps are written to hdf_file as by dmc.rundmc(). The walkers are only gathered 
+    to the client when a checkpoint is written and at the end.
+
+    Arguments are as in dmc.rundmc(); kwargs are passed to dmc_propagate().
+
+    Returns: (df,coords,weights) as dmc.rundmc().
+    """
+    if npartitions is None:
+        npartitions = sum([x for x in client.nthreads().values()])
+    nconfig = configs.configs.shape[0]
+    assert nconfig % npartitions == 0, "nconfig must be divisible by npartitions"
+    target = nconfig // npartitions
+    if weights is None:
+        weights = np.ones(nconfig)
+    writer = pyqmc.hdftools.HDFWriter(hdf_file, dict(tstep=tstep))
+
+    def gather():
+        futures = [w.gather() for w in workers]
+        gathered = [f.result() for f in futures]
+        configs.join([g[0] for g in gathered])
+        weights = np.concatenate([g[1] for g in gathered])
+        return {"configs": configs.configs, "weights": weights}
+
+    def propagate(*args):
+        futures = [w.propagate(*args) for w in workers]
+        results = [f.result() for f in futures]
+        return _merge_dmc([r[0] for r in results]), np.array([r[1] for r in results])
+
+    checkpoint = None
+    try:
+        futures = [
+            client.submit(DMCWorker, wf, c, w, accumulators, ekey, actor=True, **kwargs)
+            for c, w in zip(configs.split(npartitions), np.split(weights, npartitions))
+        ]
+        workers = [f.result() for f in futures]
+
+        df_, weightsums = propagate(tstep, 1e8, 1e9, 0.0, 1, 0)
+        eref = df_[ekey[0] + ekey[1]][0]
+        esigma = np.abs(eref) / 100
+        df = []
+        for step in range(int(np.ceil(nsteps / branchtime))):
+            if verbose:
+                print("branch step", step, flush=True)
+            df_, weightsums = propagate(
+                tstep,
+                branchcut_start * esigma,
+                branchcut_stop * esigma,
+                eref,
+                branchtime,
+                branchtime * step + stepoffset,
+            )
+            df_["nconfig"] = nconfig
+            df_["eref"] = eref
+            writer.extend(df_.to_dict("records"), gather)
+            df.append(df_)
+
+            wavg = np.sum(weightsums) / nconfig
+            eref = df_[ekey[0] + ekey[1]].values[-1] - feedback * np.log(wavg)
+            teeth = _comb_teeth(weightsums, nconfig)
+            counts = [f.result() for f in [w.comb(t, wavg) for w, t in zip(workers, teeth)]]
+            plan = _transfer_plan(counts, target)
+            exports = [workers[source].export(n) for source, destination, n in plan]
+            received = {}
+            for (source, destination, n), f in zip(plan, exports):
+                received.setdefault(destination, []).append(f.result())
+            receives = [
+                workers[d].receive(_merge_walkers(exported), wavg)
+                for d, exported in received.items()
+            ]
+            [f.result() for f in receives]
+
+        checkpoint = gather()
+        weights = checkpoint["weights"]
+    finally:
+        writer.close(checkpoint)
+    return pd.concat(df).reset_index(), configs, weights
 
 
 def dist_sample_overlap(wfs, configs, *args, client, npartitions=None, **kwargs):
@@ -220,12 +464,17 @@ def dist_sample_overlap(wfs, configs, *args, client, npartitions=None, **kwargs)
     allresults = [r.result() for r in allruns]
     configs.join([x[1] for x in allresults])
     coordret = configs
+    return _merge_overlap([x[0] for x in allresults]), coordret
+
+
+def _merge_overlap(allresults):
+    """ Combine the sample_overlap() data of all partitions """
     # Here we reweight the averages since each step on each node
     # was done with a different average weight.
-    keys = allresults[0][0].keys()
+    keys = allresults[0].keys()
     df = {} 
     for k in keys:
-        df[k] = np.array([x[0][k] for x in allresults])
+        df[k] = np.array([x[k] for x in allresults])
     for k in df.keys():
         if k != 'weight' and k!= 'overlap' and k!= 'overlap_gradient':
             if len(df[k].shape) == 2:
@@ -242,7 +491,7 @@ def dist_sample_overlap(wfs, configs, *args, client, npartitions=None, **kwargs)
 
     df['weight'] = np.mean(df['weight'], axis=0)
 
-    return df, coordret
+    return df
 
 
 def dist_correlated_sample(wfs, configs, *args, client, npartitions = None, **kwargs):
@@ -261,6 +510,11 @@ def dist_correlated_sample(wfs, configs, *args, client, npartitions = None, **kw
         )
 
     allresults = [r.result() for r in allruns]
+    return _merge_correlated(allresults)
+
+
+def _merge_correlated(allresults):
+    """ Combine the correlated_sample() data of all partitions """
     df = {}
     for k in allresults[0].keys():
         df[k] = np.array([x[k] for x in allresults])
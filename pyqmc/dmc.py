@@ -11,6 +11,9 @@ import pyqmc.mc as mc
 import sys
 import pandas as pd
 import h5py
+from pyqmc.timing import null_timer
+import pyqmc.hdftools as hdftools
+from pyqmc.reblock import TargetError, OnlineBlocking
 
 
 def limdrift(g, tau, acyrus=0.25):
@@ -49,6 +52,38 @@ def limdrift_cutoff(g, tau, cutoff=1):
     return mc.limdrift(g, cutoff) * tau
 
 
+def tmove(wf, configs, energy_accumulator, tstep, e):
+    """
+    Performs a T-move (Casula, Phys. Rev. B 74, 161102 (2006)) of electron e.
+    The sign-preserving nonlocal ECP matrix elements, ratio*weight < 0 at the quadrature 
+    points returned by energy_accumulator.nonlocal_tmoves(), give transition weights 
+    -tstep*ratio*weight; electron e moves to one of the quadrature points with probability 
+    proportional to its weight, or stays with probability proportional to 1.
+
+    Returns:
+      accept: (nconfig,) Boolean array, True for the walkers that moved
+    """
+    nconfig = configs.configs.shape[0]
+    quadrature = energy_accumulator.nonlocal_tmoves(configs, wf, e)
+    tweight = -tstep * np.real(quadrature["ratio"] * quadrature["weight"])
+    if tweight.shape[1] == 0:
+        return np.zeros(nconfig, dtype=bool)
+    cdf = np.cumsum(np.maximum(tweight, 0), axis=1)
+    # u < 1 means the electron stays; otherwise it moves to the first point with cdf >= u-1
+    u = np.random.rand(nconfig) * (1 + cdf[:, -1])
+    accept = u > 1
+    point = np.sum(cdf < (u - 1)[:, np.newaxis], axis=1)
+    point = np.minimum(point, cdf.shape[1] - 1)
+    if not np.any(accept):
+        return accept
+    newepos = configs.make_irreducible(
+        e, quadrature["epos"][np.arange(nconfig), point]
+    )
+    configs.move(e, newepos, accept)
+    wf.updateinternals(e, newepos, mask=accept)
+    return accept
+
+
 def dmc_propagate(
     wf,
     configs,
@@ -62,12 +97,18 @@ def dmc_propagate(
     ekey=("energy", "total"),
     drift_limiter=limdrift,
     stepoffset=0,
+    move="electron",
+    timer=None,
+    eloc=None,
+    return_eloc=False,
+    tmoves=False,
+    intervals=None,
 ):
     """
     Propagate DMC without branching
     
     Args:
-      wf: A Wave function-like class. recompute(), gradient(), and updateinternals() are used, as well as anything (such as laplacian() ) used by accumulators
+      wf: A Wave function-like class. recompute(), gradient(), testvalue(), and updateinternals() are used, as well as anything (such as laplacian() ) used by accumulators. gradient_current() and testvalue_gradient() are used instead of gradient() and testvalue() if wf has them.
 
       configs: Configs object, (nconfig, nelec, 3) - initial coordinates to start calculation.
 
@@ -85,52 +126,107 @@ def dmc_propagate(
 
       stepoffset: what to start the step numbering at.
 
-    Returns: (df,coords,weights)
+      move: "electron" moves one electron at a time. "all" moves every electron at once and accepts or rejects the whole configuration (see mc.all_electron_move()).
+
+      timer: A timing.PhaseTimer that accumulates the wall time and number of calls of each phase of the step.
+
+      eloc: (nconfig,) local energies of configs, as returned by a previous call with return_eloc=True. If given, wf must already be up to date with configs (for example through wf.resample() in branch()), and the initial recompute and energy evaluation are skipped.
+
+      return_eloc: If True, the local energies of the final coordinates are returned as a fourth value.
+
+      tmoves: If True, nonlocal ECP terms are treated with T-moves (see tmove()) after each electron's drift-diffusion move, instead of only through the locality approximation. accumulators[ekey[0]] must have nonlocal_tmoves(), like EnergyAccumulator.
+
+      intervals: A dictionary from accumulator names to evaluation intervals k, as in vmc(). Those accumulators are only evaluated, with the walker weights of that step, on steps whose number is a multiple of k; the energy accumulator ekey[0] is evaluated every step.
+
+    Returns: (df,coords,weights), and eloc if return_eloc is True
       df: A list of dictionaries nstep long that contains all results from the accumulators.
 
       coords: The final coordinates from this calculation.
 
       weights: The final weights from this calculation
+
+      eloc: The local energies of the final coordinates, which can be passed as eloc= to the next call.
       
     """
     assert accumulators is not None, "Need an energy accumulator for DMC"
+    assert move in ("electron", "all"), "Invalid move={0}".format(move)
+    if timer is None:
+        timer = null_timer
+    if intervals is None:
+        intervals = {}
     nconfig, nelec = configs.configs.shape[0:2]
-    wf.recompute(configs)
+    tmove_acc = np.zeros(nelec)
+    if eloc is None:
+        with timer("recompute"):
+            wf.recompute(configs)
 
-    eloc = accumulators[ekey[0]](configs, wf)[ekey[1]]
+        with timer("accumulator_" + ekey[0]):
+            eloc = accumulators[ekey[0]](configs, wf)[ekey[1]]
     # eref_mean = np.mean(weights * eloc) / np.mean(weights)
     # eref = eref_mean
     df = []
+    drift = None
     for step in range(nsteps):
-        acc = np.zeros(nelec)
-        for e in range(nelec):
-            # Propose move
-            grad = drift_limiter(np.real(wf.gradient(e, configs.electron(e)).T), tstep)
-            gauss = np.random.normal(scale=np.sqrt(tstep), size=(nconfig, 3))
-            eposnew = configs.configs[:, e, :] + gauss + grad
-            newepos = configs.make_irreducible(e, eposnew)
-
-            # Compute reverse move
-            new_grad = drift_limiter(np.real(wf.gradient(e, newepos).T), tstep)
-            forward = np.sum(gauss ** 2, axis=1)
-            backward = np.sum((gauss + grad + new_grad) ** 2, axis=1)
-            # forward = np.sum((configs[:, e, :] + grad - eposnew) ** 2, axis=1)
-            # backward = np.sum((eposnew + new_grad - configs[:, e, :]) ** 2, axis=1)
-            t_prob = np.exp(1 / (2 * tstep) * (forward - backward))
-
-            # Acceptance -- fixed-node: reject if wf changes sign
-            wfratio = wf.testvalue(e, newepos)
-            ratio = wfratio ** 2 * t_prob
-            accept = ratio * np.sign(wfratio) > np.random.rand(nconfig)
-
-            # Update wave function
-            configs.move(e, newepos, accept)
-            wf.updateinternals(e, newepos, mask=accept)
-            acc[e] = np.mean(accept)
+        if move == "all":
+            with timer("move_all"):
+                accept, drift = mc.all_electron_move(
+                    wf,
+                    configs,
+                    tstep,
+                    lambda g: drift_limiter(g, tstep),
+                    fixed_node=True,
+                    grad=drift,
+                )
+            acc = np.mean(accept)
+            if tmoves:
+                # T-moves change the positions, so the drift is recomputed next step
+                drift = None
+                for e in range(nelec):
+                    with timer("tmove"):
+                        tmove_acc[e] = np.mean(
+                            tmove(wf, configs, accumulators[ekey[0]], tstep, e)
+                        )
+        else:
+            acc = np.zeros(nelec)
+            for e in range(nelec):
+                # Propose move
+                with timer("gradient"):
+                    grad = drift_limiter(
+                        np.real(mc.gradient_current(wf, e, configs.electron(e)).T), tstep
+                    )
+                gauss = np.random.normal(scale=np.sqrt(tstep), size=(nconfig, 3))
+                eposnew = configs.configs[:, e, :] + gauss + grad
+                newepos = configs.make_irreducible(e, eposnew)
+
+                # Compute reverse move
+                with timer("testvalue"):
+                    wfratio, new_grad = mc.testvalue_gradient(wf, e, newepos)
+                new_grad = drift_limiter(np.real(new_grad.T), tstep)
+                forward = np.sum(gauss ** 2, axis=1)
+                backward = np.sum((gauss + grad + new_grad) ** 2, axis=1)
+                # forward = np.sum((configs[:, e, :] + grad - eposnew) ** 2, axis=1)
+                # backward = np.sum((eposnew + new_grad - configs[:, e, :]) ** 2, axis=1)
+                t_prob = np.exp(1 / (2 * tstep) * (forward - backward))
+
+                # Acceptance -- fixed-node: reject if wf changes sign
+                ratio = wfratio ** 2 * t_prob
+                accept = ratio * np.sign(wfratio) > np.random.rand(nconfig)
+
+                # Update wave function
+                with timer("updateinternals"):
+                    configs.move(e, newepos, accept)
+                    wf.updateinternals(e, newepos, mask=accept)
+                acc[e] = np.mean(accept)
+                if tmoves:
+                    with timer("tmove"):
+                        tmove_acc[e] = np.mean(
+                            tmove(wf, configs, accumulators[ekey[0]], tstep, e)
+                        )
 
         # weights
         elocold = eloc.copy()
-        energydat = accumulators[ekey[0]](configs, wf)
+        with timer("accumulator_" + ekey[0]):
+            energydat = accumulators[ekey[0]](configs, wf)
         eloc = energydat[ekey[1]]
         tdamp = limit_timestep(
             weights, eloc, elocold, eref, branchcut_start, branchcut_stop
@@ -142,8 +238,11 @@ def dmc_propagate(
 
         avg = {}
         for k, accumulator in accumulators.items():
+            if k != ekey[0] and (stepoffset + step) % intervals.get(k, 1) != 0:
+                continue
             if k != ekey[0]:
-                dat = accumulator(configs, wf)
+                with timer("accumulator_" + k):
+                    dat = accumulator(configs, wf)
             else:
                 dat = energydat
             for m, res in dat.items():
@@ -155,9 +254,13 @@ def dmc_propagate(
         avg["weightmin"] = np.amin(weights)
         avg["weightmax"] = np.amax(weights)
         avg["acceptance"] = np.mean(acc)
+        if tmoves:
+            avg["tmove_acceptance"] = np.mean(tmove_acc)
         avg["step"] = stepoffset + step
 
         df.append(avg)
+    if return_eloc:
+        return pd.DataFrame(df), configs, weights, eloc
     return pd.DataFrame(df), configs, weights
 
 
@@ -199,7 +302,7 @@ def limit_timestep(weights, elocnew, elocold, eref, start, stop):
     return tdamp
 
 
-def branch(configs, weights):
+def branch(configs, weights, wf=None, eloc=None):
     """
     Perform branching on a set of walkers  by stochastic reconfiguration
 
@@ -210,6 +313,10 @@ def branch(configs, weights):
 
       weights: (nconfig,) walker weights
 
+      wf: If given, its internal state is resampled along with the walkers by wf.resample(), so that it does not need to be recomputed.
+
+      eloc: If given, (nconfig,) local energies that are resampled in place along with the walkers.
+
     Returns:
       configs: resampled walker configurations
 
@@ -221,24 +328,47 @@ def branch(configs, weights):
     base = np.random.rand()
     newinds = np.searchsorted(probability, (base + np.arange(nconfig) / nconfig) % 1.0)
     configs.resample(newinds)
+    if wf is not None:
+        wf.resample(newinds)
+    if eloc is not None:
+        eloc[:] = eloc[newinds]
     weights.fill(wtot / nconfig)
     return configs, weights
 
 
-def dmc_file(hdf_file, data, attr, configs, weights):
-    import pyqmc.hdftools as hdftools
+def branch_birthdeath(configs, weights, wf=None, eloc=None):
+    """
+    Perform branching on a set of walkers by birth and death
 
-    if hdf_file is not None:
-        with h5py.File(hdf_file, "a") as hdf:
-            if "configs" not in hdf.keys():
-                hdftools.setup_hdf(hdf, data.loc[0], attr)
-                hdf.create_dataset("configs", configs.configs.shape)
-            if "weights" not in hdf.keys():
-                hdf.create_dataset("weights", weights.shape)
-            for i in range(len(data)):
-                hdftools.append_hdf(hdf, data.loc[i])
-            hdf["configs"][:, :, :] = configs.configs
-            hdf["weights"][:] = weights
+    Each walker is replaced by floor(weight + u) copies of itself with unit weight, where u is uniform in [0,1), so that the number of walkers fluctuates. At least one walker is always kept.
+
+    Args:
+      configs: (nconfig,nelec,3) walker coordinates
+
+      weights: (nconfig,) walker weights
+
+      wf: If given, its internal state is resampled along with the walkers by wf.resample(), so that it does not need to be recomputed.
+
+      eloc: If given, (nconfig,) local energies that are resampled along with the walkers.
+
+    Returns:
+      configs: resampled walker configurations, (nconfig_new,nelec,3)
+
+      weights: (nconfig_new,) all ones
+
+      eloc: (nconfig_new,) resampled local energies, or None if eloc was not given
+    """
+    nconfig = configs.configs.shape[0]
+    ncopies = np.floor(weights + np.random.rand(nconfig)).astype(int)
+    if ncopies.sum() == 0:
+        ncopies[np.argmax(weights)] = 1
+    newinds = np.repeat(np.arange(nconfig), ncopies)
+    configs.resample(newinds)
+    if wf is not None:
+        wf.resample(newinds)
+    if eloc is not None:
+        eloc = eloc[newinds]
+    return configs, np.ones(len(newinds)), eloc
 
 
 def rundmc(
@@ -258,6 +388,18 @@ def rundmc(
     propagate=dmc_propagate,
     feedback=1.0,
     hdf_file=None,
+    move="electron",
+    timer=None,
+    hdf_options=None,
+    statistics=None,
+    store_steps=True,
+    target_error=None,
+    target_key=None,
+    check_every=10,
+    carry_state=None,
+    branching="comb",
+    tmoves=False,
+    intervals=None,
     **kwargs,
 ):
     """
@@ -286,8 +428,32 @@ def rundmc(
 
       stepoffset: If continuing a run, what to start the step numbering at.
 
+      move: "electron" for single-electron moves, or "all" to move every electron at once. Passed to propagate.
+
+      timer: A timing.PhaseTimer. Passed to propagate, and also used to time branching and hdf output. It is written to the "timing" group of hdf_file.
+
+      hdf_options: A dictionary of options for the hdftools.HDFWriter that saves to hdf_file, such as buffer_size, checkpoint_every, and compression. The steps are written in blocks of buffer_size rows to datasets preallocated for nsteps rows.
+
+      statistics: A reblock.OnlineBlocking object. Every step's averages are added to it, so that statistics.summary() gives reblocked means and error bars without storing the steps. One is created if not given.
+
+      store_steps: If False, the steps are not kept in memory: df is the reblocked summary of the steps (statistics.summary()), and per-step data is only kept in statistics and hdf_file. Together with hdf_file, this keeps memory fixed however many steps are run.
+
+      target_error: If given, stop once the reblocked standard error of target_key reaches this value, and treat nsteps as the maximum number of steps. The equilibration period is detected automatically (see reblock.TargetError) and only later steps are added to statistics. Each step in df then has "equilibrated", which is True for the steps added to statistics, so that they can be reblocked for error bars even without statistics=. Checked after branching.
+
+      target_key: tuple of strings naming the quantity checked against target_error. Defaults to ekey.
+
+      check_every: number of steps between checks of target_error.
+
+      carry_state: If True, branching resamples the wave function's internal state (wf.resample()) and the local energies, and they are passed to the next propagate call (as eloc=, with return_eloc=True), so that no recompute or extra energy evaluation is needed between branches. Defaults to True when propagate is dmc_propagate and wf has resample(); distributed propagators recompute on their workers.
+
+      branching: "comb" for stochastic reconfiguration at a fixed number of walkers (branch()), or "birthdeath" to let the number of walkers fluctuate (branch_birthdeath()). In both cases eref is fed back towards a total weight equal to the initial number of walkers. The walker arrays of wave functions with resample() are kept in a coord.WalkerPool, so a changing population does not allocate new arrays at every branch. The number of walkers at each step is saved as "nconfig".
+
+      tmoves: If True, nonlocal pseudopotentials are treated with T-moves, which removes the locality approximation's instability at larger tstep. Passed to propagate.
+
+      intervals: A dictionary from accumulator names to evaluation intervals k. Those accumulators are only evaluated every k steps, and are NaN on the other steps in df and hdf_file. Each evaluation is weighted by the walker weights of its step, so a weighted average over steps should use the "weight" of the evaluated steps. Passed to propagate.
+
     Returns: (df,coords,weights)
-      df: A list of dictionaries nstep long that contains all results from the accumulators.
+      df: A DataFrame nstep long that contains all results from the accumulators, or their reblocked summary if store_steps is False.
 
       coords: The final coordinates from this calculation.
 
@@ -306,11 +472,34 @@ def rundmc(
     nconfig, nelec = configs.configs.shape[0:2]
     if weights is None:
         weights = np.ones(nconfig)
-
+    if timer is None:
+        timer = null_timer
+    assert branching in ("comb", "birthdeath"), "Invalid branching={0}".format(
+        branching
+    )
+    if hdf_options is None:
+        hdf_options = {}
     npropagate = int(np.ceil(nsteps / branchtime))
+    hdf_options = dict(dict(expected_rows=npropagate * branchtime), **hdf_options)
+    writer = hdftools.HDFWriter(hdf_file, dict(tstep=tstep, move=move), **hdf_options)
+    if statistics is None:
+        statistics = OnlineBlocking()
+
+    monitor = None
+    if target_error is not None:
+        if target_key is None:
+            target_key = ekey
+        monitor = TargetError(
+            target_key[0] + target_key[1], target_error, check_every, statistics
+        )
+
+    if carry_state is None:
+        carry_state = propagate is dmc_propagate and hasattr(wf, "resample")
+
     df = []
 
-    df_, configs, weights = propagate(
+    carried = dict(return_eloc=True) if carry_state else {}
+    result = propagate(
         wf,
         configs,
         weights,
@@ -323,33 +512,86 @@ def rundmc(
         accumulators=accumulators,
         ekey=ekey,
         drift_limiter=drift_limiter,
+        move=move,
+        timer=timer,
+        tmoves=tmoves,
+        intervals=intervals,
+        **carried,
         **kwargs,
     )
+    df_, configs, weights = result[:3]
+    eloc = result[3] if carry_state else None
     df_ = pd.DataFrame(df_)
     eref = df_[ekey[0] + ekey[1]][0]
     esigma = np.abs(eref) / 100
-    for step in range(npropagate):
-        if verbose:
-            print("branch step", step, flush=True)
-        df_, configs, weights = propagate(
-            wf,
-            configs,
-            weights,
-            tstep,
-            branchcut_start * esigma,
-            branchcut_stop * esigma,
-            eref=eref,
-            nsteps=branchtime,
-            stepoffset=branchtime * step + stepoffset,
-            accumulators=accumulators,
-            ekey=ekey,
-            drift_limiter=drift_limiter,
-            **kwargs,
-        )
-        dmc_file(hdf_file, df_, dict(tstep=tstep), configs, weights)
-        df_["eref"] = eref
-        # print(df_)
-        df.append(df_)
-        eref = df_[ekey[0] + ekey[1]].values[-1] - feedback * np.log(np.mean(weights))
-        configs, weights = branch(configs, weights)
-    return pd.concat(df).reset_index(), configs, weights
+    try:
+        for step in range(npropagate):
+            if verbose:
+                print("branch step", step, flush=True)
+            carried = dict(eloc=eloc, return_eloc=True) if carry_state else {}
+            result = propagate(
+                wf,
+                configs,
+                weights,
+                tstep,
+                branchcut_start * esigma,
+                branchcut_stop * esigma,
+                eref=eref,
+                nsteps=branchtime,
+                stepoffset=branchtime * step + stepoffset,
+                accumulators=accumulators,
+                ekey=ekey,
+                drift_limiter=drift_limiter,
+                move=move,
+                timer=timer,
+                tmoves=tmoves,
+                intervals=intervals,
+                **carried,
+                **kwargs,
+            )
+            df_, configs, weights = result[:3]
+            eloc = result[3] if carry_state else None
+            rows = df_.to_dict("records")
+            for row in rows:
+                row["nconfig"] = configs.configs.shape[0]
+                row["eref"] = eref
+            with timer("hdf"):
+                writer.extend(rows, {"configs": configs.configs, "weights": weights})
+            if monitor is not None:
+                for row in rows:
+                    monitor.add(row)
+            else:
+                for row in rows:
+                    statistics.add(row)
+            if store_steps:
+                df.extend(rows)
+            eref = rows[-1][ekey[0] + ekey[1]] - feedback * np.log(
+                np.sum(weights) / nconfig
+            )
+            with timer("branch"):
+                branchwf = wf if carry_state else None
+                if branching == "birthdeath":
+                    configs, weights, eloc = branch_birthdeath(
+                        configs, weights, wf=branchwf, eloc=eloc
+                    )
+                else:
+                    configs, weights = branch(configs, weights, wf=branchwf, eloc=eloc)
+            if monitor is not None and monitor.done():
+                if verbose:
+                    print(
+                        "Reached target error after", branchtime * (step + 1), "steps"
+                    )
+                break
+    finally:
+        with timer("hdf"):
+            writer.close({"configs": configs.configs, "weights": weights})
+    if hdf_file is not None and timer is not null_timer:
+        with h5py.File(hdf_file, "a") as hdf:
+            timer.to_hdf(hdf)
+    if not store_steps:
+        return statistics.summary(), configs, weights
+    df = pd.DataFrame(df)
+    if monitor is not None:
+        warmup = len(df) if monitor.warmup is None else monitor.warmup
+        df["equilibrated"] = np.arange(len(df)) >= warmup
+    return df, configs, weights
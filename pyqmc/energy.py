@@ -50,7 +50,7 @@ def kinetic(configs, wf):
     return ke
 
 
-def energy(mol, configs, wf, threshold):
+def energy(mol, configs, wf, threshold, ecp=None):
     """Compute the local energy of a set of configurations.
     
     Args:
@@ -60,12 +60,17 @@ def energy(mol, configs, wf, threshold):
        
       wf: A Wavefunction-like object. Functions used include recompute(), lapacian(), and testvalue()
 
+      ecp: An eval_ecp.ECPEvaluator for mol. If None, one is built for this call, without a cutoff.
+
     Returns: 
       a dictionary with energy components ke, ee, ei, and total
       """
     ee = ee_energy(configs)
     ei = ei_energy(mol, configs)
-    ecp_val = get_ecp(mol, configs, wf, threshold)
+    if ecp is None:
+        ecp_val = get_ecp(mol, configs, wf, threshold)
+    else:
+        ecp_val = ecp(configs, wf)
     ii = ii_energy(mol)
     ke = kinetic(configs, wf)
     # print(ke,ee,ei,ii)
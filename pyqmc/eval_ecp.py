@@ -148,12 +148,16 @@ def get_P_l(mol, configs, weights, epos_rot, l_list, e, at):
 #########################################################################
 
 
-def ecp_ea(mol, configs, wf, e, at, threshold):
-    """ 
-    Returns the ECP value between electron e and atom at, local+nonlocal.
+def ecp_ea_nonlocal(mol, configs, wf, e, at, threshold):
+    """
+    Returns the quadrature of the nonlocal ECP between electron e and atom at, as a dictionary:
+      ratio: nconf x naip array of Psi(r_e(i))/Psi(r_e) at the quadrature points
+      weight: nconf x naip array of sum_l v_l (2l+1) P_l w_i, zero for the walkers skipped by threshold
+      epos: nconf x naip x 3 array of the quadrature points
+      local: nconf array of the local part of the ECP
+    The nonlocal part of the ECP is sum(ratio*weight, axis=1).
     """
     nconf = configs.configs.shape[0]
-    ecp_val = np.zeros(nconf)
 
     l_list, v_l = get_v_l(mol, configs, e, at)
     mask, prob = ecp_mask(v_l, threshold)
@@ -161,9 +165,7 @@ def ecp_ea(mol, configs, wf, e, at, threshold):
     masked_v_l[:, :-1] /= prob[mask, np.newaxis]
     masked_configs = configs.mask(mask)
 
-    naip = 6
-    if len(l_list) > 2:
-        naip = 12
+    naip = 12 if len(l_list) > 2 else 6
 
     # Use masked objects internally
     weights, epos_rot = get_rot(mol, masked_configs, e, at, naip)
@@ -172,26 +174,271 @@ def ecp_ea(mol, configs, wf, e, at, threshold):
     # Expand externally
     expanded_epos_rot = np.zeros((nconf, naip, 3))
     expanded_epos_rot[mask] = epos_rot
-    ratio = get_wf_ratio(wf, configs, expanded_epos_rot, e, mask)
+    masked_ratio = get_wf_ratio(wf, configs, expanded_epos_rot, e, mask)
+    ratio = np.zeros((nconf, naip), dtype=masked_ratio.dtype)
+    ratio[mask] = masked_ratio
+    weight = np.zeros((nconf, naip))
+    weight[mask] = np.einsum("ik,ijk->ij", masked_v_l, P_l)
 
-    # Compute local and non-local parts
-    ecp_val[mask] = np.einsum("ij,ik,ijk->i", ratio, masked_v_l, P_l)
     local_l = -1
-    ecp_val += v_l[:, local_l]
-    return ecp_val
+    return {
+        "ratio": ratio,
+        "weight": weight,
+        "epos": expanded_epos_rot,
+        "local": v_l[:, local_l],
+    }
+
+
+def ecp_ea(mol, configs, wf, e, at, threshold):
+    """ 
+    Returns the ECP value between electron e and atom at, local+nonlocal.
+    """
+    quadrature = ecp_ea_nonlocal(mol, configs, wf, e, at, threshold)
+    ecp_val = np.einsum("ij,ij->i", quadrature["ratio"], quadrature["weight"])
+    return ecp_val + quadrature["local"]
 
 
 def ecp(mol, configs, wf, threshold):
     """
     Returns the ECP value, summed over all the electrons and atoms.
     """
-    nconf, nelec = configs.configs.shape[0:2]
-    ecp_tot = np.zeros(nconf)
-    if mol._ecp != {}:
+    return ECPEvaluator(mol, threshold, tolerance=None)(configs, wf)
+
+
+def nonlocal_tmoves(mol, configs, wf, e, threshold):
+    """
+    Returns the quadrature points of the nonlocal ECP of electron e for all atoms; 
+    see ECPEvaluator.nonlocal_tmoves().
+    """
+    return ECPEvaluator(mol, threshold, tolerance=None).nonlocal_tmoves(configs, wf, e)
+
+
+def ecp_e(mol, configs, wf, e, threshold):
+    """
+    Returns the ECP quadrature of electron e for all the atoms; see ECPEvaluator.electron().
+    """
+    return ECPEvaluator(mol, threshold, tolerance=None).electron(configs, wf, e)
+
+
+class ECPEvaluator:
+    """
+    Evaluates the ECP of mol for all electrons and atoms. It is built once per mol: the 
+    radial functions of each species are kept, along with a cutoff radius beyond which 
+    every nonlocal channel of the species is smaller than tolerance. Electron-atom pairs 
+    outside the cutoff skip the nonlocal quadrature entirely, without random masking or 
+    wave function evaluations; the local part is evaluated for every pair.
+
+    EnergyAccumulator owns one. tolerance=None turns the cutoff off, which reproduces 
+    ecp_ea() for every pair with the same random numbers, as long as the default 
+    quadrature is used.
+    """
+
+    def __init__(self, mol, threshold=10, tolerance=1e-8, rmax=50.0, quadrature=None):
+        """
+        threshold: as in ecp_mask().
+        tolerance: size of the nonlocal channels at the cutoff radius, or None for no cutoff.
+        rmax: largest cutoff radius considered.
+        quadrature: number of points of the rule in QUADRATURE_RULES used for every species, 
+          or a dictionary from species names to either a number of points or a dictionary 
+          from nonlocal channels l to numbers of points, for example {"Cl": {0: 6, 1: 6, 2: 18}}. 
+          Species and channels left out use default_quadrature().
+        """
+        self.threshold = threshold
+        self.atoms = [at for at in range(len(mol._atom)) if mol._atom[at][0] in mol._ecp]
+        self.apos = np.array([mol._atom[at][1] for at in self.atoms]).reshape((-1, 3))
+        self.species = {}
+        for a, at in enumerate(self.atoms):
+            self.species.setdefault(mol._atom[at][0], []).append(a)
+        self.functors = {
+            name: generate_ecp_functors(mol._ecp[name][1]) for name in self.species
+        }
+        self.nl = max([len(vl) - 1 for vl in self.functors.values()], default=0)
+        self.cutoff = np.zeros(len(self.atoms))
+        for name, inds in self.species.items():
+            self.cutoff[inds] = _cutoff_radius(self.functors[name], tolerance, rmax)
+
+        # Each term integrates some nonlocal channels of one atom with one rule
+        self.rules = {}
+        term_atom, term_naip, term_channels = [], [], []
+        for name, inds in self.species.items():
+            self.rules[name] = _channel_rules(self.functors[name], name, quadrature)
+            for n in sorted(set(self.rules[name].values())):
+                channels = np.zeros(self.nl, dtype=bool)
+                channels[[l for l, nl in self.rules[name].items() if nl == n]] = True
+                term_atom.extend(inds)
+                term_naip.extend([n] * len(inds))
+                term_channels.extend([channels] * len(inds))
+        self.term_atom = np.array(term_atom, dtype=int)
+        self.term_naip = np.array(term_naip, dtype=int)
+        self.term_channels = np.array(term_channels, dtype=bool).reshape(
+            (len(term_atom), self.nl)
+        )
+
+    def __call__(self, configs, wf):
+        """ Returns the ECP value of each walker, summed over all the electrons and atoms """
+        nconf, nelec = configs.configs.shape[0:2]
+        ecp_tot = np.zeros(nconf)
+        if len(self.atoms) == 0:
+            return ecp_tot
         for e in range(nelec):
-            for at in range(len(mol._atom)):
-                ecp_tot += ecp_ea(mol, configs, wf, e, at, threshold)
-    return ecp_tot
+            quadrature = self.electron(configs, wf, e)
+            ecp_tot += quadrature["local"]
+            ecp_tot += np.real(
+                np.einsum("ij,ij->i", quadrature["ratio"], quadrature["weight"])
+            )
+        return ecp_tot
+
+    def nonlocal_tmoves(self, configs, wf, e):
+        """
+        Returns the dictionary of electron() without "local". ratio*weight are the nonlocal 
+        matrix elements <r_e(i)|V|r_e> Psi(r_e(i))/Psi(r_e), from which DMC proposes T-moves.
+        Every pair inside the cutoff is included, without the random threshold masking: the 
+        T-move probabilities are nonlinear in these weights, so the 1/prob rescaled weights 
+        of the energy estimator would bias the walk.
+        """
+        quadrature = self.electron(configs, wf, e, sample=False)
+        return {k: quadrature[k] for k in ["ratio", "weight", "epos"]}
+
+    def electron(self, configs, wf, e, sample=True):
+        """
+        Returns the ECP quadrature of electron e for all the atoms at once, as a dictionary:
+          ratio: nconf x npoints array of Psi(r_e(i))/Psi(r_e)
+          weight: nconf x npoints array of sum_l v_l (2l+1) P_l w_i 
+          epos: nconf x npoints x 3 array of the quadrature points
+          local: nconf array of the local part, summed over the atoms
+        Each walker's points are those of the atoms it samples, packed at the start of its 
+        row; the remaining points are the current position of e, with ratio 1 and weight 0. 
+        An atom whose channels use different rules contributes one set of points per rule, 
+        all rotated by the same random angles. The random numbers are drawn atom by atom, 
+        in the same order as ecp_ea() for each atom; everything else is evaluated for all 
+        pairs together, and the wave function ratios with one wf.testvalue() call.
+        If sample is False, every pair inside the cutoff is evaluated instead of being 
+        sampled with the probabilities of ecp_mask(), and only the rotations are random.
+        """
+        nconf = configs.configs.shape[0]
+        natom = len(self.atoms)
+        r_ea_vec = configs.dist.dist_i(self.apos, configs.configs[:, e, :])
+        r_ea = np.linalg.norm(r_ea_vec, axis=-1)  # nconf x natom
+        incut = r_ea < self.cutoff
+
+        # Radial functions; the nonlocal channels only inside the cutoff
+        v_nonlocal = np.zeros((nconf, natom, self.nl))
+        v_local = np.zeros((nconf, natom))
+        for name, inds in self.species.items():
+            r = r_ea[:, inds]
+            inside = incut[:, inds]
+            vals = np.zeros((*r.shape, self.nl))
+            for l, func in self.functors[name].items():
+                if l == -1:
+                    v_local[:, inds] = func(r.ravel()).reshape(r.shape)
+                else:
+                    vals[inside, l] = func(r[inside])
+            v_nonlocal[:, inds] = vals
+
+        # Same acceptance probabilities as ecp_mask(); random numbers drawn atom by atom
+        l = 2 * np.arange(self.nl) + 1
+        prob = np.einsum("ijl,l->ij", np.abs(v_nonlocal), self.threshold * (2 * l + 1))
+        prob = np.minimum(1, prob)
+        if not sample:
+            prob = np.ones(prob.shape)
+        mask = np.zeros((nconf, natom), dtype=bool)
+        t, p = np.zeros((nconf, natom)), np.zeros((nconf, natom))
+        for a in range(natom):
+            inside = np.nonzero(incut[:, a])[0]
+            if len(inside) == 0:
+                continue
+            if sample:
+                u = np.random.uniform(low=0, high=1, size=len(inside))
+                masked = inside[prob[inside, a] > u]
+            else:
+                masked = inside
+            mask[masked, a] = True
+            t[masked, a] = np.random.uniform(low=0.0, high=np.pi, size=len(masked))
+            p[masked, a] = np.random.uniform(low=0.0, high=2 * np.pi, size=len(masked))
+
+        # Sampled terms, sorted by walker, and where their points start in the walker's row
+        c_idx, t_idx = np.nonzero(mask[:, self.term_atom])
+        a_idx = self.term_atom[t_idx]
+        npts = self.term_naip[t_idx]
+        cumulative = np.cumsum(npts) - npts
+        start = cumulative - cumulative[np.searchsorted(c_idx, c_idx)]
+        nrow = np.bincount(c_idx, weights=npts, minlength=nconf).astype(int)
+        npoints = np.amax(nrow, initial=0)
+
+        epos_rot = np.repeat(configs.configs[:, e, np.newaxis, :], npoints, axis=1)
+        weight = np.zeros((nconf, npoints))
+        scaled_v = v_nonlocal[c_idx, a_idx] / prob[c_idx, a_idx, np.newaxis]
+        scaled_v *= self.term_channels[t_idx]
+        frames = _rotation_frames(t[c_idx, a_idx], p[c_idx, a_idx])  # npairs x 3 x 3
+        for n in np.unique(npts):
+            sel = npts == n
+            c, a = c_idx[sel], a_idx[sel]
+            vectors, w = QUADRATURE_RULES[n]
+            unit = np.matmul(vectors, frames[sel])  # npairs x naip x 3
+            rdotR = np.einsum("pk,pnk->pn", r_ea_vec[c, a], unit)
+            rdotR /= r_ea[c, a, np.newaxis]
+            P_l_val = np.stack(
+                [(2 * l + 1) * P_l(rdotR, l) * w for l in range(self.nl)], axis=-1
+            )
+            cols = start[sel, np.newaxis] + np.arange(n)
+            rows = c[:, np.newaxis]
+            epos_rot[rows, cols] = (
+                self.apos[a, np.newaxis] + r_ea[c, a, np.newaxis, np.newaxis] * unit
+            )
+            weight[rows, cols] = np.einsum("pl,pnl->pn", scaled_v[sel], P_l_val)
+
+        anymask = nrow > 0
+        ratio = np.zeros((nconf, npoints))
+        if npoints > 0:
+            epos = configs.make_irreducible(e, epos_rot)
+            masked_ratio = wf.testvalue(e, epos, anymask)
+            ratio = np.ones((nconf, npoints), dtype=masked_ratio.dtype)
+            ratio[anymask] = masked_ratio
+        return {
+            "ratio": ratio,
+            "weight": weight,
+            "epos": epos_rot,
+            "local": np.sum(v_local, axis=1),
+        }
+
+
+def _channel_rules(vl, name, quadrature):
+    """ The number of quadrature points for each nonlocal channel l in the functors vl """
+    if isinstance(quadrature, dict):
+        quadrature = quadrature.get(name, None)
+    rules = {}
+    for l in vl:
+        if l == -1:
+            continue
+        n = quadrature.get(l, None) if isinstance(quadrature, dict) else quadrature
+        rules[l] = default_quadrature(vl) if n is None else n
+        if rules[l] not in QUADRATURE_RULES:
+            raise ValueError(
+                "No quadrature rule with {0} points; available: {1}".format(
+                    rules[l], sorted(QUADRATURE_RULES)
+                )
+            )
+    return rules
+
+
+def _cutoff_radius(vl, tolerance, rmax):
+    """
+    The radius beyond which every nonlocal channel in the functors vl is smaller than 
+    tolerance, found on a grid up to rmax. Infinite if tolerance is None.
+    """
+    if tolerance is None:
+        return np.inf
+    r = np.linspace(0, rmax, 5001)[1:]
+    v = np.zeros(r.shape)
+    for l, func in vl.items():
+        if l != -1:
+            v = np.maximum(v, np.abs(func(r)))
+    above = np.nonzero(v > tolerance)[0]
+    if len(above) == 0:
+        return 0.0
+    if above[-1] == len(r) - 1:
+        return np.inf
+    return r[above[-1] + 1]
 
 
 def ecp_mask(v_l, threshold):
@@ -209,7 +456,8 @@ def ecp_mask(v_l, threshold):
 #################### Quadrature Rules ############################
 def get_rot(mol, configs, e, at, naip):
     """
-    Returns the integration weights (naip), and the positions of the rotated electron e (nconf x naip x 3)
+    Returns the integration weights (naip), and the positions of the rotated electron e (nconf x naip x 3),
+    for the rule with naip points in QUADRATURE_RULES
     Parameters: 
       configs[:,e,:]: epos of the electron e to be rotated
     Returns:
@@ -227,54 +475,107 @@ def get_rot(mol, configs, e, at, naip):
     t = np.random.uniform(low=0.0, high=np.pi, size=nconf)
     p = np.random.uniform(low=0.0, high=2 * np.pi, size=nconf)
 
-    # rotated unit vectors:
-    i_rot, j_rot, k_rot = (
-        np.zeros([nconf, 1, 3]),
-        np.zeros([nconf, 1, 3]),
-        np.zeros([nconf, 1, 3]),
+    # rotate the quadrature directions with one batched matrix product
+    vectors, weights = QUADRATURE_RULES[naip]
+    epos_rot = apos + r_ea * np.matmul(vectors, _rotation_frames(t, p))
+
+    return weights, epos_rot
+
+
+def _rotation_frames(t, p):
+    """
+    Returns a (t.shape) x 3 x 3 array whose rows are the rotated unit vectors i, j, k 
+    for random angles t and p, which orient the quadrature grid. A rule's unit vectors 
+    (npoints x 3) times this matrix are the rotated quadrature directions.
+    """
+    frames = np.zeros((*t.shape, 3, 3))
+    frames[..., 0, 0] = np.cos(p - np.pi / 2.0)
+    frames[..., 0, 1] = np.sin(p - np.pi / 2.0)
+    frames[..., 1, 0] = np.sin(t + np.pi / 2.0) * np.cos(p)
+    frames[..., 1, 1] = np.sin(t + np.pi / 2.0) * np.sin(p)
+    frames[..., 1, 2] = np.cos(t + np.pi / 2.0)
+    frames[..., 2, 0] = np.sin(t) * np.cos(p)
+    frames[..., 2, 1] = np.sin(t) * np.sin(p)
+    frames[..., 2, 2] = np.cos(t)
+    return frames
+
+
+def _from_angles(d1, d2):
+    """ Unit vectors with polar angles d1 and azimuthal angles d2 """
+    d1, d2 = np.asarray(d1), np.asarray(d2)
+    return np.stack(
+        [np.sin(d1) * np.cos(d2), np.sin(d1) * np.sin(d2), np.cos(d1)], axis=-1
     )
-    i_rot[:, 0, 0] = np.cos(p - np.pi / 2.0)
-    i_rot[:, 0, 1] = np.sin(p - np.pi / 2.0)
-    j_rot[:, 0, 0] = np.sin(t + np.pi / 2.0) * np.cos(p)
-    j_rot[:, 0, 1] = np.sin(t + np.pi / 2.0) * np.sin(p)
-    j_rot[:, 0, 2] = np.cos(t + np.pi / 2.0)
-    k_rot[:, 0, 0] = np.sin(t) * np.cos(p)
-    k_rot[:, 0, 1] = np.sin(t) * np.sin(p)
-    k_rot[:, 0, 2] = np.cos(t)
-
-    d1, d2 = np.zeros((naip, 1)), np.zeros((naip, 1))
-    if naip == 6:
-        d1[1] = np.pi
-
-        d1[2] = np.pi / 2.0
-
-        d1[3] = np.pi / 2.0
-        d2[3] = np.pi
-
-        d1[4] = np.pi / 2.0
-        d2[4] = np.pi / 2.0
-
-        d1[5] = np.pi / 2.0
-        d2[5] = 3.0 * np.pi / 2.0
-
-    elif naip == 12:
-        d1[1] = np.pi
-
-        fi0 = np.pi / 5.0
-        tha = np.arccos(1.0 / np.sqrt(5.0))
-        for i in range(5):
-            rk2 = 2 * i
-            d1[i + 2] = tha
-            d2[i + 2] = rk2 * fi0
-
-            d1[i + 7] = np.pi - tha
-            d2[i + 7] = (rk2 + 1) * fi0
-
-    epos_rot = apos + r_ea * (
-        i_rot * np.sin(d1) * np.cos(d2)
-        + j_rot * np.sin(d1) * np.sin(d2)
-        + k_rot * np.cos(d1)
+
+
+def _signed_permutations(v, cyclic=True):
+    """ All distinct sign changes of the cyclic permutations of v """
+    perms = [np.roll(v, i) for i in range(3)] if cyclic else [np.asarray(v)]
+    points = set()
+    for perm in perms:
+        for signs in np.ndindex(2, 2, 2):
+            points.add(tuple(np.where(signs, -1, 1) * perm + 0.0))
+    return np.array(sorted(points))
+
+
+def _normalize(v):
+    return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+
+def _quadrature_rules():
+    """
+    Spherical quadrature rules (Mitas, Shirley, and Ceperley, J. Chem. Phys. 95, 3467 (1991)), 
+    keyed by the number of points, as (npoints x 3 unit vectors, npoints weights summing to 1).
+    Exact for spherical harmonics up to l=2 (4 points), 3 (6), 5 (12 and 18), and 9 (32).
+    """
+    rules = {}
+    rules[4] = _normalize(np.array([[1, 1, 1], [1, -1, -1], [-1, 1, -1], [-1, -1, 1]]))
+
+    # octahedron, with the same orientation as the original grid
+    d1 = np.array([0, np.pi, np.pi / 2, np.pi / 2, np.pi / 2, np.pi / 2])
+    d2 = np.array([0, 0, 0, np.pi, np.pi / 2, 3 * np.pi / 2])
+    rules[6] = _from_angles(d1, d2)
+
+    # icosahedron: the poles and two staggered rings
+    tha = np.arccos(1.0 / np.sqrt(5.0))
+    fi0 = np.pi / 5.0
+    d1 = np.concatenate([[0, np.pi], [tha] * 5, [np.pi - tha] * 5])
+    d2 = np.concatenate([[0, 0], 2 * np.arange(5) * fi0, (2 * np.arange(5) + 1) * fi0])
+    rules[12] = _from_angles(d1, d2)
+
+    # octahedron vertices and edge midpoints
+    octahedron = _signed_permutations([1.0, 0, 0])
+    edges = _normalize(_signed_permutations([1.0, 1.0, 0]))
+    rules[18] = np.concatenate([octahedron, edges])
+
+    # icosahedron vertices and the dual dodecahedron's vertices
+    phi = (1 + np.sqrt(5)) / 2
+    icosahedron = _normalize(_signed_permutations([0, 1.0, phi]))
+    dodecahedron = _normalize(
+        np.concatenate(
+            [
+                _signed_permutations([1.0, 1.0, 1.0], cyclic=False),
+                _signed_permutations([1 / phi, 0, phi]),
+            ]
+        )
     )
-    weights = 1.0 / naip * np.ones(naip)
+    rules[32] = np.concatenate([icosahedron, dodecahedron])
 
-    return weights, epos_rot
+    weights = {
+        4: np.full(4, 1 / 4),
+        6: np.full(6, 1 / 6),
+        12: np.full(12, 1 / 12),
+        18: np.concatenate([np.full(6, 1 / 30), np.full(12, 1 / 15)]),
+        32: np.concatenate([np.full(12, 5 / 168), np.full(20, 27 / 840)]),
+    }
+    return {n: (vectors, weights[n]) for n, vectors in rules.items()}
+
+
+# Available rules, as (unit vectors, weights) keyed by the number of points.
+# Further rules can be added here and selected with ECPEvaluator(quadrature=...).
+QUADRATURE_RULES = _quadrature_rules()
+
+
+def default_quadrature(vl):
+    """ The number of quadrature points used for the functors vl unless chosen otherwise """
+    return 12 if len(vl) > 2 else 6
@@ -1,6 +1,7 @@
 import numpy as np
 import pyqmc
-from scipy.special import erfc
+from scipy.special import erfc, comb
+from math import factorial
 
 
 class Ewald:
@@ -38,10 +39,10 @@ class Ewald:
     Real space terms, arranged to sum over each pair only once:
 
         .. math:: E_{\rm real\ space}^{\text{ion-ion}} = \sum_{\vec{n}} \sum_{I<J}^{N_{ion}} Z_I Z_J \frac{{\rm erfc}(\alpha r_{IJn})}{r_{IJn}} 
-            + \frac{1}{2} \sum_{I=1}^{N_{ion}} Z_I^2 C_{\rm self\ image}
+            + \sum_{I=1}^{N_{ion}} Z_I^2 C_{\rm self\ image}
 
         .. math:: E_{\rm real\ space}^{ee} = \sum_{\vec{n}} \sum_{i<j}^{N_e} \frac{{\rm erfc}(\alpha r_{ijn})}{r_{ijn}}
-            + \frac{N_e}{2} C_{\rm self\ image}
+            + N_e C_{\rm self\ image}
 
     .. math:: E_{\rm real\ space}^{e\text{-ion}} = {\sum_{\vec{n}}} \sum_{i=1}^{N_e} \sum_{I=1}^{N_{ion}} -Z_I \frac{{\rm erfc}(\alpha r_{iIn})}{r_{iIn}}
 
@@ -77,28 +78,72 @@ class Ewald:
 
     """
 
-    def __init__(self, cell, ewald_gmax=200, nlatvec=2):
+    def __init__(
+        self,
+        cell,
+        ewald_gmax=200,
+        nlatvec=2,
+        accuracy=None,
+        nconf=1,
+        cost_ratio=1.0,
+        reciprocal="direct",
+        pme_order=6,
+        pme_grid=None,
+        structure_factor_bytes=2 ** 30,
+    ):
         """
         Inputs:
             cell: pyscf Cell object (simulation cell)
             ewald_gmax: int, how far to take reciprocal sum; probably never needs to be changed.
             nlatvec: int, how far to take real-space sum; probably never needs to be changed.
+            accuracy: float, if given, choose alpha, the lattice displacements and the reciprocal cutoff with tune_ewald() for this absolute error of the energy, instead of using nlatvec and the default alpha. The choice is stored in `tuning`.
+            nconf: int, number of walkers per evaluation, passed to tune_ewald().
+            cost_ratio: float, cost of a reciprocal-space term relative to a real-space term, passed to tune_ewald().
+            reciprocal: "direct" sums the electron reciprocal-space terms over the G vectors; "pme" uses the smooth particle-mesh Ewald method (see set_up_pme()), whose cost grows as :math:`N_e \log N_e` instead of :math:`N_e N_G`.
+            pme_order: int, order of the B-splines used by "pme".
+            pme_grid: 3 ints, size of the "pme" grid; chosen from the G vectors if None.
+            structure_factor_bytes: int, largest size of the electron structure factors kept between calls by structure_factor(); larger ones are recomputed on every call. Also passed to tune_ewald() as max_bytes.
         """
+        assert reciprocal in ("direct", "pme"), "Invalid reciprocal={0}".format(
+            reciprocal
+        )
         self.nelec = np.array(cell.nelec)
         self.atom_coords, self.atom_charges = cell.atom_coords(), cell.atom_charges()
         self.latvec = cell.lattice_vectors()
-        self.set_lattice_displacements(nlatvec)
-        self.set_up_reciprocal_ewald_sum(ewald_gmax)
-
-    def set_lattice_displacements(self, nlatvec):
+        if accuracy is None:
+            self.tuning = None
+            self.set_lattice_displacements(nlatvec)
+            self.set_up_reciprocal_ewald_sum(ewald_gmax)
+        else:
+            self.tuning = tune_ewald(
+                cell, accuracy, nconf, cost_ratio, max_bytes=structure_factor_bytes
+            )
+            self.set_lattice_displacements(nlatvec, rmax=self.tuning["rmax"])
+            self.set_up_reciprocal_ewald_sum(
+                ewald_gmax,
+                alpha=self.tuning["alpha"],
+                gcut=self.tuning["gcut"],
+                rcut=self.tuning["rcut"],
+            )
+        self.reciprocal = reciprocal
+        if reciprocal == "pme":
+            self.set_up_pme(pme_order, pme_grid)
+        self.structure_factor_bytes = structure_factor_bytes
+        self._epos = None
+
+    def set_lattice_displacements(self, nlatvec, rmax=None):
         """
-        Generates list of lattice-vector displacements to add together for real-space sum, going from `-nlatvec` to `nlatvec` in each lattice direction.
+        Generates list of lattice-vector displacements to add together for real-space sum, going from `-nlatvec` to `nlatvec` in each lattice direction, or, if rmax is given, all displacements shorter than rmax.
         """
-        XYZ = np.meshgrid(*[np.arange(-nlatvec, nlatvec + 1)] * 3, indexing="ij")
-        xyz = np.stack(XYZ, axis=-1).reshape((-1, 3))
+        if rmax is None:
+            XYZ = np.meshgrid(*[np.arange(-nlatvec, nlatvec + 1)] * 3, indexing="ij")
+            xyz = np.stack(XYZ, axis=-1).reshape((-1, 3))
+        else:
+            half = _positive_half_sphere(self.latvec, rmax, np.iinfo(np.int32).max)
+            xyz = np.concatenate([np.zeros((1, 3), dtype=int), half, -half])
         self.lattice_displacements = np.dot(xyz, self.latvec)
 
-    def set_up_reciprocal_ewald_sum(self, ewald_gmax):
+    def set_up_reciprocal_ewald_sum(self, ewald_gmax, alpha=None, gcut=None, rcut=None):
         r"""
         Determine parameters for Ewald sums. 
 
@@ -108,33 +153,51 @@ class Ewald:
         
         .. math:: W_G = \frac{4\pi}{V |\vec{G}|^2} e^{- \frac{|\vec{G}|^2}{ 4\alpha^2}}
 
+        G vectors are kept if :math:`W_G > 10^{-10}`. Since :math:`W_G` decreases with :math:`|\vec{G}|`, they are enumerated inside the sphere where this holds, without building a grid of all candidates, so the cost scales with the number of G vectors kept.
+
         Inputs:
             latvec: (3, 3) array of lattice vectors; latvec[0] is the first
             ewald_gmax: int, max number of reciprocal lattice vectors to check away from 0
+            alpha: float, defaults to 5 over the smallest height of the cell
+            gcut: float, keep G vectors with :math:`|\vec{G}| \le` gcut instead of those with large weights
+            rcut: float, real-space cutoff used by real_space_sum(); defaults to where the terms fall below :math:`10^{-10}`
         """
         cellvolume = np.linalg.det(self.latvec)
-        recvec = np.linalg.inv(self.latvec)
-        crossproduct = recvec.T * cellvolume
+        recvec = np.linalg.inv(self.latvec).T
 
         # Determine alpha
-        tmpheight_i = np.einsum("ij,ij->i", crossproduct, self.latvec)
-        length_i = np.linalg.norm(crossproduct, axis=1)
-        smallestheight = np.amin(np.abs(tmpheight_i) / length_i)
-        self.alpha = 5.0 / smallestheight
+        if alpha is None:
+            alpha = 5.0 / _smallest_height(self.latvec)
+        self.alpha = alpha
         print("Setting Ewald alpha to ", self.alpha)
 
         # Determine G points to include in reciprocal Ewald sum
-        XYZ = np.meshgrid(*[np.arange(-ewald_gmax, ewald_gmax + 1)] * 3, indexing="ij")
-        X, Y, Z = [x.ravel() for x in XYZ]
-        positive_octants = X + 1e-6 * Y + 1e-12 * Z > 0  # assume ewald_gmax < 1e5
-        gpoints = np.stack((X, Y, Z), axis=-1)[positive_octants]
-        gpoints = np.dot(gpoints, recvec) * 2 * np.pi
+        tolerance = 1e-10
+        gweight = lambda g: 4 * np.pi * np.exp(-(g ** 2) / (4 * self.alpha ** 2)) / (
+            cellvolume * g ** 2
+        )
+        if gcut is None:
+            gmax = _decreasing_cutoff(gweight, tolerance, 2 * self.alpha)
+        else:
+            gmax = gcut
+        gbasis = recvec * 2 * np.pi
+        gpoints = _positive_half_sphere(gbasis, gmax * (1 + 1e-6), ewald_gmax)
+        gpoints = np.dot(gpoints, gbasis)
         gsquared = np.sum(gpoints ** 2, axis=1)
         gweight = 4 * np.pi * np.exp(-gsquared / (4 * self.alpha ** 2))
         gweight /= cellvolume * gsquared
-        bigweight = gweight > 1e-10
-        self.gpoints = gpoints[bigweight]
-        self.gweight = gweight[bigweight]
+        if gcut is None:
+            keep = gweight > tolerance
+        else:
+            keep = gsquared <= gcut ** 2
+        self.gpoints = gpoints[keep]
+        self.gweight = gweight[keep]
+
+        # Real-space terms beyond rcut are smaller than tolerance
+        if rcut is None:
+            erfc_r = lambda r: erfc(self.alpha * r) / r
+            rcut = _decreasing_cutoff(erfc_r, tolerance, 1 / self.alpha)
+        self.rcut = rcut
 
         self.set_ewald_constants(cellvolume)
 
@@ -147,8 +210,10 @@ class Ewald:
 
         .. math:: C_{ij} = - \frac{\pi}{V\alpha^2}
 
-        .. math:: C_{\rm square} = - \frac{\alpha}{\sqrt{\pi}}  - \frac{\pi}{2V\alpha^2} 
-                  = - \frac{\alpha}{\sqrt{\pi}}  - \frac{C_{ij}}{2}
+        .. math:: C_{\rm square} = - \frac{\alpha}{\sqrt{\pi}}  - \frac{\pi}{2V\alpha^2} + C_{\rm self\ image}
+                  = - \frac{\alpha}{\sqrt{\pi}}  - \frac{C_{ij}}{2} + C_{\rm self\ image}
+
+        The self-image term :math:`C_{\rm self\ image} = \frac{1}{2} \sum_{\vec{n} \ne 0} \frac{{\rm erfc}(\alpha |\vec{n}|)}{|\vec{n}|}` is negligible for the default :math:`\alpha`, but not for the smaller values that tune_ewald() may choose.
 
         The Ewald object doesn't retain information about the configurations, including number of electrons, so the electron constants are defined as functions of :math:`N_e`.
 
@@ -174,7 +239,10 @@ class Ewald:
 
         ijconst = -np.pi / (cellvolume * self.alpha ** 2)
         self.ijconst = ijconst
-        squareconst = -self.alpha / np.sqrt(np.pi) + ijconst / 2
+        nlength = np.linalg.norm(self.lattice_displacements, axis=1)
+        nlength = nlength[nlength > 0]
+        self_image = 0.5 * np.sum(erfc(self.alpha * nlength) / nlength)
+        squareconst = -self.alpha / np.sqrt(np.pi) + ijconst / 2 + self_image
 
         self.ii_const = ii_sum * ijconst + ii_sum2 * squareconst
         self.ee_const = lambda ne: ne * (ne - 1) / 2 * ijconst + ne * squareconst
@@ -193,7 +261,7 @@ class Ewald:
         r"""
         Compute ion contribution to Ewald sums.  Since the ions don't move in our calculations, the ion-ion term only needs to be computed once.
 
-        Note: We ignore the constant term :math:`\frac{1}{2} \sum_{I} Z_I^2 C_{\rm self\ image}` in the real-space ion-ion sum corresponding to the interaction of an ion with its own image in other cells.
+        Note: The constant term :math:`\sum_{I} Z_I^2 C_{\rm self\ image}` in the real-space ion-ion sum, corresponding to the interaction of an ion with its own image in other cells, is included in `ii_const` (see set_ewald_constants()).
 
         The real-space part:
 
@@ -212,10 +280,10 @@ class Ewald:
         else:
             dist = pyqmc.distance.MinimalImageDistance(self.latvec)
             ion_distances, ion_inds = dist.dist_matrix(self.atom_coords[np.newaxis])
-            rvec = ion_distances[:, :, np.newaxis, :] + self.lattice_displacements
-            r = np.linalg.norm(rvec, axis=-1)
             charge_ij = np.prod(self.atom_charges[np.asarray(ion_inds)], axis=1)
-            ion_ion_real = np.einsum("j,ijk->", charge_ij, erfc(self.alpha * r) / r)
+            ion_ion_real = np.einsum(
+                "j,ij->", charge_ij, self.real_space_sum(ion_distances)
+            )
 
         # Reciprocal space part
         GdotR = np.dot(self.gpoints, self.atom_coords.T)
@@ -225,11 +293,187 @@ class Ewald:
         ion_ion = ion_ion_real + ion_ion_rec
         return ion_ion
 
+    def real_space_sum(self, distances, max_bytes=2 ** 27):
+        r"""
+        Compute :math:`\sum_{\vec{n}} \frac{{\rm erfc}(\alpha |\vec{x}+\vec{n}|)}{|\vec{x}+\vec{n}|}` for each displacement :math:`\vec{x}`.
+
+        Only the images with :math:`|\vec{x}+\vec{n}|` within `rcut` are included for each :math:`\vec{x}`; the others contribute less than the tolerance. The lattice displacements that cannot bring any :math:`\vec{x}` within `rcut` are skipped, and the rest are added in blocks, so that the temporary arrays take about max_bytes.
+
+        Inputs:
+            distances: (..., 3) array of displacements
+            max_bytes: int, approximate size of the temporary arrays
+        Returns:
+            (...) array
+        """
+        dmax = np.amax(np.linalg.norm(distances, axis=-1), initial=0)
+        nlength = np.linalg.norm(self.lattice_displacements, axis=1)
+        images = self.lattice_displacements[nlength < self.rcut + dmax]
+        block = max(1, int(max_bytes / (8 * 4 * max(distances.size // 3, 1))))
+        total = np.zeros(distances.shape[:-1])
+        for start in range(0, len(images), block):
+            rvec = distances[..., np.newaxis, :] + images[start : start + block]
+            r = np.linalg.norm(rvec, axis=-1)
+            inside = r < self.rcut
+            total += np.sum(erfc(self.alpha * r) / r, axis=-1, where=inside)
+        return total
+
+    def set_up_pme(self, order, grid=None):
+        r"""
+        Set up the smooth particle-mesh Ewald method (Essmann et al., J. Chem. Phys. 103, 8577 (1995)) for the electron reciprocal-space sums.
+
+        Each charge is spread onto a periodic grid of :math:`K_1 \times K_2 \times K_3` points with cardinal B-splines :math:`M_p` of order :math:`p`, which approximate
+
+        .. math:: e^{i\vec{G}\cdot\vec{x}} \approx b(\vec{m}) \sum_{\vec{k}} M_p(\vec{u} - \vec{k}) e^{2\pi i \vec{m}\cdot\vec{k}/K}
+
+        where :math:`\vec{u}` are the fractional coordinates of :math:`\vec{x}` times the grid size and :math:`\vec{G} = 2\pi \sum_\beta m_\beta \vec{b}_\beta`. The reciprocal-space potential of a grid of charges is then a convolution, done with FFTs, and is interpolated back to the electrons with the same B-splines. The pair interaction :math:`\sum_{\vec{G} \ne 0} W_G \cos(\vec{G}\cdot\vec{x})` needed by energy_with_test_pos() is tabulated on the grid once.
+
+        Inputs:
+            order: int, order of the B-splines; even orders avoid zeros of :math:`b(\vec{m})`
+            grid: 3 ints; defaults to twice the range of each index of the G vectors, rounded up to a fast FFT size
+        """
+        invvec = np.linalg.inv(self.latvec)
+        if grid is None:
+            gmax = np.sqrt(np.amax(np.sum(self.gpoints ** 2, axis=1), initial=0))
+            nmax = np.ceil(gmax * np.linalg.norm(self.latvec, axis=1) / (2 * np.pi))
+            grid = [_fft_size(max(4 * n, 2 * order)) for n in nmax]
+        self.pme_order = order
+        self.pme_grid = np.asarray(grid, dtype=int)
+
+        m = [np.fft.fftfreq(K, 1.0 / K) for K in self.pme_grid]
+        m = np.meshgrid(*m, indexing="ij")
+        gpoints = np.dot(np.stack(m, axis=-1), invvec.T) * 2 * np.pi
+        gsquared = np.sum(gpoints ** 2, axis=-1)
+        gsquared[0, 0, 0] = 1.0
+        gweight = 4 * np.pi * np.exp(-gsquared / (4 * self.alpha ** 2))
+        gweight /= np.linalg.det(self.latvec) * gsquared
+        gweight[0, 0, 0] = 0.0
+        b1, b2, b3 = [_bspline_moduli(K, order) for K in self.pme_grid]
+        b = b1[:, np.newaxis, np.newaxis] * b2[:, np.newaxis] * b3
+        npoints = np.prod(self.pme_grid)
+
+        # The potential of grid charges Q is ifftn(influence * fftn(Q))
+        self._pme_influence = 0.5 * npoints * gweight * np.abs(b) ** 2
+        self._pme_pair = np.real(npoints * np.fft.ifftn(gweight * b))
+        self._pme_ion_potential = self._pme_potential(
+            self._pme_spread(self.atom_coords[np.newaxis], self.atom_charges)
+        )[0]
+
+    def _pme_weights(self, positions):
+        """
+        Returns the flattened grid indices and B-spline weights, both (..., p**3), of the grid points near each position (..., 3).
+        """
+        p, K = self.pme_order, self.pme_grid
+        u = (np.dot(positions, np.linalg.inv(self.latvec)) * K) % K
+        k0 = np.floor(u)
+        j = np.arange(p)
+        weights = _bspline(u[..., np.newaxis] - k0[..., np.newaxis] + j, p)
+        inds = (k0[..., np.newaxis].astype(int) - j) % K[:, np.newaxis]
+        flat = (
+            inds[..., 0, :, np.newaxis, np.newaxis] * K[1] * K[2]
+            + inds[..., 1, np.newaxis, :, np.newaxis] * K[2]
+            + inds[..., 2, np.newaxis, np.newaxis, :]
+        )
+        weight = (
+            weights[..., 0, :, np.newaxis, np.newaxis]
+            * weights[..., 1, np.newaxis, :, np.newaxis]
+            * weights[..., 2, np.newaxis, np.newaxis, :]
+        )
+        shape = positions.shape[:-1] + (p ** 3,)
+        return flat.reshape(shape), weight.reshape(shape)
+
+    def _pme_spread(self, positions, charges):
+        """
+        Returns the (nconf, K1, K2, K3) grid charges of charges (n) at positions (nconf, n, 3).
+        """
+        nconf = positions.shape[0]
+        npoints = np.prod(self.pme_grid)
+        flat, weight = self._pme_weights(positions)
+        flat += npoints * np.arange(nconf)[:, np.newaxis, np.newaxis]
+        weight *= np.asarray(charges)[:, np.newaxis]
+        Q = np.bincount(flat.ravel(), weight.ravel(), minlength=nconf * npoints)
+        return Q.reshape((nconf, *self.pme_grid))
+
+    def _pme_potential(self, Q):
+        """ Returns the reciprocal-space potential (nconf, K1, K2, K3) of grid charges Q """
+        axes = (1, 2, 3)
+        Qhat = np.fft.fftn(Q, axes=axes)
+        return np.real(np.fft.ifftn(self._pme_influence * Qhat, axes=axes))
+
+    def _pme_gather(self, grid, positions):
+        """
+        Interpolates a grid, either (K1, K2, K3) or (nconf, K1, K2, K3), at positions (nconf, ..., 3).
+        """
+        flat, weight = self._pme_weights(positions)
+        if grid.ndim == 3:
+            return np.sum(grid.ravel()[flat] * weight, axis=-1)
+        nconf = positions.shape[0]
+        conf = np.arange(nconf).reshape((nconf, *[1] * (flat.ndim - 1)))
+        return np.sum(grid.reshape((nconf, -1))[conf, flat] * weight, axis=-1)
+
+    def pme_separated(self, configs, max_bytes=2 ** 27):
+        """
+        Compute the reciprocal-space parts of the separated e-e and e-ion energies with the particle-mesh method; these replace ee_recip_separated and ei_recip_separated of the direct sums in ewald_electron().
+        Walkers are processed in blocks so that the grids take about max_bytes.
+
+        Inputs:
+            configs: pyqmc PeriodicConfigs object of shape (nconf, nelec, ndim)
+        Returns:
+            ee_recip_separated: (nconf, nelec) array
+            ei_recip_separated: (nconf, nelec) array
+        """
+        nconf, nelec = configs.configs.shape[:2]
+        per_walker = 8 * 4 * max(np.prod(self.pme_grid), nelec * self.pme_order ** 3)
+        block = max(1, int(max_bytes / per_walker))
+        ee_recip_separated = np.zeros((nconf, nelec))
+        for start in range(0, nconf, block):
+            epos = configs.configs[start : start + block]
+            potential = self._pme_potential(self._pme_spread(epos, np.ones(nelec)))
+            potential = self._pme_gather(potential, epos)
+            ee_recip_separated[start : start + block] = potential
+        ee_recip_separated -= 0.5 * self.gweight.sum()
+        ei_recip_separated = -self._pme_gather(self._pme_ion_potential, configs.configs)
+        return ee_recip_separated, ei_recip_separated
+
+    def structure_factor(self, configs, refresh_every=100):
+        r"""
+        Compute the electron terms of the reciprocal-space sums, :math:`e^{i\vec{G}\cdot\vec{x}_i}` for each electron and their sum :math:`\rho_G = \sum_{i=1}^{N_e} e^{i\vec{G}\cdot\vec{x}_i}`.
+
+        Both are kept between calls if :math:`e^{i\vec{G}\cdot\vec{x}_i}` takes at most `structure_factor_bytes`; otherwise they are recomputed and nothing is kept. Only the electrons that moved since the previous call are recomputed, at a cost proportional to the number of G vectors each, and :math:`\rho_G` is updated by their change. It is summed again from scratch every refresh_every calls to remove accumulated roundoff, and everything is recomputed if the number of walkers or electrons changes.
+
+        Inputs:
+            configs: pyqmc PeriodicConfigs object of shape (nconf, nelec, ndim)
+            refresh_every: int, number of calls between full sums of :math:`\rho_G`
+        Returns:
+            e_exp: (nconf, nelec, nG) array
+            rho: (nconf, nG) array
+        """
+        epos = configs.configs
+        nbytes = 16 * epos.shape[0] * epos.shape[1] * len(self.gpoints)
+        if nbytes > self.structure_factor_bytes:
+            self._epos, self._e_exp, self._rho = None, None, None
+            e_exp = np.exp(1j * np.dot(epos, self.gpoints.T))
+            return e_exp, np.sum(e_exp, axis=1)
+        if self._epos is None or self._epos.shape != epos.shape:
+            self._e_exp = np.exp(1j * np.dot(epos, self.gpoints.T))
+            self._rho = np.sum(self._e_exp, axis=1)
+            self._ncalls = 0
+        else:
+            c, e = np.nonzero(np.any(epos != self._epos, axis=-1))
+            if len(c) > 0:
+                new_exp = np.exp(1j * np.dot(epos[c, e], self.gpoints.T))
+                np.add.at(self._rho, c, new_exp - self._e_exp[c, e])
+                self._e_exp[c, e] = new_exp
+            self._ncalls += 1
+            if self._ncalls % refresh_every == 0:
+                self._rho = np.sum(self._e_exp, axis=1)
+        self._epos = epos.copy()
+        return self._e_exp, self._rho
+
     def ewald_electron(self, configs):
         r"""
         Compute the Ewald sum for e-e and e-ion
 
-        Note: We ignore the constant term :math:`\frac{N_e}{2} C_{\rm self\ image}` in the real-space e-e sum corresponding to the interaction of an electron with its own image in other cells.
+        Note: The constant term :math:`N_e C_{\rm self\ image}` in the real-space e-e sum, corresponding to the interaction of an electron with its own image in other cells, is included in `ee_const` (see set_ewald_constants()).
 
         Real space e-e:
 
@@ -258,39 +502,40 @@ class Ewald:
         # Real space electron-ion part
         # ei_distances shape (elec, conf, atom, dim)
         ei_distances = configs.dist.dist_i(self.atom_coords, configs.configs)
-        rvec = ei_distances[:, :, :, np.newaxis, :] + self.lattice_displacements
-        r = np.linalg.norm(rvec, axis=-1)
         ei_real_separated = np.einsum(
-            "k,ijkl->ji", -self.atom_charges, erfc(self.alpha * r) / r
+            "k,ijk->ji", -self.atom_charges, self.real_space_sum(ei_distances)
         )
 
         # Real space electron-electron part
         if nelec > 1:
-            ee_distances, ee_inds = configs.dist.dist_matrix(configs.configs)
-            rvec = ee_distances[:, :, np.newaxis, :] + self.lattice_displacements
-            r = np.linalg.norm(rvec, axis=-1)
-            ee_cij = np.sum(erfc(self.alpha * r) / r, axis=-1)
-
-            ee_matrix = np.zeros((nconf, nelec, nelec))
-            # ee_matrix[:, ee_inds] = ee_cij
-            for ((i, j), val) in zip(ee_inds, ee_cij.T):
-                ee_matrix[:, i, j] = val
-                ee_matrix[:, j, i] = val
-            ee_real_separated = ee_matrix.sum(axis=-1) / 2
+            ee_distances, _ = configs.dist.dist_matrix(configs.configs)
+            ee_cij = self.real_space_sum(ee_distances)
+
+            # Half of each pair energy goes to each electron; pairs are in triu order
+            i, j = np.triu_indices(nelec, k=1)
+            offset = nelec * np.arange(nconf)[:, np.newaxis]
+            ee_real_separated = np.bincount(
+                np.concatenate([(offset + i).ravel(), (offset + j).ravel()]),
+                weights=np.concatenate([ee_cij.ravel(), ee_cij.ravel()]),
+                minlength=nconf * nelec,
+            ).reshape((nconf, nelec))
+            ee_real_separated /= 2
         else:
             ee_real_separated = np.zeros(nelec)
 
-        # Reciprocal space electron-electron part
-        e_GdotR = np.dot(configs.configs, self.gpoints.T)
-        e_expGdotR = np.exp(1j * e_GdotR)
-        sum_e_exp = np.sum(e_expGdotR, axis=1, keepdims=True)
-        coscos_sinsin = np.real(sum_e_exp.conj() * e_expGdotR)
-        ### Don't know why we subtract 0.5 for "separated"
-        ee_recip_separated = np.dot(coscos_sinsin - 0.5, self.gweight)
+        if self.reciprocal == "pme":
+            ee_recip_separated, ei_recip_separated = self.pme_separated(configs)
+        else:
+            # Reciprocal space electron-electron part
+            e_expGdotR, rho = self.structure_factor(configs)
+            sum_e_exp = rho[:, np.newaxis]
+            coscos_sinsin = np.real(sum_e_exp.conj() * e_expGdotR)
+            ### Don't know why we subtract 0.5 for "separated"
+            ee_recip_separated = np.dot(coscos_sinsin - 0.5, self.gweight)
 
-        # Reciprocal space electron-ion part
-        coscos_sinsin = np.real(-self.ion_exp.conj() * e_expGdotR)
-        ei_recip_separated = np.dot(coscos_sinsin, self.gweight)
+            # Reciprocal space electron-ion part
+            coscos_sinsin = np.real(-self.ion_exp.conj() * e_expGdotR)
+            ei_recip_separated = np.dot(coscos_sinsin, self.gweight)
 
         # Combine parts
         self.ei_separated = ei_real_separated + 2 * ei_recip_separated
@@ -358,22 +603,27 @@ class Ewald:
         # Real space electron-ion part
         # ei_distances shape (conf, atom, dim)
         ei_distances = configs.dist.dist_i(self.atom_coords, epos.configs)
-        rvec = ei_distances[:, :, np.newaxis, :] + self.lattice_displacements
-        r = np.linalg.norm(rvec, axis=-1)
         Vtest[:, -1] += np.einsum(
-            "k,jkl->j", -self.atom_charges, erfc(self.alpha * r) / r
+            "k,jk->j", -self.atom_charges, self.real_space_sum(ei_distances)
         )
 
         # Real space electron-electron part
         ee_distances = configs.dist.dist_i(configs.configs, epos.configs)
-        rvec = ee_distances[:, :, np.newaxis, :] + self.lattice_displacements
-        r = np.linalg.norm(rvec, axis=-1)
-        Vtest[:, :-1] += np.sum(erfc(self.alpha * r) / r, axis=-1)
+        Vtest[:, :-1] += self.real_space_sum(ee_distances)
+
+        if self.reciprocal == "pme":
+            # The pair terms are interpolated as a function of the displacement
+            Vtest[:, :-1] += self._pme_gather(self._pme_pair, ee_distances)
+            ion_potential = -self._pme_gather(self._pme_ion_potential, epos.configs)
+            Vtest[:, -1] += 2 * (ion_potential + 0.5 * self.gweight.sum())
+            return Vtest
 
         # Reciprocal space electron-electron part
-        e_expGdotR = np.exp(1j * np.dot(configs.configs, self.gpoints.T))
+        e_expGdotR, rho = self.structure_factor(configs)
         test_exp = np.exp(1j * np.dot(epos.configs, self.gpoints.T))
-        ee_recip_separated = np.dot(np.real(test_exp.conj() * e_expGdotR), self.gweight)
+        ee_recip_separated = np.dot(
+            np.real(test_exp[:, np.newaxis].conj() * e_expGdotR), self.gweight
+        )
         Vtest[:, :-1] += 2 * ee_recip_separated
 
         # Reciprocal space electrin-ion part
@@ -382,3 +632,198 @@ class Ewald:
         Vtest[:, -1] += 2 * ei_recip_separated
 
         return Vtest
+
+
+def tune_ewald(
+    cell, accuracy, nconf=1, cost_ratio=1.0, alphas=None, max_bytes=2 ** 30
+):
+    r"""
+    Choose the Ewald parameters that minimize the modeled cost of Ewald.ewald_electron() for a given accuracy.
+
+    The truncation errors of the energy are estimated as in Kolafa and Perram, Mol. Sim. 9, 351 (1992):
+
+    .. math:: \delta E_{\rm real} \approx Q \sqrt{\frac{r_c}{2V}} \frac{e^{-\alpha^2 r_c^2}}{(\alpha r_c)^2}
+              \qquad
+              \delta E_{\rm reciprocal} \approx Q \frac{\alpha}{\pi^2} K^{-3/2} e^{-\frac{G_c^2}{4\alpha^2}}
+
+    where :math:`Q = N_e + \sum_I Z_I^2` and :math:`K = G_c V^{1/3} / 2\pi`. For each alpha, the cutoffs :math:`r_c` and :math:`G_c` are chosen so that each error is accuracy/:math:`\sqrt{2}`. The real-space sum then includes the lattice displacements shorter than :math:`r_c` plus half the longest diagonal of the cell, and its cost is modeled as nconf times the number of particle pairs times the number of displacements; the reciprocal-space cost as nconf times cost_ratio times :math:`N_e` times the number of G vectors. The electron structure factors kept by Ewald.structure_factor() take :math:`16 \, n_{\rm conf} N_e N_G` bytes, so for many walkers or electrons the alphas whose G vectors would not fit in max_bytes are left out, which moves the choice towards smaller alphas and more real-space work. If none fit, the alpha with the fewest G vectors is used.
+
+    Inputs:
+        cell: pyscf Cell object (simulation cell)
+        accuracy: float, absolute error of the energy
+        nconf: int, number of walkers per evaluation
+        cost_ratio: float, cost of a reciprocal-space term (a complex exponential) relative to a real-space term (a distance and an erfc)
+        alphas: array of alphas to consider; defaults to a logarithmic grid around 5 over the smallest height of the cell
+        max_bytes: int, memory available for the electron structure factors
+    Returns:
+        dictionary with alpha, rcut, gcut, rmax (the length of the longest lattice displacement), the modeled number of lattice displacements (nimages) and G vectors (ngvectors), the estimated real_error, reciprocal_error and total error, the modeled cost, and the memory of the structure factors in bytes
+    """
+    latvec = cell.lattice_vectors()
+    cellvolume = abs(np.linalg.det(latvec))
+    nelec = np.sum(cell.nelec)
+    charges = cell.atom_charges()
+    charge2 = nelec + np.sum(charges ** 2)
+    npairs = nelec * (nelec - 1) / 2 + nelec * len(charges)
+    corners = np.stack(np.meshgrid(*[[-0.5, 0.5]] * 3, indexing="ij"), axis=-1)
+    dmax = np.amax(np.linalg.norm(np.dot(corners.reshape((-1, 3)), latvec), axis=1))
+    if alphas is None:
+        alphas = np.geomspace(0.25, 25, 81) / _smallest_height(latvec)
+    target = accuracy / np.sqrt(2)
+
+    candidates = []
+    for alpha in alphas:
+        real = lambda r: _real_space_error(alpha, r, charge2, cellvolume)
+        reciprocal = lambda g: _reciprocal_error(alpha, g, charge2, cellvolume)
+        rcut = _decreasing_cutoff(real, target, 1 / alpha)
+        gcut = _decreasing_cutoff(reciprocal, target, alpha)
+        nimages = max(1.0, 4 * np.pi / 3 * (rcut + dmax) ** 3 / cellvolume)
+        ngvectors = 4 * np.pi / 3 * gcut ** 3 / 2 * cellvolume / (2 * np.pi) ** 3
+        real_error, reciprocal_error = real(rcut), reciprocal(gcut)
+        candidates.append(
+            {
+                "alpha": alpha,
+                "rcut": rcut,
+                "gcut": gcut,
+                "rmax": rcut + dmax,
+                "nimages": nimages,
+                "ngvectors": ngvectors,
+                "real_error": real_error,
+                "reciprocal_error": reciprocal_error,
+                "error": np.sqrt(real_error ** 2 + reciprocal_error ** 2),
+                "cost": nconf * (npairs * nimages + cost_ratio * nelec * ngvectors),
+                "memory": 16 * nconf * nelec * ngvectors,
+            }
+        )
+    fits = [c for c in candidates if c["memory"] <= max_bytes]
+    if len(fits) == 0:
+        return min(candidates, key=lambda c: c["memory"])
+    return min(fits, key=lambda c: c["cost"])
+
+
+def _real_space_error(alpha, rcut, charge2, cellvolume):
+    return (
+        charge2
+        * np.sqrt(rcut / (2 * cellvolume))
+        * np.exp(-((alpha * rcut) ** 2))
+        / (alpha * rcut) ** 2
+    )
+
+
+def _reciprocal_error(alpha, gcut, charge2, cellvolume):
+    K = gcut * cellvolume ** (1 / 3) / (2 * np.pi)
+    return charge2 * alpha / np.pi ** 2 * K ** -1.5 * np.exp(-((gcut / alpha) ** 2) / 4)
+
+
+def _smallest_height(latvec):
+    """ The smallest distance between opposite faces of the cell """
+    cellvolume = np.linalg.det(latvec)
+    crossproduct = np.linalg.inv(latvec).T * cellvolume
+    tmpheight_i = np.einsum("ij,ij->i", crossproduct, latvec)
+    length_i = np.linalg.norm(crossproduct, axis=1)
+    return np.amin(np.abs(tmpheight_i) / length_i)
+
+
+def _bspline(x, order):
+    """ The cardinal B-spline of the given order, nonzero for 0 < x < order """
+    value = np.zeros(np.shape(x))
+    for k in range(order + 1):
+        value += (-1) ** k * comb(order, k) * np.maximum(x - k, 0) ** (order - 1)
+    return value / factorial(order - 1)
+
+
+def _bspline_moduli(K, order):
+    """
+    Returns b(m) of the particle-mesh interpolation for the integer frequencies of np.fft.fftfreq(K, 1 / K); it is zero where the interpolation fails.
+    """
+    m = np.fft.fftfreq(K, 1.0 / K)
+    k = np.arange(order - 1)
+    denominator = np.dot(
+        np.exp(2j * np.pi * np.outer(m, k) / K), _bspline(k + 1.0, order)
+    )
+    b = np.zeros(K, dtype=complex)
+    good = np.abs(denominator) > 1e-8
+    b[good] = np.exp(2j * np.pi * (order - 1) * m[good] / K) / denominator[good]
+    return b
+
+
+def _fft_size(n):
+    """ The smallest integer at least n with no prime factors other than 2, 3, and 5 """
+    n = int(n)
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+
+def _decreasing_cutoff(func, tolerance, start):
+    """
+    Returns the x > 0 at which the decreasing function func falls to tolerance, by bisection.
+    """
+    low, high = 0.0, start
+    while func(high) > tolerance:
+        low, high = high, 2 * high
+    for i in range(100):
+        mid = (low + high) / 2
+        if func(mid) > tolerance:
+            low = mid
+        else:
+            high = mid
+    return high
+
+
+def _positive_half_sphere(gbasis, gcut, nmax):
+    """
+    Returns the integer vectors n, with |n_i| <= nmax, such that |n gbasis| <= gcut, keeping 
+    one of n and -n and leaving out 0, as an (nG, 3) array in lexicographic order.
+    The range of each index follows from the previous ones through the Schur complements 
+    of the metric, so only the points inside the sphere are generated.
+    """
+    metric = np.dot(gbasis, gbasis.T)
+    schur2 = metric[:2, :2] - np.outer(metric[:2, 2], metric[:2, 2]) / metric[2, 2]
+    schur1 = schur2[0, 0] - schur2[0, 1] ** 2 / schur2[1, 1]
+    gcut2 = gcut ** 2
+
+    # "Positive" means n_x > 0, or n_x = 0 and n_y > 0, or n_x = n_y = 0 and n_z > 0
+    nx = np.arange(min(int(np.floor(np.sqrt(gcut2 / schur1))), nmax) + 1)
+    low, high = _quadratic_range(
+        schur2[1, 1], schur2[0, 1] * nx, schur2[0, 0] * nx ** 2 - gcut2, nmax
+    )
+    low[nx == 0] = np.maximum(low[nx == 0], 0)
+    owner, ny = _expand_ranges(low, high)
+    nx = nx[owner]
+
+    b = metric[0, 2] * nx + metric[1, 2] * ny
+    c = metric[0, 0] * nx ** 2 + 2 * metric[0, 1] * nx * ny + metric[1, 1] * ny ** 2
+    low, high = _quadratic_range(metric[2, 2], b, c - gcut2, nmax)
+    origin = (nx == 0) & (ny == 0)
+    low[origin] = np.maximum(low[origin], 1)
+    owner, nz = _expand_ranges(low, high)
+    return np.stack([nx[owner], ny[owner], nz], axis=-1)
+
+
+def _quadratic_range(a, b, c, nmax):
+    """
+    Returns the bounds low, high of the integers n with a n^2 + 2 b n + c <= 0 and |n| <= nmax, 
+    for a > 0 and arrays b and c. Empty ranges have high < low.
+    """
+    discriminant = b ** 2 - a * c
+    root = np.sqrt(np.maximum(discriminant, 0))
+    low = np.maximum(np.ceil((-b - root) / a), -nmax).astype(int)
+    high = np.minimum(np.floor((-b + root) / a), nmax).astype(int)
+    high[discriminant < 0] = low[discriminant < 0] - 1
+    return low, high
+
+
+def _expand_ranges(low, high):
+    """
+    Returns the index of the range each value comes from, and the values, of the 
+    concatenated integer ranges [low, high].
+    """
+    counts = np.maximum(high - low + 1, 0)
+    owner = np.repeat(np.arange(len(low)), counts)
+    offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, low[owner] + offsets
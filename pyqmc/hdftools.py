@@ -22,6 +22,226 @@ def append_hdf(f, data):
         f[k].resize((currshape[0]+1,*currshape[1:]))
         f[k][-1,] = it
 
+class HDFWriter:
+    """
+    Keeps an HDF5 file open for a whole run, buffers rows of data in memory and 
+    appends them in chunks. Datasets are created chunked along the row axis, 
+    optionally compressed.
+
+    Checkpoint arrays (configurations, weights, wave function parameters) are 
+    overwritten in place rather than appended, and are only written every 
+    checkpoint_every rows and when the writer is closed.
+
+    If hdf_file is None, nothing is written.
+
+    A row may leave out keys, or give a scalar NaN for them, for quantities that were 
+    not evaluated at that step (see the intervals option of vmc() and rundmc()). 
+    Those entries are stored as NaN, so that every dataset keeps one row per step.
+
+    If the number of rows is known in advance (expected_rows), the datasets are 
+    preallocated to that length and grown geometrically if it is exceeded, so that 
+    long runs do not resize them at every flush. They are trimmed to the rows written 
+    when the writer is closed. The "nrows" attribute always holds the number of rows 
+    written, so that a run that stopped before closing its writer can be continued 
+    after its last row rather than after the preallocated length.
+
+      with HDFWriter(hdf_file, attr) as writer:
+          for step in range(nsteps):
+              ...
+              writer.append(data, {"configs": configs.configs})
+    """
+
+    def __init__(
+        self,
+        hdf_file,
+        attr=None,
+        buffer_size=10,
+        checkpoint_every=None,
+        compression=None,
+        expected_rows=None,
+    ):
+        """
+        hdf_file: file name, or None to do nothing.
+        attr: a dictionary that goes into attributes when the datasets are created.
+        buffer_size: number of rows to keep in memory before they are appended to the file.
+        checkpoint_every: number of rows between checkpoints. Defaults to buffer_size.
+        compression: passed to h5py's create_dataset, for example "gzip".
+        expected_rows: number of rows this writer will append, used to preallocate the datasets.
+        """
+        self.attr = {} if attr is None else attr
+        self.buffer_size = buffer_size
+        self.checkpoint_every = (
+            buffer_size if checkpoint_every is None else checkpoint_every
+        )
+        self.compression = compression
+        self.expected_rows = expected_rows
+        self._nrows = None
+        self._capacity = 0
+        self._rows = []
+        self._checkpoint = {}
+        self._since_checkpoint = 0
+        self._datasets = set()
+        self._hdf = None if hdf_file is None else h5py.File(hdf_file, "a")
+
+    def append(self, data, checkpoint=None):
+        """
+        data: a dictionary of numpy arrays, one row of each dataset.
+        checkpoint: a dictionary of arrays (keys are dataset paths such as "configs" or "wf/acoeff")
+        that replace the previous checkpoint. They are copied, so they may be modified afterwards.
+        """
+        if self._hdf is None:
+            return
+        self._rows.append(data)
+        if checkpoint is not None:
+            self._checkpoint = {k: np.array(it) for k, it in checkpoint.items()}
+        self._since_checkpoint += 1
+        if self._since_checkpoint >= self.checkpoint_every:
+            self.flush(checkpoint=True)
+        elif len(self._rows) >= self.buffer_size:
+            self.flush()
+
+    def extend(self, rows, checkpoint=None):
+        """
+        Append several rows at once, such as the steps between two DMC branches.
+        rows: a list of dictionaries, as for append().
+        checkpoint: as for append(), the state after the last row, or a function that 
+        returns it. It is only copied, or called, if a checkpoint falls due during these 
+        rows, so it can be passed every time.
+        """
+        if self._hdf is None:
+            return
+        self._rows.extend(rows)
+        self._since_checkpoint += len(rows)
+        if self._since_checkpoint >= self.checkpoint_every:
+            if callable(checkpoint):
+                checkpoint = checkpoint()
+            if checkpoint is not None:
+                self._checkpoint = {k: np.array(it) for k, it in checkpoint.items()}
+            self.flush(checkpoint=True)
+        elif len(self._rows) >= self.buffer_size:
+            self.flush()
+
+    @property
+    def checkpoint_due(self):
+        """ True if the next append() writes the checkpoint, so that callers can skip 
+        building one otherwise. """
+        if self._hdf is None:
+            return False
+        return self._since_checkpoint + 1 >= self.checkpoint_every
+
+    def flush(self, checkpoint=False):
+        """ Append buffered rows to the file, and write the checkpoint if checkpoint is True. """
+        if self._hdf is None:
+            return
+        if len(self._rows) > 0:
+            keys = []
+            for row in self._rows:
+                keys.extend(k for k in row.keys() if k not in keys)
+            self._datasets.update(k for k in keys if k in self._hdf)
+            if self._nrows is None:
+                # Rows already in the file, when continuing a run
+                if "nrows" in self._hdf.attrs:
+                    self._nrows = int(self._hdf.attrs["nrows"])
+                else:
+                    self._nrows = max(
+                        [self._hdf[k].shape[0] for k in self._datasets], default=0
+                    )
+                if self.expected_rows is not None:
+                    self._capacity = self._nrows + self.expected_rows
+            nrows, end = self._nrows, self._nrows + len(self._rows)
+            if end > self._capacity:
+                grown = int(1.5 * self._capacity) if self.expected_rows is not None else 0
+                self._capacity = max(end, grown)
+            for row in self._rows:
+                new = {
+                    k: it
+                    for k, it in row.items()
+                    if k not in self._hdf and not _missing(it)
+                }
+                if len(new) > 0:
+                    self._setup(new, nrows)
+                    self._datasets.update(new.keys())
+            for k in self._datasets:
+                dset = self._hdf[k]
+                fill = _missing_value(dset)
+                rows = np.asarray(
+                    [
+                        fill if _missing(row.get(k)) else np.asarray(row[k])
+                        for row in self._rows
+                    ]
+                )
+                if dset.shape[0] < self._capacity:
+                    dset.resize((self._capacity, *dset.shape[1:]))
+                dset[nrows:end] = rows
+            self._nrows = end
+            self._hdf.attrs["nrows"] = end
+            self._rows = []
+        if checkpoint:
+            for k, it in self._checkpoint.items():
+                if k in self._hdf and self._hdf[k].shape != it.shape:
+                    del self._hdf[k]
+                if k not in self._hdf:
+                    self._hdf.create_dataset(k, data=it)
+                else:
+                    self._hdf[k][...] = it
+            self._since_checkpoint = 0
+        self._hdf.flush()
+
+    def close(self, checkpoint=None):
+        """ Write any buffered rows and the last checkpoint, then close the file. 
+        checkpoint: if given, replaces the last checkpoint, as in append(). """
+        if self._hdf is None:
+            return
+        if checkpoint is not None:
+            self._checkpoint = {k: np.array(it) for k, it in checkpoint.items()}
+        self.flush(checkpoint=True)
+        if self._nrows is not None:
+            for k in self._datasets:
+                dset = self._hdf[k]
+                if dset.shape[0] > self._nrows:
+                    dset.resize((self._nrows, *dset.shape[1:]))
+        self._hdf.close()
+        self._hdf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _setup(self, data, nrows=0):
+        """ Like setup_hdf(), but with chunked datasets of the data's own dtype,
+        allocated to the current capacity. The first nrows rows are filled as missing. """
+        for k, it in data.items():
+            if k in self._hdf.keys():
+                continue
+            itnp = np.asarray(it)
+            chunks = (self.buffer_size, *itnp.shape) if all(itnp.shape) else True
+            dset = self._hdf.create_dataset(
+                k,
+                (max(nrows, self._capacity), *itnp.shape),
+                maxshape=(None, *itnp.shape),
+                dtype=itnp.dtype,
+                chunks=chunks,
+                compression=self.compression,
+            )
+            if nrows > 0:
+                dset[:nrows] = np.broadcast_to(_missing_value(dset), (nrows, *itnp.shape))
+        for k, it in self.attr.items():
+            self._hdf.attrs[k] = it
+
+
+def _missing(it):
+    """ True if a row entry stands for a quantity that was not evaluated """
+    return it is None or (np.ndim(it) == 0 and np.isnan(it))
+
+
+def _missing_value(dset):
+    """ Array that marks a missing row of dset: NaN, or 0 for integer datasets """
+    fill = np.nan if np.issubdtype(dset.dtype, np.inexact) else 0
+    return np.full(dset.shape[1:], fill, dtype=dset.dtype)
+
+
 if __name__=="__main__":
     import numpy as np
     f = h5py.File("testfile.hdf5","a")
@@ -1,6 +1,7 @@
 import numpy as np
 from pyqmc.func3d import GaussianFunction
 from pyqmc.distance import RawDistance
+from pyqmc.coord import WalkerPool
 
 
 class JastrowSpin:
@@ -38,6 +39,7 @@ class JastrowSpin:
             self.a_basis = a_basis
 
         self.parameters = {}
+        self._pool = WalkerPool()
         self._nelec = np.sum(mol.nelec)
         self._mol = mol
         self.parameters["bcoeff"] = np.zeros((nexpand, 3))
@@ -223,6 +225,41 @@ class JastrowSpin:
             self._b_partial[e, mask, l, 0] = bval[:, :sep].sum(axis=1)
             self._b_partial[e, mask, l, 1] = bval[:, sep:].sum(axis=1)
 
+    def resample(self, newinds):
+        """Reorder the walkers by newinds (for example after DMC branching), so that the 
+        a and b sums match configs.resample(newinds) without a recompute()."""
+        self._configscurrent.resample(newinds)
+        self._avalues = self._pool.take("avalues", self._avalues, newinds)
+        self._bvalues = self._pool.take("bvalues", self._bvalues, newinds)
+        self._a_partial = self._pool.take("a_partial", self._a_partial, newinds, axis=1)
+        self._b_partial = self._pool.take("b_partial", self._b_partial, newinds, axis=1)
+
+    def save_state(self):
+        """The walker-indexed internal state, for restore_state(). The arrays are not 
+        copied: recompute() replaces them rather than writing into them, so the state 
+        stays valid across recompute(), but not across updateinternals() or resample()."""
+        return (
+            self._configscurrent,
+            self._avalues,
+            self._bvalues,
+            self._a_partial,
+            self._b_partial,
+        )
+
+    def restore_state(self, state, mask, rows=None):
+        """Set the internal state of the walkers in mask back to state, as returned by 
+        save_state(). rows selects the walkers of state to use, and defaults to mask 
+        for a state of the same walkers."""
+        rows = mask if rows is None else rows
+        configs, avalues, bvalues, a_partial, b_partial = state
+        self._configscurrent.configs[mask] = configs.configs[rows]
+        if hasattr(configs, "wrap"):
+            self._configscurrent.wrap[mask] = configs.wrap[rows]
+        self._avalues[mask] = avalues[rows]
+        self._bvalues[mask] = bvalues[rows]
+        self._a_partial[:, mask] = a_partial[:, rows]
+        self._b_partial[:, mask] = b_partial[:, rows]
+
     def value(self):
         """Compute the current log value of the wavefunction"""
         u = np.sum(self._bvalues * self.parameters["bcoeff"], axis=(2, 1))
@@ -262,6 +299,38 @@ class JastrowSpin:
 
         return grad
 
+    def gradient_current(self, e, epos):
+        """Gradient for electron e at its current position epos. The e-e terms depend on
+        every other electron, so nothing is cached and this is the same as gradient()."""
+        return self.gradient(e, epos)
+
+    def gradient_all(self, configs):
+        """Gradient for every electron at its current position, as a (3, nconf, nelec) array.
+        The e-e terms are evaluated for all pairs at once, with the coefficient of each pair 
+        chosen by the spins of its two electrons as in gradient()."""
+        nconf, nelec = configs.configs.shape[:2]
+        nup = self._mol.nelec[0]
+        spin = (np.arange(nelec) >= nup).astype(int)
+
+        # d[i, :, j] is the displacement of electron i from electron j
+        d = configs.dist.dist_i(configs.configs, configs.configs)
+        r = np.linalg.norm(d, axis=-1)
+        offdiag = ~np.eye(nelec, dtype=bool)[:, np.newaxis, :]
+        r[~np.broadcast_to(offdiag, r.shape)] = 1.0
+        di = configs.dist.dist_i(self._mol.atom_coords(), configs.configs)
+        ri = np.linalg.norm(di, axis=-1)
+
+        grad = np.zeros((3, nconf, nelec))
+        for c, b in zip(self.parameters["bcoeff"], self.b_basis):
+            cpair = c[spin[:, np.newaxis] + spin[np.newaxis, :]][:, np.newaxis, :]
+            bgrad = b.gradient(d, r) * (cpair * offdiag)[..., np.newaxis]
+            grad += np.sum(bgrad, axis=2).transpose((2, 1, 0))
+
+        for c, a in zip(self.parameters["acoeff"].transpose((1, 2, 0)), self.a_basis):
+            grad += np.einsum("ej,eijk->kie", c[spin], a.gradient(di, ri))
+
+        return grad
+
     def gradient_laplacian(self, e, epos):
         """ """
         nconf, nelec = self._configscurrent.configs.shape[:2]
@@ -323,6 +392,53 @@ class JastrowSpin:
             val = val.T
         return val
 
+    def testvalue_gradient(self, e, epos, mask=None):
+        r"""
+        Compute the ratio $\Psi_{\rm new}/\Psi_{\rm old}$ for moving electron e to epos, and the gradient of $\ln \Psi$ at epos.
+        The e-e and e-ion distances are computed once and shared between the value and gradient of each basis function.
+        """
+        if mask is None:
+            mask = [True] * epos.configs.shape[0]
+        nup = self._mol.nelec[0]
+        eup = int(e < nup)
+        edown = int(e >= nup)
+
+        # Get e-e and e-ion distances
+        not_e = np.arange(self._nelec) != e
+        dnew = epos.dist.dist_i(
+            self._configscurrent.configs[mask][:, not_e], epos.configs[mask]
+        )
+        dinew = epos.dist.dist_i(self._mol.atom_coords(), epos.configs[mask])
+        rnew = np.linalg.norm(dnew, axis=-1)
+        rinew = np.linalg.norm(dinew, axis=-1)
+
+        nconf = rnew.shape[0]
+        grad = np.zeros((3, nconf))
+        a_val = -np.einsum(
+            "ijk,jk->i",
+            self._a_partial[e, mask],
+            self.parameters["acoeff"][..., edown],
+        )
+        b_val = -np.einsum(
+            "ijk,jk->i",
+            self._b_partial[e, mask],
+            self.parameters["bcoeff"][:, edown : edown + 2],
+        )
+
+        for c, a in zip(self.parameters["acoeff"].transpose()[edown], self.a_basis):
+            a_val += np.dot(a.value(dinew, rinew), c)
+            grad += np.einsum("j,ijk->ki", c, a.gradient(dinew, rinew))
+
+        for c, b in zip(self.parameters["bcoeff"], self.b_basis):
+            bval = b.value(dnew, rnew)
+            bgrad = b.gradient(dnew, rnew)
+            b_val += c[edown] * np.sum(bval[:, : nup - eup], axis=1)
+            b_val += c[1 + edown] * np.sum(bval[:, nup - eup :], axis=1)
+            grad += c[edown] * np.sum(bgrad[:, : nup - eup], axis=1).T
+            grad += c[1 + edown] * np.sum(bgrad[:, nup - eup :], axis=1).T
+
+        return np.exp(b_val + a_val), grad
+
     def testvalue_many(self, e, epos, mask=None):
         r"""
         Compute the ratio $\Psi_{\rm new}/\Psi_{\rm old}$ for moving electron e to epos.
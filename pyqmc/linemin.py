@@ -2,6 +2,15 @@ import numpy as np
 import pandas as pd
 import scipy
 import h5py
+import pyqmc.hdftools as hdftools
+
+
+def opt_checkpoint(configs, parameters):
+    """ The arrays needed to restart an optimization, for hdftools.HDFWriter.append() """
+    checkpoint = {"configs": configs.configs}
+    for k, it in parameters.items():
+        checkpoint["wf/" + k] = it
+    return checkpoint
 
 
 def sr_update(pgrad, Sij, step, eps=0.1):
@@ -20,23 +29,6 @@ def sr12_update(pgrad, Sij, step, eps=0.1):
     return -v * step  # / np.linalg.norm(v)
 
 
-def opt_hdf(hdf_file, data, attr, configs, parameters):
-    import pyqmc.hdftools as hdftools
-
-    if hdf_file is not None:
-        with h5py.File(hdf_file, "a") as hdf:
-            if "configs" not in hdf.keys():
-                hdftools.setup_hdf(hdf, data, attr)
-                hdf.create_dataset("configs", configs.configs.shape)
-                hdf.create_group("wf")
-                for k, it in parameters.items():
-                    hdf.create_dataset("wf/" + k, data=it)
-            hdftools.append_hdf(hdf, data)
-            hdf["configs"][:, :, :] = configs.configs
-            for k, it in parameters.items():
-                hdf["wf/" + k][...] = it.copy()
-
-
 def polyfit_relative(xfit, yfit, degree):
     p = np.polyfit(xfit, yfit,degree)
     ypred = np.polyval(p, xfit)
@@ -168,6 +160,7 @@ def line_minimization(
 
     # Attributes for linemin
     attr = dict(maxiters=maxiters, npts=npts, steprange=steprange)
+    writer = hdftools.HDFWriter(hdf_file, attr, buffer_size=1)
 
     def gradient_energy_function(x, coords):
         newparms = pgrad_acc.transform.deserialize(x)
@@ -186,55 +179,62 @@ def line_minimization(
 
     x0 = pgrad_acc.transform.serialize_parameters(wf.parameters)
 
-    # VMC warm up period
-    if verbose:
-        print("starting warmup")
-    data, coords = vmc(wf, coords, accumulators={}, **vmcoptions)
-    df = []
-    # Gradient descent cycles
-    for it in range(maxiters):
-        # Calculate gradient accurately
-        coords, last_en, pgrad, Sij, en, en_err = gradient_energy_function(x0, coords)
-        step_data = {}
-        step_data["energy"] = en
-        step_data["energy_error"] = en_err
-        step_data["x"] = x0
-        step_data["pgradient"] = pgrad
-        step_data["iteration"] = it
-
+    try:
+        # VMC warm up period
         if verbose:
-            print("descent en", en, en_err)
-            print("descent |grad|", np.linalg.norm(pgrad), flush=True)
-
-        xfit = []
-        yfit = []
-
-        # Calculate samples to fit.
-        # include near zero in the fit, and go backwards as well
-        # We don't use the above computed value because we are
-        # doing correlated sampling.
-        steps = np.linspace(-steprange / npts, steprange, npts)
-        params = [x0 + update(pgrad, Sij, step, **update_kws) for step in steps]
-        stepsdata = lm(wf, coords, params, pgrad_acc, **lmoptions)
-        for data, p, step in zip(stepsdata, params, steps):
-            en = np.mean(data["total"] * data["weight"]) / np.mean(data["weight"])
-            yfit.append(en)
+            print("starting warmup")
+        data, coords = vmc(wf, coords, accumulators={}, **vmcoptions)
+        df = []
+        # Gradient descent cycles
+        for it in range(maxiters):
+            # Calculate gradient accurately
+            coords, last_en, pgrad, Sij, en, en_err = gradient_energy_function(
+                x0, coords
+            )
+            step_data = {}
+            step_data["energy"] = en
+            step_data["energy_error"] = en_err
+            step_data["x"] = x0
+            step_data["pgradient"] = pgrad
+            step_data["iteration"] = it
+
             if verbose:
-                print(
-                    "descent step {:<15.10} {:<15.10} weight stddev {:<15.10}".format(
-                        step, en, np.std(data["weight"])
-                    ),
-                    flush=True,
-                )
-
-        xfit.extend(steps)
-        est_min = stable_fit(xfit, yfit)
-        x0 += update(pgrad, Sij, est_min, **update_kws)
-        step_data["tau"] = xfit
-        step_data["yfit"] = yfit
-
-        opt_hdf(hdf_file, step_data, attr, coords, pgrad_acc.transform.deserialize(x0))
-        df.append(step_data)
+                print("descent en", en, en_err)
+                print("descent |grad|", np.linalg.norm(pgrad), flush=True)
+
+            xfit = []
+            yfit = []
+
+            # Calculate samples to fit.
+            # include near zero in the fit, and go backwards as well
+            # We don't use the above computed value because we are
+            # doing correlated sampling.
+            steps = np.linspace(-steprange / npts, steprange, npts)
+            params = [x0 + update(pgrad, Sij, step, **update_kws) for step in steps]
+            stepsdata = lm(wf, coords, params, pgrad_acc, **lmoptions)
+            for data, p, step in zip(stepsdata, params, steps):
+                en = np.mean(data["total"] * data["weight"]) / np.mean(data["weight"])
+                yfit.append(en)
+                if verbose:
+                    print(
+                        "descent step {:<15.10} {:<15.10} weight stddev {:<15.10}".format(
+                            step, en, np.std(data["weight"])
+                        ),
+                        flush=True,
+                    )
+
+            xfit.extend(steps)
+            est_min = stable_fit(xfit, yfit)
+            x0 += update(pgrad, Sij, est_min, **update_kws)
+            step_data["tau"] = xfit
+            step_data["yfit"] = yfit
+
+            writer.append(
+                step_data, opt_checkpoint(coords, pgrad_acc.transform.deserialize(x0))
+            )
+            df.append(step_data)
+    finally:
+        writer.close()
 
     newparms = pgrad_acc.transform.deserialize(x0)
     for k in newparms:
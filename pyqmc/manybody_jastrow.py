@@ -2,6 +2,7 @@ from pyscf.gto import eval_gto
 from pyscf import gto
 import numpy as np
 import pyqmc
+from pyqmc.coord import WalkerPool
 
 class J3:
     def __init__(self, mol):
@@ -9,6 +10,7 @@ class J3:
         randpos = np.random.random((1,3))
         dim = mol.eval_gto('GTOval_cart', randpos).shape[-1]
         self.parameters={}
+        self._pool = WalkerPool()
         self.parameters["gcoeff"] = np.zeros((dim, dim))
         # self.parameters["gcoeff"] = np.ones((dim, dim)) # for debugging purpose
     
@@ -32,6 +34,31 @@ class J3:
         self.ao_lap[:, mask, e, :] = e_lap[:, mask, 0, :]
         self._configscurrent.configs[:, e, :] = epos.configs
 
+    def resample(self, newinds):
+        self._configscurrent.resample(newinds)
+        self.ao_val = self._pool.take("ao_val", self.ao_val, newinds)
+        self.ao_grad = self._pool.take("ao_grad", self.ao_grad, newinds, axis=1)
+        self.ao_lap = self._pool.take("ao_lap", self.ao_lap, newinds, axis=1)
+
+    def save_state(self):
+        """The walker-indexed internal state, for restore_state(). The arrays are not 
+        copied: recompute() replaces them rather than writing into them, so the state 
+        stays valid across recompute(), but not across updateinternals() or resample()."""
+        return (self._configscurrent, self.ao_val, self.ao_grad, self.ao_lap)
+
+    def restore_state(self, state, mask, rows=None):
+        """Set the internal state of the walkers in mask back to state, as returned by 
+        save_state(). rows selects the walkers of state to use, and defaults to mask 
+        for a state of the same walkers."""
+        rows = mask if rows is None else rows
+        configs, ao_val, ao_grad, ao_lap = state
+        self._configscurrent.configs[mask] = configs.configs[rows]
+        if hasattr(configs, "wrap"):
+            self._configscurrent.wrap[mask] = configs.wrap[rows]
+        self.ao_val[mask] = ao_val[rows]
+        self.ao_grad[:, mask] = ao_grad[:, rows]
+        self.ao_lap[:, mask] = ao_lap[:, rows]
+
     def value(self):
         mask = np.tril(np.ones((self.nelec, self.nelec)), -1)
         vals = np.einsum('mn,cim, cjn, ij-> c', self.parameters["gcoeff"], self.ao_val, self.ao_val, mask)
@@ -44,6 +71,30 @@ class J3:
         grad2 = np.einsum('mn, cim, dcn -> dc', self.parameters["gcoeff"], self.ao_val[:,e+1:,:], e_grad[:,:,0,:])
         return grad1 + grad2
 
+    def gradient_current(self, e, epos):
+        """
+        Gradient at the current position of electron e, from the stored ao_grad
+        """
+        e_grad = self.ao_grad[:,:,e,:]
+        grad1 = np.einsum('mn, dcm, cjn -> dc', self.parameters["gcoeff"], e_grad, self.ao_val[:,:e,:])
+        grad2 = np.einsum('mn, cim, dcn -> dc', self.parameters["gcoeff"], self.ao_val[:,e+1:,:], e_grad)
+        return grad1 + grad2
+
+    def testvalue_gradient(self, e, epos, mask=None):
+        """
+        Return psi(epos)/psi and grad(psi(epos))/psi(epos) from one AO evaluation
+        """
+        if mask is None:
+            mask = [True] * epos.configs.shape[0]
+        e_val, e_grad = self._get_val_grad_lap(epos.mask(mask), mode = 'grad')
+        ao_val = self.ao_val[mask]
+        delta = e_val[:,0,:] - ao_val[:,e,:]
+        val1 = np.einsum('mn, cm, cjn -> c', self.parameters["gcoeff"], delta, ao_val[:,:e,:])
+        val2 = np.einsum('mn, cim, cn -> c', self.parameters["gcoeff"], ao_val[:,e+1:,:], delta)
+        grad1 = np.einsum('mn, dcm, cjn -> dc', self.parameters["gcoeff"], e_grad[:,:,0,:], ao_val[:,:e,:])
+        grad2 = np.einsum('mn, cim, dcn -> dc', self.parameters["gcoeff"], ao_val[:,e+1:,:], e_grad[:,:,0,:])
+        return np.exp(val1 + val2), grad1 + grad2
+
     def laplacian(self, e,epos):
         """
         Return lap(psi)/ psi = lap(J) when psi = exp(J)
@@ -7,6 +7,11 @@ os.environ["NUMEXPR_NUM_THREADS"] = "1"
 os.environ["OMP_NUM_THREADS"] = "1"
 import numpy as np
 import h5py
+from pyqmc.timing import null_timer
+import pyqmc.hdftools as hdftools
+from pyqmc.reblock import TargetError, OnlineBlocking
+from pyqmc.accumulators import ChunkedAccumulator
+import pyqmc.memory as memory
 
 
 def initial_guess(mol, nconfig, r=1.0):
@@ -87,16 +92,89 @@ def limdrift(g, cutoff=1):
     return g
 
 
-def vmc_file(hdf_file, data, attr, configs):
-    import pyqmc.hdftools as hdftools
+def gradient_current(wf, e, epos):
+    """ wf.gradient_current(e, epos), or wf.gradient(e, epos) for wave functions that 
+    do not cache the gradient at the current positions """
+    if hasattr(wf, "gradient_current"):
+        return wf.gradient_current(e, epos)
+    return wf.gradient(e, epos)
 
-    if hdf_file is not None:
-        with h5py.File(hdf_file, "a") as hdf:
-            if "configs" not in hdf.keys():
-                hdftools.setup_hdf(hdf, data, attr)
-                hdf.create_dataset("configs", configs.configs.shape)
-            hdftools.append_hdf(hdf, data)
-            hdf["configs"][:, :, :] = configs.configs
+
+def testvalue_gradient(wf, e, epos):
+    """ wf.testvalue_gradient(e, epos), or separate calls to wf.testvalue() and 
+    wf.gradient() for wave functions without it """
+    if hasattr(wf, "testvalue_gradient"):
+        return wf.testvalue_gradient(e, epos)
+    return wf.testvalue(e, epos), wf.gradient(e, epos)
+
+
+def _drift_all(wf, configs, drift):
+    """ The drift displacement of every electron at its current position, (nconf, nelec, 3).
+    Wave functions with gradient_all() compute the gradients in one call; otherwise 
+    gradient_current() is called for each electron. """
+    nconf, nelec = configs.configs.shape[0:2]
+    if hasattr(wf, "gradient_all"):
+        grad = wf.gradient_all(configs)
+    else:
+        grad = np.stack(
+            [gradient_current(wf, e, configs.electron(e)) for e in range(nelec)], axis=-1
+        )
+    grad = np.real(grad).transpose((1, 2, 0)).reshape((nconf * nelec, 3))
+    return drift(grad).reshape((nconf, nelec, 3))
+
+
+def all_electron_move(wf, configs, tstep, drift, fixed_node=False, grad=None):
+    """Propose a drift-diffusion move of every electron at once, and accept or reject 
+    the whole configuration of each walker.
+
+    Args:
+      wf: A Wave function-like class. recompute(), value(), and gradient_current() (or gradient_all() or gradient()) are used, as well as save_state() and restore_state() if it has them. On return, wf is up to date with configs.
+
+      configs: Electron coordinates; updated in place.
+
+      tstep: Time step for the move proposal.
+
+      drift: A function that takes a (n, 3) gradient and returns the (n, 3) drift displacement.
+
+      fixed_node: If True, reject moves that change the sign of the wave function.
+
+      grad: The (nconf, nelec, 3) drift at the current positions, as returned by the previous call if neither wf nor configs changed since. Computed if None.
+
+    Returns:
+      accept: (nconf,) boolean array of which walkers moved.
+
+      grad: (nconf, nelec, 3) drift at the positions in configs on return.
+    """
+    nconf = configs.configs.shape[0]
+    oldphase, oldval = wf.value()
+    if grad is None:
+        grad = _drift_all(wf, configs, drift)
+    gauss = np.random.normal(scale=np.sqrt(tstep), size=configs.configs.shape)
+    newconfigs = configs.make_irreducible_all(configs.configs + gauss + grad)
+
+    saved = wf.save_state() if hasattr(wf, "save_state") else None
+    wf.recompute(newconfigs)
+    newphase, newval = wf.value()
+    new_grad = _drift_all(wf, newconfigs, drift)
+    forward = np.sum(gauss ** 2, axis=(1, 2))
+    backward = np.sum((gauss + grad + new_grad) ** 2, axis=(1, 2))
+    t_prob = np.exp(1 / (2 * tstep) * (forward - backward))
+
+    ratio = np.exp(2 * (newval - oldval)) * t_prob
+    if fixed_node:
+        ratio *= np.sign(np.real(newphase / oldphase))
+    accept = ratio > np.random.rand(nconf)
+
+    # wf is at newconfigs; put the state of the rejected walkers back
+    configs.move_all(newconfigs, accept)
+    reject = ~accept
+    if np.any(reject):
+        if saved is not None:
+            wf.restore_state(saved, reject)
+        else:
+            wf.recompute(configs)
+    grad = np.where(accept[:, np.newaxis, np.newaxis], new_grad, grad)
+    return accept, grad
 
 
 def vmc(
@@ -108,12 +186,23 @@ def vmc(
     verbose=False,
     stepoffset=0,
     hdf_file=None,
+    move="electron",
+    timer=None,
+    hdf_options=None,
+    statistics=None,
+    store_steps=True,
+    target_error=None,
+    target_key=("energy", "total"),
+    check_every=10,
+    max_bytes=None,
+    intervals=None,
 ):
     """Run a Monte Carlo sample of a given wave function.
 
     Args:
-      wf: A Wave function-like class. recompute(), gradient(), and updateinternals() are used, as well as 
-      anything (such as laplacian() ) used by accumulators
+      wf: A Wave function-like class. recompute(), gradient(), testvalue(), and updateinternals() are used, as well as 
+      anything (such as laplacian() ) used by accumulators. gradient_current() and testvalue_gradient() are used 
+      instead of gradient() and testvalue() if wf has them.
       
       configs: Initial electron coordinates
 
@@ -127,8 +216,28 @@ def vmc(
 
       stepoffset: If continuing a run, what to start the step numbering at.
 
+      move: "electron" moves one electron at a time. "all" moves every electron at once and accepts or rejects the whole configuration (see all_electron_move()); the acceptance is then the fraction of walkers that moved.
+
+      timer: A timing.PhaseTimer that accumulates the wall time and number of calls of each phase of the step (gradient, testvalue, updateinternals, each accumulator, and hdf). It is also written to the "timing" group of hdf_file.
+
+      hdf_options: A dictionary of options for the hdftools.HDFWriter that saves to hdf_file, such as buffer_size, checkpoint_every, and compression.
+
+      statistics: A reblock.OnlineBlocking object. Every step's averages are added to it, so that statistics.summary() gives reblocked means and error bars without storing the steps. One is created if not given.
+
+      store_steps: If False, the steps are not kept in memory: df is the reblocked summary of the steps (statistics.summary()), and per-step data is only kept in statistics and hdf_file.
+
+      target_error: If given, stop once the reblocked standard error of target_key reaches this value, and treat nsteps as the maximum number of steps. The equilibration period is detected automatically (see reblock.TargetError) and only later steps are added to statistics. Each step in df then has "equilibrated", which is True for the steps added to statistics, so that they can be reblocked for error bars even without statistics=.
+
+      target_key: tuple of strings naming the accumulator and quantity checked against target_error.
+
+      check_every: number of steps between checks of target_error.
+
+      max_bytes: If given, each accumulator is wrapped in an accumulators.ChunkedAccumulator, which evaluates it on chunks of walkers sized so that its temporary arrays fit in max_bytes, and the initial recompute() is done in chunks (memory.recompute_chunked()) so that its temporary arrays fit next to the wave function state. Use memory.estimate_memory() to see whether this is needed.
+
+      intervals: A dictionary from accumulator names to evaluation intervals k. Those accumulators are only evaluated on steps whose number is a multiple of k, and are left out of the other steps, which appear as NaN in df and in hdf_file. Use this for expensive accumulators (obdm, tbdm, pgrad) whose samples are correlated over several steps anyway.
+
     Returns: (df,configs)
-       df: A list of dictionaries nstep long that contains all results from the accumulators. These are averaged across all walkers.
+       df: A list of dictionaries nstep long that contains all results from the accumulators, averaged across all walkers, or their reblocked summary if store_steps is False.
 
        configs: The final coordinates from this calculation.
        
@@ -137,6 +246,15 @@ def vmc(
         accumulators = {}
         if verbose:
             print("WARNING: running VMC with no accumulators")
+    assert move in ("electron", "all"), "Invalid move={0}".format(move)
+    if max_bytes is not None:
+        accumulators = {
+            k: ChunkedAccumulator(acc, max_bytes) for k, acc in accumulators.items()
+        }
+    if timer is None:
+        timer = null_timer
+    if intervals is None:
+        intervals = {}
 
     # Restart
     if hdf_file is not None:
@@ -146,43 +264,104 @@ def vmc(
                 if verbose:
                     print("Restarted calculation")
 
+    if hdf_options is None:
+        hdf_options = {}
+    writer = hdftools.HDFWriter(hdf_file, dict(tstep=tstep, move=move), **hdf_options)
+
+    if statistics is None:
+        statistics = OnlineBlocking()
+    monitor = None
+    if target_error is not None:
+        monitor = TargetError(
+            target_key[0] + target_key[1], target_error, check_every, statistics
+        )
+
     nconf, nelec, ndim = configs.configs.shape
     df = []
-    wf.recompute(configs)
-    for step in range(nsteps):
-        if verbose:
-            print("step", step)
-        acc = []
-        for e in range(nelec):
-            # Propose move
-            grad = limdrift(np.real(wf.gradient(e, configs.electron(e)).T))
-            gauss = np.random.normal(scale=np.sqrt(tstep), size=(nconf, 3))
-            newcoorde = configs.configs[:, e, :] + gauss + grad * tstep
-            newcoorde = configs.make_irreducible(e, newcoorde)
-
-            # Compute reverse move
-            new_grad = limdrift(np.real(wf.gradient(e, newcoorde).T))
-            forward = np.sum(gauss ** 2, axis=1)
-            backward = np.sum((gauss + tstep * (grad + new_grad)) ** 2, axis=1)
-
-            # Acceptance
-            t_prob = np.exp(1 / (2 * tstep) * (forward - backward))
-            ratio = np.multiply(wf.testvalue(e, newcoorde) ** 2, t_prob)
-            accept = ratio > np.random.rand(nconf)
-
-            # Update wave function
-            configs.move(e, newcoorde, accept)
-            wf.updateinternals(e, newcoorde, mask=accept)
-            acc.append(np.mean(accept))
-        avg = {}
-        for k, accumulator in accumulators.items():
-            dat = accumulator.avg(configs, wf)
-            for m, res in dat.items():
-                # print(m,res.nbytes/1024/1024)
-                avg[k + m] = res  # np.mean(res,axis=0)
-        avg["acceptance"] = np.mean(acc)
-        avg["step"] = stepoffset + step
-        avg["nconfig"] = nconf
-        vmc_file(hdf_file, avg, dict(tstep=tstep), configs)
-        df.append(avg)
+    with timer("recompute"):
+        if max_bytes is not None and nconf > 1:
+            model = memory.memory_model(wf, configs)
+            resident = model["wf"][0] + model["wf"][1] * nconf
+            size = memory.chunk_size(max_bytes - resident, *model["recompute"])
+            memory.recompute_chunked(wf, configs, size)
+        else:
+            wf.recompute(configs)
+    drift = None
+    try:
+        for step in range(nsteps):
+            if verbose:
+                print("step", step)
+            acc = []
+            if move == "all":
+                with timer("move_all"):
+                    accept, drift = all_electron_move(
+                        wf, configs, tstep, lambda g: limdrift(g) * tstep, grad=drift
+                    )
+                acc.append(np.mean(accept))
+            else:
+                for e in range(nelec):
+                    # Propose move
+                    with timer("gradient"):
+                        grad = limdrift(
+                            np.real(gradient_current(wf, e, configs.electron(e)).T)
+                        )
+                    gauss = np.random.normal(scale=np.sqrt(tstep), size=(nconf, 3))
+                    newcoorde = configs.configs[:, e, :] + gauss + grad * tstep
+                    newcoorde = configs.make_irreducible(e, newcoorde)
+
+                    # Compute reverse move
+                    with timer("testvalue"):
+                        wfratio, new_grad = testvalue_gradient(wf, e, newcoorde)
+                    new_grad = limdrift(np.real(new_grad.T))
+                    forward = np.sum(gauss ** 2, axis=1)
+                    backward = np.sum((gauss + tstep * (grad + new_grad)) ** 2, axis=1)
+
+                    # Acceptance
+                    t_prob = np.exp(1 / (2 * tstep) * (forward - backward))
+                    ratio = np.multiply(wfratio ** 2, t_prob)
+                    accept = ratio > np.random.rand(nconf)
+
+                    # Update wave function
+                    with timer("updateinternals"):
+                        configs.move(e, newcoorde, accept)
+                        wf.updateinternals(e, newcoorde, mask=accept)
+                    acc.append(np.mean(accept))
+            avg = {}
+            for k, accumulator in accumulators.items():
+                if (stepoffset + step) % intervals.get(k, 1) != 0:
+                    continue
+                with timer("accumulator_" + k):
+                    dat = accumulator.avg(configs, wf)
+                for m, res in dat.items():
+                    # print(m,res.nbytes/1024/1024)
+                    avg[k + m] = res  # np.mean(res,axis=0)
+            avg["acceptance"] = np.mean(acc)
+            avg["step"] = stepoffset + step
+            avg["nconfig"] = nconf
+            with timer("hdf"):
+                checkpoint = None
+                if writer.checkpoint_due:
+                    checkpoint = {"configs": configs.configs}
+                writer.append(avg, checkpoint)
+            if monitor is not None:
+                monitor.add(avg)
+            else:
+                statistics.add(avg)
+            if store_steps:
+                df.append(avg)
+            if monitor is not None and monitor.done():
+                if verbose:
+                    print("Reached target error after", step + 1, "steps")
+                break
+    finally:
+        with timer("hdf"):
+            writer.close({"configs": configs.configs})
+    if hdf_file is not None and timer is not null_timer:
+        with h5py.File(hdf_file, "a") as hdf:
+            timer.to_hdf(hdf)
+    if not store_steps:
+        return statistics.summary(), configs
+    if monitor is not None:
+        warmup = len(df) if monitor.warmup is None else monitor.warmup
+        df = [dict(row, equilibrated=i >= warmup) for i, row in enumerate(df)]
     return df, configs
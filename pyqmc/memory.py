@@ -0,0 +1,143 @@
+import copy
+import tracemalloc
+import numpy as np
+
+
+def _measure(f):
+    """ Returns (peak, retained) bytes allocated while calling f(), as seen by tracemalloc """
+    started = tracemalloc.is_tracing()
+    if started and hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    else:
+        # Before Python 3.9 the peak can only be reset by restarting the trace
+        tracemalloc.stop()
+        tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    f()
+    current, peak = tracemalloc.get_traced_memory()
+    if not started:
+        tracemalloc.stop()
+    return peak - base, current - base
+
+
+def memory_model(wf, configs, accumulators=None, nsample=4):
+    """
+    Measures the memory used by wf.recompute() and by each accumulator on nsample and
+    2*nsample walkers taken from configs, and fits a linear model in the number of walkers.
+    wf is copied, so it is left unchanged.
+
+    Returns:
+      a dictionary of (fixed, per_walker) bytes, with keys "recompute" (peak during recompute()),
+      "wf" (resident wave function state after recompute()), and each accumulator name
+      (peak during the accumulator call, on top of the wave function state).
+    """
+    if accumulators is None:
+        accumulators = {}
+    wf = copy.deepcopy(wf)
+    nsample = min(nsample, configs.configs.shape[0] // 2)
+    assert nsample > 0, "Need at least two configurations to estimate memory"
+    measurements = {}
+    for n in [nsample, 2 * nsample]:
+        sample = configs.mask(slice(0, n))
+        peak, retained = _measure(lambda: wf.recompute(sample))
+        measurements.setdefault("recompute", []).append(peak)
+        measurements.setdefault("wf", []).append(retained)
+        for k, accumulator in accumulators.items():
+            peak, retained = _measure(lambda: accumulator(sample, wf))
+            measurements.setdefault(k, []).append(peak)
+    model = {}
+    for k, (small, large) in measurements.items():
+        per_walker = max(large - small, 0) / nsample
+        model[k] = (max(small - per_walker * nsample, 0), per_walker)
+    return model
+
+
+def estimate_memory(wf, configs, accumulators=None, nconf=None, nsample=4):
+    """
+    Estimate the peak memory in bytes of a calculation with nconf walkers
+    (default: the number in configs), extrapolated from memory_model().
+
+    Returns:
+      a dictionary with the bytes for "recompute", "wf", each accumulator, and "total",
+      the largest of the recompute peak and the wave function state plus an accumulator peak.
+    """
+    if nconf is None:
+        nconf = configs.configs.shape[0]
+    model = memory_model(wf, configs, accumulators, nsample)
+    estimate = {k: int(fixed + per_walker * nconf) for k, (fixed, per_walker) in model.items()}
+    accumulator_peaks = [estimate[k] for k in model if k not in ("recompute", "wf")]
+    estimate["total"] = max(
+        [estimate["recompute"]] + [estimate["wf"] + p for p in accumulator_peaks]
+    )
+    return estimate
+
+
+def chunk_size(max_bytes, fixed, per_walker):
+    """ The number of walkers whose memory fixed + per_walker*n fits in max_bytes, at least 1 """
+    if per_walker <= 0:
+        return None
+    return max(int((max_bytes - fixed) // per_walker), 1)
+
+
+def walker_chunks(nconf, size):
+    """ Slices that cover range(nconf) in pieces of at most size walkers """
+    if size is None:
+        size = nconf
+    return [slice(start, min(start + size, nconf)) for start in range(0, nconf, size)]
+
+
+def _state_arrays(state):
+    """ The walker arrays in a save_state() structure, including those of configurations """
+    if isinstance(state, np.ndarray):
+        return [state]
+    if isinstance(state, (list, tuple)):
+        return [a for it in state for a in _state_arrays(it)]
+    return [getattr(state, k) for k in ("configs", "wrap") if hasattr(state, k)]
+
+
+def _share_state_copy(wf):
+    """ A deep copy of wf that shares its walker arrays (from save_state()) instead of 
+    copying them. Only valid for calls that replace those arrays, such as recompute() 
+    and resample(), rather than writing into them. """
+    if not hasattr(wf, "save_state"):
+        return copy.deepcopy(wf)
+    memo = {id(a): a for a in _state_arrays(wf.save_state())}
+    return copy.deepcopy(wf, memo)
+
+
+def walker_subset(wf, inds):
+    """
+    A copy of wf with the state of the walkers inds only, built with resample() from 
+    the rows inds of the state of wf, which is not copied as a whole. wf is unchanged.
+    """
+    subset = _share_state_copy(wf)
+    subset.resample(inds)
+    return subset
+
+
+def recompute_chunked(wf, configs, size):
+    """
+    wf.recompute(configs) in chunks of at most size walkers, so that the temporary 
+    arrays of recompute() scale with size rather than with the number of walkers. 
+    Each chunk is recomputed on a copy and its state copied into wf by restore_state().
+    Wave functions without resample(), save_state(), and restore_state() are 
+    recomputed all at once.
+
+    Returns:
+      the value of wf, as recompute() does.
+    """
+    nconf = configs.configs.shape[0]
+    chunks = walker_chunks(nconf, size)
+    methods = ["resample", "save_state", "restore_state"]
+    if len(chunks) == 1 or not all(hasattr(wf, m) for m in methods):
+        return wf.recompute(configs)
+    first = chunks[0]
+    wf.recompute(configs.mask(first))
+    # State for all walkers; the rows after the first chunk are filled in below
+    wf.resample(np.minimum(np.arange(nconf), first.stop - 1))
+    for chunk in chunks[1:]:
+        chunk_wf = _share_state_copy(wf)
+        chunk_wf.recompute(configs.mask(chunk))
+        wf.restore_state(chunk_wf.save_state(), chunk, rows=slice(None))
+        del chunk_wf
+    return wf.value()
@@ -69,6 +69,17 @@ class MultiplyNWF:
         for wf in self.wf_factors:
             wf.updateinternals(e, epos, mask=mask)
 
+    def resample(self, newinds):
+        for wf in self.wf_factors:
+            wf.resample(newinds)
+
+    def save_state(self):
+        return [wf.save_state() for wf in self.wf_factors]
+
+    def restore_state(self, state, mask, rows=None):
+        for wf, wfstate in zip(self.wf_factors, state):
+            wf.restore_state(wfstate, mask, rows)
+
     def value(self):
         results = [wf.value() for wf in self.wf_factors]
         results = np.array([*results])
@@ -78,10 +89,20 @@ class MultiplyNWF:
         grads = [wf.gradient(e, epos) for wf in self.wf_factors]
         return np.sum(grads, axis=0)
 
+    def gradient_current(self, e, epos):
+        grads = [wf.gradient_current(e, epos) for wf in self.wf_factors]
+        return np.sum(grads, axis=0)
+
     def testvalue(self, e, epos, mask=None):
         testvalues = [wf.testvalue(e, epos, mask=mask) for wf in self.wf_factors]
         return np.prod(testvalues, axis=0)
 
+    def testvalue_gradient(self, e, epos, mask=None):
+        results = [wf.testvalue_gradient(e, epos, mask=mask) for wf in self.wf_factors]
+        testvalues = [r[0] for r in results]
+        grads = [r[1] for r in results]
+        return np.prod(testvalues, axis=0), np.sum(grads, axis=0)
+
     def laplacian(self, e, epos):
         grad_laps = [wf.gradient_laplacian(e, epos) for wf in self.wf_factors]
         grad_laps = np.array(grad_laps)
@@ -63,6 +63,17 @@ class MultiplyWF:
         self.wf1.updateinternals(e, epos, mask=mask)
         self.wf2.updateinternals(e, epos, mask=mask)
 
+    def resample(self, newinds):
+        self.wf1.resample(newinds)
+        self.wf2.resample(newinds)
+
+    def save_state(self):
+        return self.wf1.save_state(), self.wf2.save_state()
+
+    def restore_state(self, state, mask, rows=None):
+        self.wf1.restore_state(state[0], mask, rows)
+        self.wf2.restore_state(state[1], mask, rows)
+
     def value(self):
         v1 = self.wf1.value()
         v2 = self.wf2.value()
@@ -71,11 +82,32 @@ class MultiplyWF:
     def gradient(self, e, epos):
         return self.wf1.gradient(e, epos) + self.wf2.gradient(e, epos)
 
+    def gradient_current(self, e, epos):
+        return self.wf1.gradient_current(e, epos) + self.wf2.gradient_current(e, epos)
+
+    def gradient_all(self, configs):
+        grad = 0
+        for wf in [self.wf1, self.wf2]:
+            if hasattr(wf, "gradient_all"):
+                grad = grad + wf.gradient_all(configs)
+            else:
+                nelec = configs.configs.shape[1]
+                grad = grad + np.stack(
+                    [wf.gradient_current(e, configs.electron(e)) for e in range(nelec)],
+                    axis=-1,
+                )
+        return grad
+
     def testvalue(self, e, epos, mask=None):
         return self.wf1.testvalue(e, epos, mask=mask) * self.wf2.testvalue(
             e, epos, mask=mask
         )
 
+    def testvalue_gradient(self, e, epos, mask=None):
+        v1, g1 = self.wf1.testvalue_gradient(e, epos, mask=mask)
+        v2, g2 = self.wf2.testvalue_gradient(e, epos, mask=mask)
+        return v1 * v2, g1 + g2
+
     def testvalue_many(self, e, epos, mask=None):
         return self.wf1.testvalue_many(e, epos, mask=mask) * self.wf2.testvalue_many(
             e, epos, mask=mask
@@ -1,5 +1,6 @@
 import numpy as np
 from pyqmc.slateruhf import sherman_morrison_row
+from pyqmc.coord import WalkerPool
 
 
 def sherman_morrison_ms(e, inv, vec):
@@ -35,6 +36,7 @@ class MultiSlater:
 
     def __init__(self, mol, mf, mc):
         self.parameters = {}
+        self._pool = WalkerPool()
         self._mol = mol
         self._nelec = (mc.nelecas[0] + mc.ncore, mc.nelecas[1] + mc.ncore)
         self._copy_ci(mc)
@@ -104,6 +106,15 @@ class MultiSlater:
         self._aovals = ao
         self._dets = []
         self._inverse = []
+        # Cache of MO values and derivatives at each electron's current position,
+        # filled by testvalue_gradient()/updateinternals() and invalidated here.
+        dtype = np.result_type(ao, *[self.parameters[k] for k in self._coefflookup])
+        self._mograd = [
+            np.zeros((4, nconf, self._nelec[s], self.parameters[k].shape[1]), dtype)
+            for s, k in enumerate(self._coefflookup)
+        ]
+        self._mograd_valid = np.zeros((nconf, nelec), dtype=bool)
+        self._proposal = None
         for s in [0, 1]:
             mo = ao[:, self._nelec[0] * s : self._nelec[0] + self._nelec[1] * s, :].dot(
                 self.parameters[self._coefflookup[s]]
@@ -126,10 +137,19 @@ class MultiSlater:
         if mask is None:
             mask = [True] * epos.configs.shape[0]
         eeff = e - s * self._nelec[0]
-        ao = np.real_if_close(
-            self._mol.eval_gto(self.pbc_str + "GTOval_sph", epos.configs), tol=1e4
-        )
-        mo = ao.dot(self.parameters[self._coefflookup[s]])
+        proposal, self._proposal = self._proposal, None
+        if proposal is not None and proposal[0] == e and proposal[1] is epos:
+            # Reuse the MOs evaluated by testvalue_gradient() for this move
+            mograd = proposal[2]
+            mo = mograd[0]
+            self._mograd[s][:, mask, eeff, :] = mograd[:, mask]
+            self._mograd_valid[mask, e] = True
+        else:
+            ao = np.real_if_close(
+                self._mol.eval_gto(self.pbc_str + "GTOval_sph", epos.configs), tol=1e4
+            )
+            mo = ao.dot(self.parameters[self._coefflookup[s]])
+            self._mograd_valid[mask, e] = False
 
         mo_vals = mo[:, self._det_occup[s]]
         det_ratio, self._inverse[s][mask, :, :, :] = sherman_morrison_ms(
@@ -138,6 +158,44 @@ class MultiSlater:
 
         self._updateval(det_ratio, s, mask)
 
+    def resample(self, newinds):
+        """Reorder the walkers by newinds (for example after DMC branching), so that the 
+        internal state matches configs.resample(newinds) without a recompute()."""
+        take = self._pool.take
+        self._aovals = take("aovals", self._aovals, newinds)
+        self._dets = [
+            take(("dets", s), det, newinds, axis=1) for s, det in enumerate(self._dets)
+        ]
+        self._inverse = [
+            take(("inverse", s), inv, newinds) for s, inv in enumerate(self._inverse)
+        ]
+        self._mograd = [
+            take(("mograd", s), mograd, newinds, axis=1)
+            for s, mograd in enumerate(self._mograd)
+        ]
+        self._mograd_valid = take("mograd_valid", self._mograd_valid, newinds)
+        self._proposal = None
+
+    def save_state(self):
+        """The walker-indexed internal state, for restore_state(). The arrays are not 
+        copied: recompute() replaces them rather than writing into them, so the state 
+        stays valid across recompute(), but not across updateinternals() or resample()."""
+        return (self._aovals, self._dets, self._inverse, self._mograd, self._mograd_valid)
+
+    def restore_state(self, state, mask, rows=None):
+        """Set the internal state of the walkers in mask back to state, as returned by 
+        save_state(). rows selects the walkers of state to use, and defaults to mask 
+        for a state of the same walkers."""
+        rows = mask if rows is None else rows
+        aovals, dets, inverse, mograd, mograd_valid = state
+        self._aovals[mask] = aovals[rows]
+        for s, det in enumerate(dets):
+            self._dets[s][:, mask] = det[:, rows]
+            self._inverse[s][mask] = inverse[s][rows]
+            self._mograd[s][:, mask] = mograd[s][:, rows]
+        self._mograd_valid[mask] = mograd_valid[rows]
+        self._proposal = None
+
     def value(self):
         """Return logarithm of the wave function as noted in recompute()"""
         wf_val = 0
@@ -204,7 +262,7 @@ class MultiSlater:
         if epos differs from the current position of electron e."""
         s = int(e >= self._nelec[0])
         aograd = np.real_if_close(
-            self._mol.eval_gto("GTOval_sph_deriv1", epos.configs), tol=1e4
+            self._mol.eval_gto(self.pbc_str + "GTOval_sph_deriv1", epos.configs), tol=1e4
         )
         mograd = aograd.dot(self.parameters[self._coefflookup[s]])
         mograd_vals = mograd[:, :, self._det_occup[s]]
@@ -212,6 +270,26 @@ class MultiSlater:
         ratios = np.asarray([self._testrow(e, x) for x in mograd_vals])
         return ratios[1:] / ratios[:1]
 
+    def gradient_current(self, e, epos):
+        """ Compute the gradient of the log wave function for electron e at its current
+        position epos, using the cached MO derivatives where they are valid."""
+        s = int(e >= self._nelec[0])
+        eeff = e - s * self._nelec[0]
+        stale = ~self._mograd_valid[:, e]
+        if np.any(stale):
+            aograd = np.real_if_close(
+                self._mol.eval_gto(
+                    self.pbc_str + "GTOval_sph_deriv1", epos.configs[stale]
+                ),
+                tol=1e4,
+            )
+            mograd = aograd.dot(self.parameters[self._coefflookup[s]])
+            self._mograd[s][:, stale, eeff, :] = mograd
+            self._mograd_valid[stale, e] = True
+        mograd_vals = self._mograd[s][:, :, eeff][:, :, self._det_occup[s]]
+        ratios = np.asarray([self._testrow(e, x) for x in mograd_vals])
+        return ratios[1:] / ratios[:1]
+
     def laplacian(self, e, epos):
         """ Compute the laplacian Psi/ Psi. """
         s = int(e >= self._nelec[0])
@@ -259,6 +337,26 @@ class MultiSlater:
         mo_vals = mo[..., self._det_occup[s]]
         return self._testrow(e, mo_vals, mask)
 
+    def testvalue_gradient(self, e, epos, mask=None):
+        """ return the ratio between the current wave function and the wave function if
+        electron e's position is replaced by epos, and the gradient of the log wave function
+        at epos. Both come from the same AO evaluation."""
+        s = int(e >= self._nelec[0])
+        if mask is None:
+            mask = [True] * epos.configs.shape[0]
+        eposmask = epos.configs[mask]
+        if len(eposmask) == 0:
+            return np.zeros(0), np.zeros((3, 0))
+        aograd = np.real_if_close(
+            self._mol.eval_gto(self.pbc_str + "GTOval_sph_deriv1", eposmask), tol=1e4
+        )
+        mograd = aograd.dot(self.parameters[self._coefflookup[s]])
+        if len(eposmask) == len(epos.configs):
+            self._proposal = (e, epos, mograd)
+        mograd_vals = mograd[:, :, self._det_occup[s]]
+        ratios = np.asarray([self._testrow(e, x, mask) for x in mograd_vals])
+        return ratios[0], ratios[1:] / ratios[:1]
+
     def testvalue_many(self, e, epos, mask=None):
         """ return the ratio between the current wave function and the wave function if 
         electron e's position is replaced by epos for each electron"""
@@ -5,23 +5,7 @@ import h5py
 import pyqmc
 import pyqmc.hdftools as hdftools
 
-def ortho_hdf(hdf_file, data, attr, configs, parameters):
-
-    if hdf_file is not None:
-        with h5py.File(hdf_file, "a") as hdf:
-            if "configs" not in hdf.keys():
-                hdftools.setup_hdf(hdf, data, attr)
-                hdf.create_dataset("configs", configs.configs.shape)
-                for k, it in parameters.items():
-                    hdf.create_dataset("wf/" + k, data=it)
-
-            hdftools.append_hdf(hdf, data)
-            hdf["configs"][:, :, :] = configs.configs
-            for k, it in parameters.items():
-                hdf["wf/" + k][...] = it.copy()
-
-
-from pyqmc.mc import limdrift
+from pyqmc.mc import limdrift, gradient_current, testvalue_gradient
 
 
 def sample_overlap(wfs, configs, pgrad, nsteps=100, tstep=0.5):
@@ -54,7 +38,9 @@ def sample_overlap(wfs, configs, pgrad, nsteps=100, tstep=0.5):
         # print("step", step)
         for e in range(nelec):
             # Propose move
-            grads = [np.real(wf.gradient(e, configs.electron(e)).T) for wf in wfs]
+            grads = [
+                np.real(gradient_current(wf, e, configs.electron(e)).T) for wf in wfs
+            ]
 
             grad = limdrift(np.mean(grads, axis=0))
             gauss = np.random.normal(scale=np.sqrt(tstep), size=(nconf, 3))
@@ -62,14 +48,15 @@ def sample_overlap(wfs, configs, pgrad, nsteps=100, tstep=0.5):
             newcoorde = configs.make_irreducible(e, newcoorde)
 
             # Compute reverse move
-            grads = [np.real(wf.gradient(e, newcoorde).T) for wf in wfs]
+            results = [testvalue_gradient(wf, e, newcoorde) for wf in wfs]
+            grads = [np.real(r[1].T) for r in results]
             new_grad = limdrift(np.mean(grads, axis=0))
             forward = np.sum(gauss ** 2, axis=1)
             backward = np.sum((gauss + tstep * (grad + new_grad)) ** 2, axis=1)
 
             # Acceptance
             t_prob = np.exp(1 / (2 * tstep) * (forward - backward))
-            wf_ratios = np.array([wf.testvalue(e, newcoorde) ** 2 for wf in wfs])
+            wf_ratios = np.array([r[0] ** 2 for r in results])
             log_values = np.array([wf.value()[1] for wf in wfs])
             ref = log_values[0]
             weights = np.exp(2 * (log_values - ref))
@@ -370,151 +357,160 @@ def optimize_orthogonal(
         beta2=beta2,
         adam_epsilon=adam_epsilon,
     )
+    writer = hdftools.HDFWriter(hdf_file, attr, buffer_size=1)
     conditioner = pyqmc.linemin.sd_update
     if sample_options is None:
         sample_options = {}
     if correlated_options is None:
         correlated_options = {}
 
-    #One set of configurations for every wave function
-    allcoords = [coords.copy() for _ in wfs[:-1]]
-    for step in range(nsteps):
-        # we iterate until the normalization is reasonable
-        # One could potentially save a little time here by not computing the gradients 
-        # every time, but typically we don't have to renormalize if the moves are good
-        deriv_data = []
-        while True:
-            tmp_deriv = evaluate([wfs[0], wfs[-1]], allcoords[0], pgrad, sampler, sample_options, warmup)
-            N = tmp_deriv['N'][-1]
-
-            print("Normalization", N)
-            if abs(N - Ntarget) < Ntol:
-                deriv_data.append(tmp_deriv)
-                break
-            else:
-                renormalize([wfs[0],wfs[-1]], N)
-                parameters = pgrad.transform.serialize_parameters(wfs[-1].parameters)
-
-        for i, wf in enumerate(wfs[1:-1]):
-            deriv_data.append(evaluate([wf, wfs[-1]], allcoords[i+1], pgrad, sampler, sample_options, warmup))
-        collected_data = {}
-        for k in deriv_data[0].keys():
-            collected_data[k] = np.array([x[k] for x in deriv_data])
-        print("normalization", collected_data['N'][:,-1])
-        normalization = collected_data['N'][:,-1]
-        total_energy = np.mean(collected_data['total'], axis=0)
-        energy_derivative = np.mean(collected_data['energy_derivative'], axis=0)
-        N_derivative = np.mean(collected_data['N_derivative'], axis=0)
-        condition = np.mean(collected_data['condition'], axis=0)
-        overlaps = collected_data['S'][:,-1,0]
-        overlap_derivatives = collected_data['S_derivative'][:,0,:]
-
-        overlap_derivative = np.sum(
-            2.0 * (forcing*(overlaps - Starget))[:,np.newaxis] * overlap_derivatives, 
-            axis=0
-        )
+    try:
+        #One set of configurations for every wave function
+        allcoords = [coords.copy() for _ in wfs[:-1]]
+        for step in range(nsteps):
+            # we iterate until the normalization is reasonable
+            # One could potentially save a little time here by not computing the gradients 
+            # every time, but typically we don't have to renormalize if the moves are good
+            deriv_data = []
+            while True:
+                tmp_deriv = evaluate([wfs[0], wfs[-1]], allcoords[0], pgrad, sampler, sample_options, warmup)
+                N = tmp_deriv['N'][-1]
+
+                print("Normalization", N)
+                if abs(N - Ntarget) < Ntol:
+                    deriv_data.append(tmp_deriv)
+                    break
+                else:
+                    renormalize([wfs[0],wfs[-1]], N)
+                    parameters = pgrad.transform.serialize_parameters(wfs[-1].parameters)
+
+            for i, wf in enumerate(wfs[1:-1]):
+                deriv_data.append(evaluate([wf, wfs[-1]], allcoords[i+1], pgrad, sampler, sample_options, warmup))
+            collected_data = {}
+            for k in deriv_data[0].keys():
+                collected_data[k] = np.array([x[k] for x in deriv_data])
+            print("normalization", collected_data['N'][:,-1])
+            normalization = collected_data['N'][:,-1]
+            total_energy = np.mean(collected_data['total'], axis=0)
+            energy_derivative = np.mean(collected_data['energy_derivative'], axis=0)
+            N_derivative = np.mean(collected_data['N_derivative'], axis=0)
+            condition = np.mean(collected_data['condition'], axis=0)
+            overlaps = collected_data['S'][:,-1,0]
+            overlap_derivatives = collected_data['S_derivative'][:,0,:]
+
+            overlap_derivative = np.sum(
+                2.0 * (forcing*(overlaps - Starget))[:,np.newaxis] * overlap_derivatives, 
+                axis=0
+            )
 
-        total_derivative = energy_derivative + overlap_derivative 
+            total_derivative = energy_derivative + overlap_derivative 
         
 
-        print("############################# step ", step)
-        format_str = "{:<15}" * 2 + "{:<15.10}" * 2
-        print(format_str.format("Quantity", "wf", "value", "|grad|"))
-        print(format_str.format("energy",len(wfs)-1,total_energy, np.linalg.norm(energy_derivative)))
-        print(format_str.format("norm",len(wfs)-1,N, np.linalg.norm(N_derivative)))
-        for i in range(len(wfs)-1):
-            print(format_str.format("overlap",i,overlaps[i], np.linalg.norm(overlap_derivatives[i])))
-
-        #Use SR to condition the derivatives
-        invSij = np.linalg.inv(condition + 0.1 * np.eye(condition.shape[0]))
-        total_derivative = np.einsum("ij,j->i", invSij, total_derivative)
-        N_derivative = np.einsum("ij,j->i", invSij, N_derivative)
-
-        #Try to move in the projection that doesn't change the norm
-        #Here we project out the 
-        if np.linalg.norm(N_derivative) > 1e-8:
-            total_derivative -= (
-                np.dot(total_derivative, N_derivative)
-                * N_derivative
-                / (np.linalg.norm(N_derivative)) ** 2
+            print("############################# step ", step)
+            format_str = "{:<15}" * 2 + "{:<15.10}" * 2
+            print(format_str.format("Quantity", "wf", "value", "|grad|"))
+            print(format_str.format("energy",len(wfs)-1,total_energy, np.linalg.norm(energy_derivative)))
+            print(format_str.format("norm",len(wfs)-1,N, np.linalg.norm(N_derivative)))
+            for i in range(len(wfs)-1):
+                print(format_str.format("overlap",i,overlaps[i], np.linalg.norm(overlap_derivatives[i])))
+
+            #Use SR to condition the derivatives
+            invSij = np.linalg.inv(condition + 0.1 * np.eye(condition.shape[0]))
+            total_derivative = np.einsum("ij,j->i", invSij, total_derivative)
+            N_derivative = np.einsum("ij,j->i", invSij, N_derivative)
+
+            #Try to move in the projection that doesn't change the norm
+            #Here we project out the 
+            if np.linalg.norm(N_derivative) > 1e-8:
+                total_derivative -= (
+                    np.dot(total_derivative, N_derivative)
+                    * N_derivative
+                    / (np.linalg.norm(N_derivative)) ** 2
+                )
+
+            deriv_norm = np.linalg.norm(total_derivative)
+            if deriv_norm > max_step:
+                total_derivative = total_derivative * max_step / deriv_norm
+
+            #ADAM uses a momentum term, which can sometimes accelerate the 
+            #optimization and allow for a much smaller sample size
+            if update_method == "adam":
+                adam_m = beta1 * adam_m + (1 - beta1) * total_derivative
+                adam_v = beta2 * adam_v + (1 - beta2) * total_derivative ** 2
+                adam_mhat = adam_m / (1 - beta1 ** (step + 1))
+                adam_vhat = adam_v / (1 - beta2 ** (step + 1))
+                total_derivative = adam_mhat / (np.sqrt(adam_vhat) + adam_epsilon)
+
+            #print("derivative after modifications", total_derivative.round(2))
+            if linemin:
+                test_tsteps = np.linspace(-tstep, tstep, 21)
+                test_parameters = [ parameters+conditioner(total_derivative, condition, x) for x in test_tsteps]
+                data =[]
+                for icoord, wf in zip(allcoords, wfs):
+                    data.append(correlated_sampler([wf,wfs[-1]], icoord, test_parameters, pgrad, **correlated_options))
+                line_data = {}
+                for k in data[0].keys():
+                    line_data[k] = np.asarray([x[k] for x in data])
+
+                yfit = []
+                xfit = []
+                overlap_cost = forcing[:,np.newaxis]*(line_data['overlap'][:,:,0]-Starget[:,np.newaxis])**2
+                cost = np.mean(line_data['total'], axis=0)+np.sum(overlap_cost, axis=0) 
+                mask = (np.abs(line_data['weight'] -1.0) > weight_boundaries) & (np.abs(line_data['weight']) > weight_boundaries)
+                mask = np.all(mask,axis=0)
+                xfit = test_tsteps[mask]
+                yfit = cost[mask]
+
+                row_format = "{:<5}"+ "{:<12.6} " * 5 + "{:<10}"
+                print(row_format.format("wf", "tstep", "energy", "S", "weight", "cost", 'used'))
+                for pt in range(len(mask)):
+                    for wf in range(len(data)):
+                        print(row_format.format(wf,test_tsteps[pt], line_data['total'][wf,pt],
+                        line_data['overlap'][wf,pt,0], line_data['weight'][wf,pt], cost[pt], mask[pt]))
+
+                if len(xfit) > 0:
+                    min_tstep = pyqmc.linemin.stable_fit2(xfit, yfit)
+                    print("chose to move", min_tstep)
+                    parameters += conditioner(total_derivative, condition, min_tstep)
+            else:
+                parameters += conditioner(total_derivative, condition, tstep)
+
+            for k, it in pgrad.transform.deserialize(parameters).items():
+                wfs[-1].parameters[k] = it
+
+
+            normalization = collected_data['N'][:,-1]
+            total_energy = np.mean(collected_data['total'], axis=0)
+            energy_derivative = np.mean(collected_data['energy_derivative'], axis=0)
+            N_derivative = np.mean(collected_data['N_derivative'], axis=0)
+            condition = np.mean(collected_data['condition'], axis=0)
+            overlaps = collected_data['S'][:,-1,0]
+            overlap_derivatives = collected_data['S_derivative'][:,0,:]
+
+            save_data = {
+                "energies": total_energy,
+                "overlap": overlaps,
+                "gradient": total_derivative,
+                "N": N,
+                "parameters": parameters,
+                "step": step + step_offset,
+                "normalization":normalization, 
+                "overlap_derivatives": overlap_derivatives,
+                "energy_derivative":energy_derivative,
+            }
+            if linemin: 
+                save_data["line_tsteps"] = test_tsteps
+                save_data["line_cost"] = cost
+                save_data["line_norm"] = line_data["weight"]
+
+            writer.append(
+                save_data,
+                pyqmc.linemin.opt_checkpoint(
+                    coords, pgrad.transform.deserialize(parameters)
+                ),
             )
-
-        deriv_norm = np.linalg.norm(total_derivative)
-        if deriv_norm > max_step:
-            total_derivative = total_derivative * max_step / deriv_norm
-
-        #ADAM uses a momentum term, which can sometimes accelerate the 
-        #optimization and allow for a much smaller sample size
-        if update_method == "adam":
-            adam_m = beta1 * adam_m + (1 - beta1) * total_derivative
-            adam_v = beta2 * adam_v + (1 - beta2) * total_derivative ** 2
-            adam_mhat = adam_m / (1 - beta1 ** (step + 1))
-            adam_vhat = adam_v / (1 - beta2 ** (step + 1))
-            total_derivative = adam_mhat / (np.sqrt(adam_vhat) + adam_epsilon)
-
-        #print("derivative after modifications", total_derivative.round(2))
-        if linemin:
-            test_tsteps = np.linspace(-tstep, tstep, 21)
-            test_parameters = [ parameters+conditioner(total_derivative, condition, x) for x in test_tsteps]
-            data =[]
-            for icoord, wf in zip(allcoords, wfs):
-                data.append(correlated_sampler([wf,wfs[-1]], icoord, test_parameters, pgrad, **correlated_options))
-            line_data = {}
-            for k in data[0].keys():
-                line_data[k] = np.asarray([x[k] for x in data])
-
-            yfit = []
-            xfit = []
-            overlap_cost = forcing[:,np.newaxis]*(line_data['overlap'][:,:,0]-Starget[:,np.newaxis])**2
-            cost = np.mean(line_data['total'], axis=0)+np.sum(overlap_cost, axis=0) 
-            mask = (np.abs(line_data['weight'] -1.0) > weight_boundaries) & (np.abs(line_data['weight']) > weight_boundaries)
-            mask = np.all(mask,axis=0)
-            xfit = test_tsteps[mask]
-            yfit = cost[mask]
-
-            row_format = "{:<5}"+ "{:<12.6} " * 5 + "{:<10}"
-            print(row_format.format("wf", "tstep", "energy", "S", "weight", "cost", 'used'))
-            for pt in range(len(mask)):
-                for wf in range(len(data)):
-                    print(row_format.format(wf,test_tsteps[pt], line_data['total'][wf,pt],
-                    line_data['overlap'][wf,pt,0], line_data['weight'][wf,pt], cost[pt], mask[pt]))
-
-            if len(xfit) > 0:
-                min_tstep = pyqmc.linemin.stable_fit2(xfit, yfit)
-                print("chose to move", min_tstep)
-                parameters += conditioner(total_derivative, condition, min_tstep)
-        else:
-            parameters += conditioner(total_derivative, condition, tstep)
-
-        for k, it in pgrad.transform.deserialize(parameters).items():
-            wfs[-1].parameters[k] = it
-
-
-        normalization = collected_data['N'][:,-1]
-        total_energy = np.mean(collected_data['total'], axis=0)
-        energy_derivative = np.mean(collected_data['energy_derivative'], axis=0)
-        N_derivative = np.mean(collected_data['N_derivative'], axis=0)
-        condition = np.mean(collected_data['condition'], axis=0)
-        overlaps = collected_data['S'][:,-1,0]
-        overlap_derivatives = collected_data['S_derivative'][:,0,:]
-
-        save_data = {
-            "energies": total_energy,
-            "overlap": overlaps,
-            "gradient": total_derivative,
-            "N": N,
-            "parameters": parameters,
-            "step": step + step_offset,
-            "normalization":normalization, 
-            "overlap_derivatives": overlap_derivatives,
-            "energy_derivative":energy_derivative,
-        }
-        if linemin: 
-            save_data["line_tsteps"] = test_tsteps
-            save_data["line_cost"] = cost
-            save_data["line_norm"] = line_data["weight"]
-
-        ortho_hdf(hdf_file, save_data, attr, coords, pgrad.transform.deserialize(parameters))
-        for wf in wfs:
-            print(wf.parameters['wf1det_coeff'])
+            for wf in wfs:
+                print(wf.parameters['wf1det_coeff'])
+    finally:
+        writer.close()
     return wfs
\ No newline at end of file
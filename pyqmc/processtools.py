@@ -0,0 +1,434 @@
+"""
+Drop-in replacement for pyqmc.dasktools on a single node. Pass a LocalClient as client=.
+
+Walkers (configs.configs, configs.wrap) and DMC weights live in shared memory, which the
+workers move in place. Wave functions and accumulators are pickled once into shared memory
+and kept resident in each long-lived worker; only their parameters are sent with each task.
+They are pickled with cloudpickle, since wave functions may hold lambdas.
+Requires Python 3.8 or later for multiprocessing.shared_memory.
+"""
+import os
+
+os.environ["MKL_NUM_THREADS"] = "1"
+os.environ["NUMEXPR_NUM_THREADS"] = "1"
+os.environ["OMP_NUM_THREADS"] = "1"
+import pickle
+import cloudpickle
+import h5py
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+import pyqmc.hdftools as hdftools
+import pyqmc.memory as memory
+from pyqmc.coord import OpenConfigs, PeriodicConfigs
+from pyqmc.dasktools import (
+    _merge_vmc,
+    _merge_lm,
+    _merge_dmc,
+    _merge_overlap,
+    _merge_correlated,
+)
+
+# Worker-side caches of attached shared memory blocks, by the parent's key, and of 
+# resident objects. Blocks that could not be closed yet are kept in _stale.
+_blocks = {}
+_stale = []
+_objects = {}
+
+
+def _release(block):
+    """ Close block, or keep it in _stale while arrays still view it """
+    try:
+        block.close()
+    except BufferError:
+        _stale.append(block)
+
+
+def _attach(desc):
+    """ numpy view of the shared array described by desc=(key, name, shape, dtype).
+    When the parent has reallocated the block for key, the old one is closed, so that the 
+    worker does not keep the unlinked block mapped. """
+    key, name, shape, dtype = desc
+    block = _blocks.get(key)
+    if block is None or block.name != name:
+        stale = _stale[:]
+        _stale.clear()
+        for old in stale:
+            _release(old)
+        if block is not None:
+            _release(block)
+        block = _blocks[key] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _resident(desc):
+    """ The resident object described by desc=(name, nbytes, parameters). Its block is 
+    only attached to unpickle it. """
+    name, nbytes, parameters = desc
+    if name not in _objects:
+        block = shared_memory.SharedMemory(name=name)
+        data = bytes(block.buf[:nbytes])
+        block.close()
+        _objects[name] = pickle.loads(data)
+    obj = _objects[name]
+    if parameters is not None:
+        for k, it in parameters.items():
+            obj.parameters[k] = it
+    return obj
+
+
+def _accumulators(desc):
+    return {k: _resident(it) for k, it in desc.items()}
+
+
+def _configs(desc, chunk):
+    """ Configs object whose arrays are views of the partition chunk of the shared walkers """
+    configs = _attach(desc["configs"])[chunk]
+    if desc["lvecs"] is None:
+        return OpenConfigs(configs)
+    return PeriodicConfigs(configs, desc["lvecs"], wrap=_attach(desc["wrap"])[chunk])
+
+
+def _vmc(wf, configs, chunk, accumulators, kwargs):
+    from pyqmc.mc import vmc
+
+    df, configs = vmc(
+        _resident(wf),
+        _configs(configs, chunk),
+        accumulators=_accumulators(accumulators),
+        **kwargs
+    )
+    return df
+
+
+def _dmc_propagate(wf, configs, weights, chunk, accumulators, args, kwargs):
+    from pyqmc.dmc import dmc_propagate
+
+    weights = _attach(weights)[chunk]
+    df, configs, weights = dmc_propagate(
+        _resident(wf),
+        _configs(configs, chunk),
+        weights,
+        *args,
+        accumulators=_accumulators(accumulators),
+        **kwargs
+    )
+    return df
+
+
+def _lm_sampler(lm_sampler, wf, configs, chunk, params, pgrad_acc):
+    return lm_sampler(
+        _resident(wf), _configs(configs, chunk), params, _resident(pgrad_acc)
+    )
+
+
+def _sample_overlap(wfs, configs, chunk, pgrad, args, kwargs):
+    from pyqmc.optimize_orthogonal import sample_overlap
+
+    wfs = [_resident(wf) for wf in wfs]
+    df, configs = sample_overlap(
+        wfs, _configs(configs, chunk), _resident(pgrad), *args, **kwargs
+    )
+    return df
+
+
+def _correlated_sample(wfs, configs, chunk, parameters, pgrad):
+    from pyqmc.optimize_orthogonal import correlated_sample
+
+    wfs = [_resident(wf) for wf in wfs]
+    return correlated_sample(
+        wfs, _configs(configs, chunk), parameters, _resident(pgrad)
+    )
+
+
+class LocalClient:
+    """
+    A pool of long-lived worker processes on this node, used as client= for the functions
+    in this module:
+
+      with LocalClient(nworkers=8) as client:
+          df, configs = distvmc(wf, configs, accumulators=acc, nsteps=100, client=client)
+    """
+
+    def __init__(self, nworkers=None):
+        if shared_memory is None:
+            raise RuntimeError(
+                "LocalClient needs multiprocessing.shared_memory (Python 3.8 or later)"
+            )
+        self.nworkers = os.cpu_count() if nworkers is None else nworkers
+        self.executor = ProcessPoolExecutor(max_workers=self.nworkers)
+        self._arrays = {}
+        self._objects = {}
+
+    def nthreads(self):
+        """ Number of workers, in the form of dask's Client.nthreads() """
+        return {"local": self.nworkers}
+
+    def submit(self, f, *args, **kwargs):
+        return self.executor.submit(f, *args, **kwargs)
+
+    def share_array(self, key, array):
+        """ Copy array into the shared block named key, reallocating it if it is too small.
+        Returns a description that workers pass to _attach(). """
+        array = np.ascontiguousarray(array)
+        block = self._arrays.get(key)
+        if block is None or block.size < array.nbytes:
+            if block is not None:
+                block.close()
+                block.unlink()
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self._arrays[key] = block
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        return (key, block.name, array.shape, array.dtype.str)
+
+    def shared_array(self, desc):
+        """ The parent's view of a shared array returned by share_array() """
+        key, name, shape, dtype = desc
+        return np.ndarray(shape, dtype=dtype, buffer=self._arrays[key].buf)
+
+    def share_configs(self, configs):
+        desc = {
+            "configs": self.share_array("configs", configs.configs),
+            "lvecs": getattr(configs, "lvecs", None),
+        }
+        if desc["lvecs"] is not None:
+            desc["wrap"] = self.share_array("wrap", configs.wrap)
+        return desc
+
+    def gather_configs(self, configs, desc):
+        """ Copy the shared walkers back into configs """
+        configs.configs[...] = self.shared_array(desc["configs"])
+        if desc["lvecs"] is not None:
+            configs.wrap[...] = self.shared_array(desc["wrap"])
+
+    def resident(self, obj):
+        """
+        Pickle obj into shared memory the first time it is seen, so that each worker
+        unpickles it once and keeps it. Returns a description for the workers, which
+        carries the current parameters if obj has any.
+        """
+        if id(obj) not in self._objects:
+            data = np.frombuffer(cloudpickle.dumps(obj), dtype=np.uint8)
+            block = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+            np.ndarray(data.shape, dtype=np.uint8, buffer=block.buf)[...] = data
+            # obj is kept so that its id is not reused while the block exists
+            self._objects[id(obj)] = (obj, block, len(data))
+        obj, block, nbytes = self._objects[id(obj)]
+        parameters = None
+        if hasattr(obj, "parameters"):
+            parameters = {k: np.asarray(it) for k, it in obj.parameters.items()}
+        return (block.name, nbytes, parameters)
+
+    def close(self):
+        self.executor.shutdown()
+        for block in list(self._arrays.values()) + [
+            it[1] for it in self._objects.values()
+        ]:
+            block.close()
+            block.unlink()
+        self._arrays = {}
+        self._objects = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _partitions(client, configs, npartitions):
+    if npartitions is None:
+        npartitions = sum([x for x in client.nthreads().values()])
+    nconf = configs.configs.shape[0]
+    assert nconf % npartitions == 0, "nconf must be divisible by npartitions"
+    return memory.walker_chunks(nconf, nconf // npartitions)
+
+
+def distvmc(
+    wf,
+    coords,
+    accumulators=None,
+    nsteps=100,
+    hdf_file=None,
+    npartitions=None,
+    nsteps_per=None,
+    client=None,
+    verbose=False,
+    **kwargs
+):
+    """
+    Args:
+    wf: a wave function object
+
+    coords: nconf x nelec x 3
+
+    nsteps: how many steps to move each walker
+
+    client: a LocalClient
+    """
+    if nsteps_per is None:
+        nsteps_per = nsteps
+
+    if hdf_file is not None:
+        with h5py.File(hdf_file, "a") as hdf:
+            if "configs" in hdf.keys():
+                coords.configs = np.array(hdf["configs"])
+                if verbose:
+                    print("Restarted calculation")
+
+    if accumulators is None:
+        accumulators = {}
+    chunks = _partitions(client, coords, npartitions)
+    writer = hdftools.HDFWriter(hdf_file, kwargs, buffer_size=nsteps_per)
+    try:
+        niterations = int(nsteps / nsteps_per)
+        shared = client.share_configs(coords)
+        wfdesc = client.resident(wf)
+        accdesc = {k: client.resident(it) for k, it in accumulators.items()}
+        alldata = []
+        for epoch in range(niterations):
+            runs = [
+                client.submit(
+                    _vmc,
+                    wfdesc,
+                    shared,
+                    chunk,
+                    accdesc,
+                    dict(nsteps=nsteps_per, stepoffset=epoch * nsteps_per, **kwargs),
+                )
+                for chunk in chunks
+            ]
+            iterdata = []
+            for r in runs:
+                iterdata.extend(r.result())
+            collected_data = _merge_vmc(iterdata)
+            if verbose:
+                print("epoch", epoch, "finished", flush=True)
+
+            client.gather_configs(coords, shared)
+            alldata.extend(collected_data)
+            for d in collected_data:
+                writer.append(d, {"configs": coords.configs})
+    finally:
+        writer.close()
+
+    return alldata, coords
+
+
+def dist_lm_sampler(
+    wf, configs, params, pgrad_acc, npartitions=None, client=None, lm_sampler=None
+):
+    """
+    Evaluates accumulator on the same set of configs for correlated sampling of
+    different wave function parameters. Same as dasktools.dist_lm_sampler.
+    """
+    if lm_sampler is None:
+        from pyqmc.linemin import lm_sampler
+
+    chunks = _partitions(client, configs, npartitions)
+    shared = client.share_configs(configs)
+    wfdesc = client.resident(wf)
+    accdesc = client.resident(pgrad_acc)
+    allruns = [
+        client.submit(_lm_sampler, lm_sampler, wfdesc, shared, chunk, params, accdesc)
+        for chunk in chunks
+    ]
+    stepresults = [r.result() for r in allruns]
+    return _merge_lm(stepresults, len(params))
+
+
+def line_minimization(*args, client, **kwargs):
+    import pyqmc
+
+    if "vmcoptions" not in kwargs:
+        kwargs["vmcoptions"] = {}
+    if "lmoptions" not in kwargs:
+        kwargs["lmoptions"] = {}
+    kwargs["vmcoptions"]["client"] = client
+    kwargs["lmoptions"]["client"] = client
+    return pyqmc.line_minimization(*args, vmc=distvmc, lm=dist_lm_sampler, **kwargs)
+
+
+def cvmc_optimize(*args, client, **kwargs):
+    import pyqmc
+    from pyqmc.cvmc import lm_cvmc
+
+    if "vmcoptions" not in kwargs:
+        kwargs["vmcoptions"] = {}
+    if "lmoptions" not in kwargs:
+        kwargs["lmoptions"] = {}
+    kwargs["vmcoptions"]["client"] = client
+    kwargs["lmoptions"]["client"] = client
+    kwargs["lmoptions"]["lm_sampler"] = lm_cvmc
+    return pyqmc.cvmc_optimize(*args, vmc=distvmc, lm=dist_lm_sampler, **kwargs)
+
+
+def distdmc_propagate(wf, configs, weights, *args, client, npartitions=None, **kwargs):
+    """ Same as dasktools.distdmc_propagate; configs and weights are updated in place. """
+    chunks = _partitions(client, configs, npartitions)
+    shared = client.share_configs(configs)
+    sharedweights = client.share_array("weights", weights)
+    wfdesc = client.resident(wf)
+    accumulators = kwargs.pop("accumulators")
+    accdesc = {k: client.resident(it) for k, it in accumulators.items()}
+    allruns = [
+        client.submit(
+            _dmc_propagate, wfdesc, shared, sharedweights, chunk, accdesc, args, kwargs
+        )
+        for chunk in chunks
+    ]
+    df = _merge_dmc([r.result() for r in allruns])
+    client.gather_configs(configs, shared)
+    weights[...] = client.shared_array(sharedweights)
+    return df, configs, weights
+
+
+def dist_sample_overlap(wfs, configs, pgrad, *args, client, npartitions=None, **kwargs):
+    chunks = _partitions(client, configs, npartitions)
+    shared = client.share_configs(configs)
+    wfdescs = [client.resident(wf) for wf in wfs]
+    pgraddesc = client.resident(pgrad)
+    allruns = [
+        client.submit(_sample_overlap, wfdescs, shared, chunk, pgraddesc, args, kwargs)
+        for chunk in chunks
+    ]
+    df = _merge_overlap([r.result() for r in allruns])
+    client.gather_configs(configs, shared)
+    return df, configs
+
+
+def dist_correlated_sample(wfs, configs, parameters, pgrad, *, client, npartitions=None):
+    chunks = _partitions(client, configs, npartitions)
+    shared = client.share_configs(configs)
+    wfdescs = [client.resident(wf) for wf in wfs]
+    pgraddesc = client.resident(pgrad)
+    allruns = [
+        client.submit(
+            _correlated_sample, wfdescs, shared, chunk, parameters, pgraddesc
+        )
+        for chunk in chunks
+    ]
+    return _merge_correlated([r.result() for r in allruns])
+
+
+def optimize_orthogonal(*args, client, **kwargs):
+    import pyqmc.optimize_orthogonal
+
+    if "sample_options" not in kwargs:
+        kwargs["sample_options"] = {}
+    if "correlated_options" not in kwargs:
+        kwargs["correlated_options"] = {}
+
+    kwargs["sample_options"]["client"] = client
+    kwargs["correlated_options"]["client"] = client
+
+    return pyqmc.optimize_orthogonal.optimize_orthogonal(
+        *args,
+        sampler=dist_sample_overlap,
+        correlated_sampler=dist_correlated_sample,
+        **kwargs
+    )
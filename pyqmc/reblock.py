@@ -97,6 +97,219 @@ def opt_block(df):
     return optimal_block
 
 
+class _BlockingLadder:
+    """
+    Running sums of one quantity at each level of the Flyvbjerg-Petersen blocking
+    transformation. Level l holds the means of blocks of 2**l consecutive samples.
+    """
+
+    def __init__(self):
+        self.sums = []
+        self.sumsqs = []
+        self.counts = []
+        self.pending = []
+
+    def add(self, x, level=0):
+        while True:
+            if level == len(self.counts):
+                self.sums.append(np.zeros_like(x))
+                self.sumsqs.append(np.zeros(x.shape))
+                self.counts.append(0)
+                self.pending.append(None)
+            self.sums[level] = self.sums[level] + x
+            self.sumsqs[level] = self.sumsqs[level] + np.abs(x) ** 2
+            self.counts[level] += 1
+            if self.pending[level] is None:
+                self.pending[level] = x
+                return
+            x = (self.pending[level] + x) / 2
+            self.pending[level] = None
+            level += 1
+
+    def mean(self):
+        return self.sums[0] / self.counts[0]
+
+    def standard_errors(self):
+        """ Standard error estimated at every level that has at least two blocks """
+        serr = []
+        for s, ssq, n in zip(self.sums, self.sumsqs, self.counts):
+            if n < 2:
+                break
+            var = (ssq / n - np.abs(s / n) ** 2) * n / (n - 1)
+            serr.append(np.sqrt(np.maximum(var, 0) / n))
+        return np.asarray(serr)
+
+    def summary(self):
+        """ Mean and error at the optimal blocking level, chosen as in opt_block() """
+        serr = self.standard_errors()
+        ndata = self.counts[0]
+        if len(serr) == 0:
+            return {
+                "mean": self.mean(),
+                "standard error": np.full(self.sums[0].shape, np.nan),
+                "standard error error": np.full(self.sums[0].shape, np.nan),
+                "reblocks": 0,
+                "nsamples": ndata,
+            }
+        levels = np.arange(len(serr)).reshape((-1,) + (1,) * (serr.ndim - 1))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            converged = 2 ** (3 * levels) >= 2 * ndata * (serr / serr[0]) ** 4
+        converged[-1] = True
+        opt = np.argmax(converged, axis=0)
+        best = np.take_along_axis(serr, opt[np.newaxis], axis=0)[0]
+        nblocks = np.asarray(self.counts)[opt]
+        return {
+            "mean": self.mean(),
+            "standard error": best,
+            "standard error error": best / np.sqrt(2 * (nblocks - 1)),
+            "reblocks": int(np.amax(opt)),
+            "nsamples": ndata,
+        }
+
+
+class OnlineBlocking:
+    """
+    Streaming version of optimally_reblocked(). Samples are added one step at a time
+    and only running sums for each level of the blocking transformation are kept,
+    so memory grows as log2 of the number of steps instead of linearly.
+
+    Pass one to vmc() or rundmc() as statistics= :
+
+      stats = OnlineBlocking()
+      vmc(wf, configs, accumulators=acc, statistics=stats, store_steps=False)
+      print(stats.summary())
+    """
+
+    def __init__(self):
+        self._ladders = {}
+
+    def add(self, data):
+        """ data is a dictionary of numbers or numpy arrays, for example one step of vmc() output. 
+        Missing quantities (None or a scalar NaN, see the intervals option of vmc()) are skipped. """
+        for k, it in data.items():
+            if it is None or (np.ndim(it) == 0 and np.isnan(it)):
+                continue
+            if k not in self._ladders:
+                self._ladders[k] = _BlockingLadder()
+            self._ladders[k].add(np.asarray(it))
+
+    def __len__(self):
+        if len(self._ladders) == 0:
+            return 0
+        return max(ladder.counts[0] for ladder in self._ladders.values())
+
+    def result(self, key):
+        """ Dictionary with the mean, standard error, standard error error, and 
+        number of reblocks for one key. Array-valued quantities return arrays. """
+        return self._ladders[key].summary()
+
+    def summary(self):
+        """
+        DataFrame with columns mean, standard error, standard error error, reblocks, and
+        nsamples and one row per key, like optimally_reblocked(). Array-valued quantities 
+        are stored as arrays in each cell.
+        """
+        return pd.DataFrame.from_dict(
+            {k: ladder.summary() for k, ladder in self._ladders.items()},
+            orient="index",
+        )
+
+
+def mser_warmup(x, min_samples=10):
+    """
+    Number of initial samples to discard from the trace x by the marginal standard error 
+    rule (White, Simulation 69, 323 (1997)): the truncation d that minimizes 
+    var(x[d:])/(len(x)-d). The last min_samples samples are always kept.
+    Returns None if the best truncation is in the second half of x, which means the 
+    trace has not equilibrated yet.
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if n < 2 * min_samples:
+        return None
+    tail = n - np.arange(n - min_samples + 1)
+    sums = np.cumsum(x[::-1])[::-1][: len(tail)]
+    sumsqs = np.cumsum(x[::-1] ** 2)[::-1][: len(tail)]
+    var = sumsqs / tail - (sums / tail) ** 2
+    d = int(np.argmin(var / tail))
+    if d > n // 2:
+        return None
+    return d
+
+
+class TargetError:
+    """
+    Decides when a run has reached a target standard error for one quantity.
+    Steps are added one at a time. Every check_every steps, the equilibration period 
+    is detected with mser_warmup() on the trace of key; once it is found, all later 
+    steps go into statistics (an OnlineBlocking), and the run is done when the reblocked 
+    standard error of key is at most target_error.
+
+    Until then, the trace and the steps are kept. If more than max_pending steps pile 
+    up without equilibration, the oldest half of them is discarded as warmup, so memory 
+    stays bounded however long equilibration takes.
+
+    vmc() and rundmc() build one from target_error= :
+
+      stats = OnlineBlocking()
+      vmc(wf, configs, nsteps=10000, accumulators=acc, statistics=stats, target_error=1e-3)
+      print(stats.summary())
+    """
+
+    def __init__(
+        self, key, target_error, check_every=10, statistics=None, max_pending=10000
+    ):
+        """
+        key: name of the quantity in the step data, such as "energytotal".
+        target_error: standard error to stop at.
+        check_every: number of steps between checks.
+        statistics: an OnlineBlocking that receives the steps after equilibration. 
+        max_pending: largest number of steps kept while equilibration is not detected.
+        """
+        self.key = key
+        self.target_error = target_error
+        self.check_every = check_every
+        self.statistics = OnlineBlocking() if statistics is None else statistics
+        self.max_pending = max_pending
+        self.warmup = None
+        self._trace = []
+        self._pending = []
+        self._discarded = 0
+        self._nsteps = 0
+        self._last_check = 0
+
+    def add(self, data):
+        self._nsteps += 1
+        if self.warmup is not None:
+            self.statistics.add(data)
+            return
+        self._trace.append(np.real(data[self.key]))
+        self._pending.append(data)
+        if len(self._pending) > self.max_pending:
+            half = len(self._pending) // 2
+            self._trace = self._trace[half:]
+            self._pending = self._pending[half:]
+            self._discarded += half
+
+    def done(self):
+        """ True if the target error has been reached. Only checks every check_every steps. 
+        Once equilibration is detected, warmup is the number of steps before it. """
+        if self._nsteps - self._last_check < self.check_every:
+            return False
+        self._last_check = self._nsteps
+        if self.warmup is None:
+            warmup = mser_warmup(self._trace)
+            if warmup is None:
+                return False
+            self.warmup = self._discarded + warmup
+            for data in self._pending[warmup:]:
+                self.statistics.add(data)
+            self._trace = []
+            self._pending = []
+        error = self.statistics.result(self.key)["standard error"]
+        return bool(error <= self.target_error)
+
+
 def test_reblocking():
     """
         Tests reblocking against known distribution.
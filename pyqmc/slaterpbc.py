@@ -1,5 +1,6 @@
 import numpy as np
 from pyqmc import pbc, slateruhf
+from pyqmc.coord import WalkerPool
 
 
 def get_supercell_kpts(supercell):
@@ -77,6 +78,7 @@ class PySCFSlaterPBC:
 
         self.occ = np.asarray(mf.mo_occ) > 0.9
         self.parameters = {}
+        self._pool = WalkerPool()
         self.real_tol = 1e4
 
         self.supercell = supercell
@@ -122,7 +124,8 @@ class PySCFSlaterPBC:
         mycoords = mycoords.reshape((-1, mycoords.shape[-1]))
         # wrap supercell positions into primitive cell
         prim_coords, prim_wrap = pbc.enforce_pbc(self._cell.lattice_vectors(), mycoords)
-        configswrap = configs.wrap.reshape(prim_wrap.shape)
+        configswrap = configs.wrap if mask is None else configs.wrap[mask]
+        configswrap = configswrap.reshape(prim_wrap.shape)
         wrap = prim_wrap + np.dot(configswrap, self.supercell.S)
         kdotR = np.linalg.multi_dot(
             (self._kpts, self._cell.lattice_vectors().T, wrap.T)
@@ -142,6 +145,11 @@ class PySCFSlaterPBC:
         self._aovals = aos
         self._dets = []
         self._inverse = []
+        # Cache of MO values and derivatives at each electron's current position,
+        # filled by testvalue_gradient()/updateinternals() and invalidated here.
+        self._mograd = [np.zeros((4, nconf, n, n), dtype=complex) for n in self._nelec]
+        self._mograd_valid = np.zeros((nconf, nelec), dtype=bool)
+        self._proposal = None
         for s in [0, 1]:
             mo = []
             i0, i1 = s * self._nelec[0], self._nelec[0] + s * self._nelec[1]
@@ -161,19 +169,69 @@ class PySCFSlaterPBC:
         if mask is None:
             mask = [True] * epos.configs.shape[0]
         eeff = e - s * self._nelec[0]
-        aos = self.evaluate_orbitals(epos)
-        self._aovals[:, :, e, :] = np.asarray(aos)
-        mo = []
-        for k in range(self.nk):
-            mo_coeff = self.parameters[self._coefflookup[s]][k]
-            mo.append(np.dot(aos[k], mo_coeff))
-        ne = self._nelec[s]
-        mo = np.concatenate(mo, axis=-1).reshape(len(mask), ne)
+        proposal, self._proposal = self._proposal, None
+        if proposal is not None and proposal[0] == e and proposal[1] is epos:
+            # Reuse the orbitals evaluated by testvalue_gradient() for this move
+            aograd, mograd = proposal[2:]
+            aos = [ak[0] for ak in aograd]
+            mo = mograd[0]
+            self._mograd[s][:, mask, eeff, :] = mograd[:, mask]
+            self._mograd_valid[mask, e] = True
+        else:
+            aos = self.evaluate_orbitals(epos)
+            mo = []
+            for k in range(self.nk):
+                mo_coeff = self.parameters[self._coefflookup[s]][k]
+                mo.append(np.dot(aos[k], mo_coeff))
+            ne = self._nelec[s]
+            mo = np.concatenate(mo, axis=-1).reshape(len(mask), ne)
+            self._mograd_valid[mask, e] = False
+        self._aovals[:, mask, e, :] = np.asarray(aos)[:, mask]
         ratio, self._inverse[s][mask, :, :] = slateruhf.sherman_morrison_row(
             eeff, self._inverse[s][mask, :, :], mo[mask, :]
         )
         self._updateval(ratio, s, mask)
 
+    def resample(self, newinds):
+        """Reorder the walkers by newinds (for example after DMC branching), so that the 
+        internal state matches configs.resample(newinds) without a recompute()."""
+        take = self._pool.take
+        self._aovals = take("aovals", self._aovals, newinds, axis=1)
+        self._dets = [
+            (take(("phase", s), phase, newinds), take(("logdet", s), mag, newinds))
+            for s, (phase, mag) in enumerate(self._dets)
+        ]
+        self._inverse = [
+            take(("inverse", s), inv, newinds) for s, inv in enumerate(self._inverse)
+        ]
+        self._mograd = [
+            take(("mograd", s), mograd, newinds, axis=1)
+            for s, mograd in enumerate(self._mograd)
+        ]
+        self._mograd_valid = take("mograd_valid", self._mograd_valid, newinds)
+        self._proposal = None
+
+    def save_state(self):
+        """The walker-indexed internal state, for restore_state(). The arrays are not 
+        copied: recompute() replaces them rather than writing into them, so the state 
+        stays valid across recompute(), but not across updateinternals() or resample()."""
+        return (self._aovals, self._dets, self._inverse, self._mograd, self._mograd_valid)
+
+    def restore_state(self, state, mask, rows=None):
+        """Set the internal state of the walkers in mask back to state, as returned by 
+        save_state(). rows selects the walkers of state to use, and defaults to mask 
+        for a state of the same walkers."""
+        rows = mask if rows is None else rows
+        aovals, dets, inverse, mograd, mograd_valid = state
+        self._aovals[:, mask] = aovals[:, rows]
+        for s, (phase, mag) in enumerate(dets):
+            self._dets[s][0][mask] = phase[rows]
+            self._dets[s][1][mask] = mag[rows]
+            self._inverse[s][mask] = inverse[s][rows]
+            self._mograd[s][:, mask] = mograd[s][:, rows]
+        self._mograd_valid[mask] = mograd_valid[rows]
+        self._proposal = None
+
     # identical to slateruhf
     def _updateval(self, ratio, s, mask):
         self._dets[s][0][mask] *= self.get_phase(ratio)  # will not work for complex!
@@ -220,6 +278,25 @@ class PySCFSlaterPBC:
         mo = np.concatenate(mo, axis=-1).reshape(nmask, self._nelec[s])
         return self._testrow(e, mo, mask)
 
+    def testvalue_gradient(self, e, epos, mask=None):
+        """ return the ratio between the current wave function and the wave function if
+        electron e's position is replaced by epos, and the gradient of the log wave function
+        at epos. Both come from the same AO evaluation."""
+        s = int(e >= self._nelec[0])
+        if mask is None:
+            mask = [True] * epos.configs.shape[0]
+        nmask = np.sum(mask)
+        if nmask == 0:
+            return np.zeros(0), np.zeros((3, 0))
+        aograd = self.evaluate_orbitals(epos, mask, eval_str="PBCGTOval_sph_deriv1")
+        mo_coeff = self.parameters[self._coefflookup[s]]
+        mograd = [ak.dot(mo_coeff[k]) for k, ak in enumerate(aograd)]
+        mograd = np.concatenate(mograd, axis=-1)
+        if nmask == epos.configs.shape[0]:
+            self._proposal = (e, epos, aograd, mograd)
+        ratios = np.asarray([self._testrow(e, x, mask) for x in mograd])
+        return ratios[0], ratios[1:] / ratios[:1]
+
     def gradient(self, e, epos):
         """ Compute the gradient of the log wave function 
         Note that this can be called even if the internals have not been updated for electron e,
@@ -232,6 +309,49 @@ class PySCFSlaterPBC:
         ratios = np.asarray([self._testrow(e, x) for x in mograd])
         return ratios[1:] / ratios[:1]
 
+    def gradient_current(self, e, epos):
+        """ Compute the gradient of the log wave function for electron e at its current
+        position epos, using the cached MO derivatives where they are valid."""
+        s = int(e >= self._nelec[0])
+        eeff = e - s * self._nelec[0]
+        stale = ~self._mograd_valid[:, e]
+        if np.any(stale):
+            aograd = self.evaluate_orbitals(
+                epos, stale, eval_str="PBCGTOval_sph_deriv1"
+            )
+            mo_coeff = self.parameters[self._coefflookup[s]]
+            mograd = [ak.dot(mo_coeff[k]) for k, ak in enumerate(aograd)]
+            self._mograd[s][:, stale, eeff, :] = np.concatenate(mograd, axis=-1)
+            self._mograd_valid[stale, e] = True
+        ratios = np.asarray([self._testrow(e, x) for x in self._mograd[s][:, :, eeff]])
+        return ratios[1:] / ratios[:1]
+
+    def gradient_all(self, configs):
+        """ Compute the gradient of the log wave function for every electron at its current
+        position, as a (3, nconf, nelec) array, using the cached MO derivatives where they 
+        are valid and one orbital evaluation for the rest."""
+        stale = ~self._mograd_valid
+        if np.any(stale):
+            c, e = np.nonzero(stale)
+            aograd = self.evaluate_orbitals(
+                configs, stale, eval_str="PBCGTOval_sph_deriv1"
+            )
+            for s in [0, 1]:
+                sel = (e >= self._nelec[0]) == s
+                mo_coeff = self.parameters[self._coefflookup[s]]
+                mograd = [ak[:, sel].dot(mo_coeff[k]) for k, ak in enumerate(aograd)]
+                mograd = np.concatenate(mograd, axis=-1)
+                self._mograd[s][:, c[sel], e[sel] - s * self._nelec[0], :] = mograd
+            self._mograd_valid[:] = True
+        ratios = np.concatenate(
+            [
+                np.einsum("dcej,cje->dce", mograd, inverse)
+                for mograd, inverse in zip(self._mograd, self._inverse)
+            ],
+            axis=2,
+        )
+        return ratios[1:] / ratios[:1]
+
     def laplacian(self, e, epos):
         s = int(e >= self._nelec[0])
         ao = self.evaluate_orbitals(epos, eval_str="PBCGTOval_sph_deriv2")
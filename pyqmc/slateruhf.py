@@ -1,4 +1,5 @@
 import numpy as np
+from pyqmc.coord import WalkerPool
 
 
 def sherman_morrison_row(e, inv, vec):
@@ -26,6 +27,7 @@ class PySCFSlaterUHF:
         """
         self.occ = np.asarray(mf.mo_occ) > 0.9
         self.parameters = {}
+        self._pool = WalkerPool()
         self.real_tol = 1e4
         if np.linalg.norm(twist) == 0:
             self.single_twist = lambda e, c: 1
@@ -122,6 +124,12 @@ class PySCFSlaterUHF:
         self._aovals = ao
         self._dets = []
         self._inverse = []
+        # Cache of MO values and derivatives at each electron's current position,
+        # filled by testvalue_gradient()/updateinternals() and invalidated here.
+        dtype = np.result_type(ao, *[self.parameters[k] for k in self._coefflookup])
+        self._mograd = [np.zeros((4, nconf, n, n), dtype=dtype) for n in self._nelec]
+        self._mograd_valid = np.zeros((nconf, nelec), dtype=bool)
+        self._proposal = None
         for s in [0, 1]:
             if s == 0:
                 mo = ao[:, 0 : self._nelec[0], :].dot(
@@ -149,15 +157,73 @@ class PySCFSlaterUHF:
         if mask is None:
             mask = [True] * epos.configs.shape[0]
         eeff = e - s * self._nelec[0]
-        ao = self._mol.eval_gto(self.pbc_str + "GTOval_sph", epos.configs)
-        self._aovals[:, e, :] = ao
-        mo = ao.dot(self.parameters[self._coefflookup[s]])
+        proposal, self._proposal = self._proposal, None
+        if proposal is not None and proposal[0] == e and proposal[1] is epos:
+            # Reuse the AOs evaluated by testvalue_gradient() for this move
+            aograd, mograd = proposal[2:]
+            ao, mo = aograd[0], mograd[0]
+            self._mograd[s][:, mask, eeff, :] = mograd[:, mask]
+            self._mograd_valid[mask, e] = True
+        else:
+            ao = self._mol.eval_gto(self.pbc_str + "GTOval_sph", epos.configs)
+            mo = ao.dot(self.parameters[self._coefflookup[s]])
+            self._mograd_valid[mask, e] = False
+        self._aovals[mask, e, :] = ao[mask]
         ratio, self._inverse[s][mask, :, :] = sherman_morrison_row(
             eeff, self._inverse[s][mask, :, :], mo[mask, :]
         )
         ratio *= self.single_twist_mask(e, epos, mask)
         self._updateval(ratio, s, mask)
 
+    def resample(self, newinds):
+        """Reorder the walkers by newinds (for example after DMC branching), so that the 
+        internal state matches configs.resample(newinds) without a recompute()."""
+        take = self._pool.take
+        self.wrap = take("wrap", self.wrap, newinds)
+        self._aovals = take("aovals", self._aovals, newinds)
+        self._dets = [
+            (take(("phase", s), phase, newinds), take(("logdet", s), mag, newinds))
+            for s, (phase, mag) in enumerate(self._dets)
+        ]
+        self._inverse = [
+            take(("inverse", s), inv, newinds) for s, inv in enumerate(self._inverse)
+        ]
+        self._mograd = [
+            take(("mograd", s), mograd, newinds, axis=1)
+            for s, mograd in enumerate(self._mograd)
+        ]
+        self._mograd_valid = take("mograd_valid", self._mograd_valid, newinds)
+        self._proposal = None
+
+    def save_state(self):
+        """The walker-indexed internal state, for restore_state(). The arrays are not 
+        copied: recompute() replaces them rather than writing into them, so the state 
+        stays valid across recompute(), but not across updateinternals() or resample()."""
+        return (
+            self.wrap,
+            self._aovals,
+            self._dets,
+            self._inverse,
+            self._mograd,
+            self._mograd_valid,
+        )
+
+    def restore_state(self, state, mask, rows=None):
+        """Set the internal state of the walkers in mask back to state, as returned by 
+        save_state(). rows selects the walkers of state to use, and defaults to mask 
+        for a state of the same walkers."""
+        rows = mask if rows is None else rows
+        wrap, aovals, dets, inverse, mograd, mograd_valid = state
+        self.wrap[mask] = wrap[rows]
+        self._aovals[mask] = aovals[rows]
+        for s, (phase, mag) in enumerate(dets):
+            self._dets[s][0][mask] = phase[rows]
+            self._dets[s][1][mask] = mag[rows]
+            self._inverse[s][mask] = inverse[s][rows]
+            self._mograd[s][:, mask] = mograd[s][:, rows]
+        self._mograd_valid[mask] = mograd_valid[rows]
+        self._proposal = None
+
     ### not state-changing functions
 
     def value(self):
@@ -196,11 +262,52 @@ class PySCFSlaterUHF:
         Note that this can be called even if the internals have not been updated for electron e,
         if epos differs from the current position of electron e."""
         s = int(e >= self._nelec[0])
-        aograd = self._mol.eval_gto("GTOval_sph_deriv1", epos.configs)
+        aograd = self._mol.eval_gto(self.pbc_str + "GTOval_sph_deriv1", epos.configs)
         mograd = aograd.dot(self.parameters[self._coefflookup[s]])
         ratios = np.asarray([self._testrow(e, x) for x in mograd])
         return ratios[1:] / ratios[:1]
 
+    def gradient_current(self, e, epos):
+        """ Compute the gradient of the log wave function for electron e at its current
+        position epos. MO derivatives are taken from the per-electron cache where it is valid,
+        so usually only the contraction with the current inverse is done here."""
+        s = int(e >= self._nelec[0])
+        eeff = e - s * self._nelec[0]
+        stale = ~self._mograd_valid[:, e]
+        if np.any(stale):
+            aograd = self._mol.eval_gto(
+                self.pbc_str + "GTOval_sph_deriv1", epos.configs[stale]
+            )
+            mograd = aograd.dot(self.parameters[self._coefflookup[s]])
+            self._mograd[s][:, stale, eeff, :] = mograd
+            self._mograd_valid[stale, e] = True
+        ratios = np.asarray([self._testrow(e, x) for x in self._mograd[s][:, :, eeff]])
+        return ratios[1:] / ratios[:1]
+
+    def gradient_all(self, configs):
+        """ Compute the gradient of the log wave function for every electron at its current
+        position, as a (3, nconf, nelec) array. MO derivatives missing from the cache are 
+        evaluated in one call for all the electrons."""
+        stale = ~self._mograd_valid
+        if np.any(stale):
+            c, e = np.nonzero(stale)
+            aograd = self._mol.eval_gto(
+                self.pbc_str + "GTOval_sph_deriv1", configs.configs[c, e]
+            )
+            for s in [0, 1]:
+                sel = (e >= self._nelec[0]) == s
+                mograd = aograd[:, sel].dot(self.parameters[self._coefflookup[s]])
+                self._mograd[s][:, c[sel], e[sel] - s * self._nelec[0], :] = mograd
+            self._mograd_valid[:] = True
+        ratios = np.concatenate(
+            [
+                np.einsum("dcej,cje->dce", mograd, inverse)
+                for mograd, inverse in zip(self._mograd, self._inverse)
+            ],
+            axis=2,
+        )
+        return ratios[1:] / ratios[:1]
+
     def laplacian(self, e, epos):
         s = int(e >= self._nelec[0])
         ao = self._mol.eval_gto(self.pbc_str + "GTOval_sph_deriv2", epos.configs)[
@@ -238,6 +345,24 @@ class PySCFSlaterUHF:
         b = self.single_twist_mask(e, epos, mask)
         return a * b
 
+    def testvalue_gradient(self, e, epos, mask=None):
+        """ return the ratio between the current wave function and the wave function if
+        electron e's position is replaced by epos, and the gradient of the log wave function
+        at epos. Both come from the same AO evaluation."""
+        s = int(e >= self._nelec[0])
+        if mask is None:
+            mask = [True] * epos.configs.shape[0]
+        eposmask = epos.configs[mask]
+        if len(eposmask) == 0:
+            return np.zeros(0), np.zeros((3, 0))
+        aograd = self._mol.eval_gto(self.pbc_str + "GTOval_sph_deriv1", eposmask)
+        mograd = aograd.dot(self.parameters[self._coefflookup[s]])
+        if len(eposmask) == len(epos.configs):
+            self._proposal = (e, epos, aograd, mograd)
+        ratios = np.asarray([self._testrow(e, x, mask) for x in mograd])
+        testvalue = ratios[0] * self.single_twist_mask(e, epos, mask)
+        return testvalue, ratios[1:] / ratios[:1]
+
     def testvalue_many(self, e, epos, mask=None):
         """ return the ratio between the current wave function and the wave function if 
         an electron's position is replaced by epos for each electron"""
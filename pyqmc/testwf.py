@@ -63,6 +63,162 @@ def test_updateinternals(wf, configs):
     }
 
 
+def test_testvalue_gradient(wf, configs, delta=1e-2):
+    """
+    Parameters:
+        wf: a wave function object to be tested
+        configs: nconf x nelec x 3 position array to set the wf object
+        delta: how far to move each electron from its current position
+
+    Tests wf.testvalue_gradient(e,epos) against separate calls to wf.testvalue(e,epos) and wf.gradient(e,epos),
+    with and without a mask.
+
+    Returns:
+        dictionary of maximum absolute errors
+    """
+    nconf, nelec = configs.configs.shape[0:2]
+    wf.recompute(configs)
+    mask = np.random.randint(0, 2, nconf).astype(bool)
+    valerror = 0
+    graderror = 0
+    for e in range(nelec):
+        epos = configs.make_irreducible(e, configs.configs[:, e, :] + delta)
+        val, grad = wf.testvalue_gradient(e, epos)
+        valerror = max(valerror, np.amax(np.abs(val - wf.testvalue(e, epos))))
+        graderror = max(graderror, np.amax(np.abs(grad - wf.gradient(e, epos))))
+        val, grad = wf.testvalue_gradient(e, epos, mask)
+        valerror = max(
+            valerror, np.amax(np.abs(val - wf.testvalue(e, epos)[mask]), initial=0)
+        )
+        graderror = max(
+            graderror, np.amax(np.abs(grad - wf.gradient(e, epos)[:, mask]), initial=0)
+        )
+    return {"testvalue": valerror, "gradient": graderror}
+
+
+def test_gradient_current(wf, configs, delta=1e-1, nsweeps=2):
+    """
+    Parameters:
+        wf: a wave function object to be tested
+        configs: nconf x nelec x 3 position array to set the wf object
+        delta: how far to move each electron in a proposed move
+        nsweeps: number of sweeps of partially accepted moves
+
+    Tests wf.gradient_current(e,epos), and wf.gradient_all(configs) if wf has it, against 
+    wf.gradient(e,epos) at the current positions while moves proposed with 
+    wf.testvalue_gradient() are accepted on a random subset of walkers.
+
+    Returns:
+        maximum absolute error
+    """
+    configs = configs.copy()
+    nconf, nelec = configs.configs.shape[0:2]
+    wf.recompute(configs)
+    error = 0
+    for sweep in range(nsweeps):
+        if hasattr(wf, "gradient_all"):
+            grad = np.stack(
+                [wf.gradient(e, configs.electron(e)) for e in range(nelec)], axis=-1
+            )
+            error = max(error, np.amax(np.abs(wf.gradient_all(configs) - grad)))
+        for e in range(nelec):
+            epos = configs.electron(e)
+            grad = wf.gradient_current(e, epos)
+            error = max(error, np.amax(np.abs(grad - wf.gradient(e, epos))))
+            newepos = configs.make_irreducible(
+                e, configs.configs[:, e, :] + delta * np.random.randn(nconf, 3)
+            )
+            wf.testvalue_gradient(e, newepos)
+            accept = np.random.randint(0, 2, nconf).astype(bool)
+            configs.move(e, newepos, accept)
+            wf.updateinternals(e, newepos, mask=accept)
+    return error
+
+
+def test_resample(wf, configs, delta=1e-1):
+    """
+    Parameters:
+        wf: a wave function object to be tested
+        configs: nconf x nelec x 3 position array to set the wf object
+        delta: how far to move each electron before resampling
+
+    Moves every electron on a random subset of walkers, resamples the walkers with 
+    wf.resample() and configs.resample() to a larger and then a smaller population, 
+    then compares the value and gradient_current() to a recompute() of the resampled 
+    configurations.
+
+    Returns:
+        dictionary of maximum absolute errors
+    """
+    configs = configs.copy()
+    nconf, nelec = configs.configs.shape[0:2]
+    wf.recompute(configs)
+    for e in range(nelec):
+        newepos = configs.make_irreducible(
+            e, configs.configs[:, e, :] + delta * np.random.randn(nconf, 3)
+        )
+        wf.testvalue_gradient(e, newepos)
+        accept = np.random.randint(0, 2, nconf).astype(bool)
+        configs.move(e, newepos, accept)
+        wf.updateinternals(e, newepos, mask=accept)
+    # Grow and then shrink the population, as birth/death branching does
+    for nnew in [nconf + nconf // 2, nconf // 2]:
+        newinds = np.random.randint(0, configs.configs.shape[0], nnew)
+        configs.resample(newinds)
+        wf.resample(newinds)
+    phase, val = wf.value()
+    grads = [wf.gradient_current(e, configs.electron(e)) for e in range(nelec)]
+    refphase, refval = copy.deepcopy(wf).recompute(configs)
+    graderror = max(
+        np.amax(np.abs(g - wf.gradient(e, configs.electron(e))))
+        for e, g in enumerate(grads)
+    )
+    return {
+        "value": np.amax(np.abs(val - refval)),
+        "phase": np.amax(np.abs(phase - refphase)),
+        "gradient_current": graderror,
+    }
+
+def test_restore_state(wf, configs, delta=1e-1):
+    """
+    Parameters:
+        wf: a wave function object to be tested
+        configs: nconf x nelec x 3 position array to set the wf object
+        delta: how far to move each electron
+
+    Saves the state with wf.save_state(), recomputes at moved configurations, then 
+    restores a random subset of walkers with wf.restore_state(), as all_electron_move() 
+    does for rejected walkers. Compares the value and gradient_current() to a recompute() 
+    of the merged configurations.
+
+    Returns:
+        dictionary of maximum absolute errors
+    """
+    configs = configs.copy()
+    nconf, nelec = configs.configs.shape[0:2]
+    wf.recompute(configs)
+    saved = wf.save_state()
+    newconfigs = configs.make_irreducible_all(
+        configs.configs + delta * np.random.randn(nconf, nelec, 3)
+    )
+    wf.recompute(newconfigs)
+    restore = np.random.randint(0, 2, nconf).astype(bool)
+    wf.restore_state(saved, restore)
+    configs.move_all(newconfigs, ~restore)
+    phase, val = wf.value()
+    grads = [wf.gradient_current(e, configs.electron(e)) for e in range(nelec)]
+    refphase, refval = copy.deepcopy(wf).recompute(configs)
+    graderror = max(
+        np.amax(np.abs(g - wf.gradient(e, configs.electron(e))))
+        for e, g in enumerate(grads)
+    )
+    return {
+        "value": np.amax(np.abs(val - refval)),
+        "phase": np.amax(np.abs(phase - refphase)),
+        "gradient_current": graderror,
+    }
+
+
 def test_wf_gradient(wf, configs, delta=1e-5):
     """ 
     Parameters:
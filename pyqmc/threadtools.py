@@ -0,0 +1,112 @@
+import os
+
+os.environ["MKL_NUM_THREADS"] = "1"
+os.environ["NUMEXPR_NUM_THREADS"] = "1"
+os.environ["OMP_NUM_THREADS"] = "1"
+import copy
+import h5py
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import pyqmc.hdftools as hdftools
+from pyqmc.mc import vmc
+
+
+def merge_steps(partition_data):
+    """
+    Average the step dictionaries of several partitions, step by step, as distvmc does.
+    partition_data is a list (one per partition) of lists of dictionaries with the same steps.
+    """
+    merged = []
+    for steps in zip(*partition_data):
+        merged.append(
+            {k: np.mean([np.asarray(d[k]) for d in steps], axis=0) for k in steps[0]}
+        )
+    return merged
+
+
+def vmc_threaded(
+    wf,
+    coords,
+    accumulators=None,
+    nsteps=100,
+    hdf_file=None,
+    nthreads=None,
+    nsteps_per=None,
+    verbose=False,
+    **kwargs
+):
+    """
+    Run vmc() on nthreads partitions of the walkers at once, in a thread pool in this process.
+    NumPy releases the GIL in the heavy linear algebra, so the partitions run concurrently
+    without any serialization of the wave function or the walkers.
+
+    Args:
+      wf: a wave function object. It is copied once per thread.
+
+      coords: configurations; nconf must be divisible by nthreads. Updated with the final positions.
+
+      accumulators: as in vmc(). They are copied once per thread.
+
+      nsteps: how many steps to move each walker
+
+      hdf_file: merged steps and the configurations are written here, as in distvmc.
+
+      nthreads: number of partitions and threads. Defaults to os.cpu_count().
+
+      nsteps_per: number of steps between merging results and writing to hdf_file. Defaults to nsteps.
+
+      kwargs: passed to vmc()
+
+    Returns: (df, coords) like vmc(), with each step averaged over the partitions.
+    """
+    if nsteps_per is None:
+        nsteps_per = nsteps
+    if nthreads is None:
+        nthreads = os.cpu_count()
+    if accumulators is None:
+        accumulators = {}
+
+    if hdf_file is not None:
+        with h5py.File(hdf_file, "a") as hdf:
+            if "configs" in hdf.keys():
+                coords.configs = np.array(hdf["configs"])
+                if verbose:
+                    print("Restarted calculation")
+
+    writer = hdftools.HDFWriter(hdf_file, kwargs, buffer_size=nsteps_per)
+    try:
+        wfs = [copy.deepcopy(wf) for i in range(nthreads)]
+        accs = [copy.deepcopy(accumulators) for i in range(nthreads)]
+        coord = coords.split(nthreads)
+        niterations = int(nsteps / nsteps_per)
+        alldata = []
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            for epoch in range(niterations):
+                runs = [
+                    executor.submit(
+                        vmc,
+                        wfs[i],
+                        coord[i],
+                        nsteps=nsteps_per,
+                        accumulators=accs[i],
+                        stepoffset=epoch * nsteps_per,
+                        **kwargs
+                    )
+                    for i in range(nthreads)
+                ]
+                iterdata = []
+                for i, r in enumerate(runs):
+                    df, coord[i] = r.result()
+                    iterdata.append(df)
+                collected_data = merge_steps(iterdata)
+                if verbose:
+                    print("epoch", epoch, "finished", flush=True)
+
+                coords.join(coord)
+                alldata.extend(collected_data)
+                for d in collected_data:
+                    writer.append(d, {"configs": coords.configs})
+    finally:
+        writer.close()
+
+    return alldata, coords
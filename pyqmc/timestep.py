@@ -0,0 +1,153 @@
+import pickle
+import cloudpickle
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from pyqmc import reblock
+
+
+def extrapolate(tsteps, energies, errors, order=1):
+    """
+    Weighted least-squares fit of energies(tstep) to a polynomial of the given order.
+
+    Returns:
+      a dictionary with "energy" and "error", the tstep -> 0 value and its standard error,
+      "coefficients" of the polynomial in increasing order, and "covariance" of the coefficients.
+    """
+    tsteps, energies, errors = [np.asarray(x, dtype=float) for x in (tsteps, energies, errors)]
+    assert len(tsteps) > order, "Need more time steps than the order of the fit"
+    A = np.vander(tsteps, order + 1, increasing=True)
+    w = 1.0 / errors ** 2
+    covariance = np.linalg.inv(np.einsum("ij,i,ik->jk", A, w, A))
+    coefficients = covariance.dot(np.einsum("ij,i,i->j", A, w, energies))
+    return {
+        "energy": coefficients[0],
+        "error": np.sqrt(covariance[0, 0]),
+        "coefficients": coefficients,
+        "covariance": covariance,
+    }
+
+
+def _run_tstep(payload):
+    """
+    Runs rundmc() for one time step in a worker. payload is the cloudpickled tuple 
+    (wf, configs, tstep, nsteps, nwarmup, seed, energy, kwargs), since wave functions may 
+    hold lambdas. Returns the rundmc() data and the reblocked energy and error of the 
+    steps after the first nwarmup.
+    """
+    from pyqmc.dmc import rundmc
+
+    wf, configs, tstep, nsteps, nwarmup, seed, energy, kwargs = pickle.loads(payload)
+    np.random.seed(seed)
+    if kwargs.get("store_steps", True):
+        df, configs, weights = rundmc(wf, configs, tstep=tstep, nsteps=nsteps, **kwargs)
+        production = df[df["step"] >= nwarmup]
+        rb = reblock.optimally_reblocked(production[[energy]])
+        return df, rb["mean"][energy], rb["standard error"][energy]
+
+    # The summary of a run has no steps to discard, so the warmup is a separate run
+    warmup_kwargs = dict(kwargs, hdf_file=None, statistics=None)
+    df, configs, weights = rundmc(
+        wf, configs, tstep=tstep, nsteps=nwarmup, **warmup_kwargs
+    )
+    df, configs, weights = rundmc(
+        wf,
+        configs,
+        weights,
+        tstep=tstep,
+        nsteps=nsteps - nwarmup,
+        stepoffset=nwarmup,
+        **kwargs,
+    )
+    return df, df["mean"][energy], df["standard error"][energy]
+
+
+def timestep_extrapolation(
+    wf,
+    configs,
+    tsteps,
+    total_time,
+    warmup_time=None,
+    ekey=("energy", "total"),
+    order=1,
+    client=None,
+    hdf_files=None,
+    seed=None,
+    **kwargs
+):
+    """
+    Run rundmc() at several time steps concurrently from the same (equilibrated) walkers,
+    and extrapolate the energy to zero time step.
+    Every run covers the same imaginary time, so it takes total_time/tstep steps.
+
+    Args:
+      wf: a wave function; each run gets its own copy.
+
+      configs: starting walkers, for example the end of a VMC run. Each run gets its own copy.
+
+      tsteps: list of time steps.
+
+      total_time: imaginary time of each run.
+
+      warmup_time: imaginary time discarded from the beginning of each run before reblocking. Defaults to total_time/10.
+
+      ekey: as in rundmc().
+
+      order: order of the polynomial in tstep fitted by extrapolate().
+
+      client: anything with submit(f, *args) that returns a future with result(), such as a dask Client, a processtools.LocalClient, or a concurrent.futures executor. Defaults to one process per time step. The runs use numpy's global random number generator, so threads would share it and could not be made reproducible.
+
+      hdf_files: optional list of hdf files, one per time step, passed to rundmc().
+
+      seed: If given, run i seeds the random number generator with seed+i. Otherwise the seeds are drawn from numpy's global random number generator, so np.random.seed() before the call also makes the runs reproducible.
+
+      kwargs: passed to rundmc(), for example accumulators. With store_steps=False, each run is split into a warmup run and a production run, and only the production run is reblocked and written to hdf_files.
+
+    Returns:
+      a dictionary with "summary", a DataFrame with the tstep, nsteps, reblocked energy and
+      its standard error of each run; "dfs", the rundmc() data of each run (of its production 
+      run if store_steps is False); and "extrapolated", the result of extrapolate().
+    """
+    tsteps = np.asarray(tsteps, dtype=float)
+    if warmup_time is None:
+        warmup_time = total_time / 10
+    if hdf_files is None:
+        hdf_files = [None] * len(tsteps)
+    nsteps = [int(np.round(total_time / tstep)) for tstep in tsteps]
+    energy = ekey[0] + ekey[1]
+    if seed is None:
+        seeds = np.random.randint(2 ** 31, size=len(tsteps))
+    else:
+        seeds = seed + np.arange(len(tsteps))
+
+    executor = None
+    if client is None:
+        client = executor = ProcessPoolExecutor(max_workers=len(tsteps))
+    # Start the longest runs first, so the wall time is that of the slowest run.
+    # Each run unpickles its own copy of wf, configs and the accumulators, which
+    # may cache walker data (such as Ewald.structure_factor()).
+    futures = {}
+    for i in np.argsort(tsteps):
+        runkwargs = dict(kwargs, ekey=ekey, hdf_file=hdf_files[i])
+        nwarmup = int(np.round(warmup_time / tsteps[i]))
+        payload = (wf, configs, tsteps[i], nsteps[i], nwarmup, int(seeds[i]), energy)
+        futures[i] = client.submit(
+            _run_tstep, cloudpickle.dumps(payload + (runkwargs,))
+        )
+    results = [futures[i].result() for i in range(len(tsteps))]
+    if executor is not None:
+        executor.shutdown()
+
+    dfs = [df for df, e, err in results]
+    rows = [
+        {"tstep": tstep, "nsteps": n, "energy": e, "error": err}
+        for tstep, n, (df, e, err) in zip(tsteps, nsteps, results)
+    ]
+    summary = pd.DataFrame(rows)
+    return {
+        "summary": summary,
+        "dfs": dfs,
+        "extrapolated": extrapolate(
+            summary["tstep"], summary["energy"], summary["error"], order
+        ),
+    }
@@ -0,0 +1,63 @@
+import time
+import contextlib
+import numpy as np
+
+
+class PhaseTimer:
+    """
+    Records wall time and number of calls for named phases of a calculation.
+    Pass one to vmc(), dmc_propagate(), or rundmc() as timer= to see where the time goes:
+
+      timer = PhaseTimer()
+      vmc(wf, configs, accumulators=acc, timer=timer)
+      print(timer.summary())
+
+    Phases are timed with
+
+      with timer("gradient"):
+          ...
+    """
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def __call__(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.times[phase] = self.times.get(phase, 0.0) + elapsed
+            self.counts[phase] = self.counts.get(phase, 0) + 1
+
+    def summary(self):
+        """ Returns a DataFrame with the total time, number of calls, and time per call for each phase,
+        sorted by total time."""
+        import pandas as pd
+
+        df = pd.DataFrame(
+            {
+                "time": pd.Series(self.times, dtype=float),
+                "calls": pd.Series(self.counts, dtype=int),
+            }
+        )
+        df["time_per_call"] = df["time"] / df["calls"]
+        return df.sort_values("time", ascending=False)
+
+    def to_hdf(self, hdf, group="timing"):
+        """ Write the phase times and call counts into group of an open h5py File,
+        replacing any previous timing information."""
+        if group in hdf.keys():
+            del hdf[group]
+        grp = hdf.create_group(group)
+        phases = list(self.times.keys())
+        grp.create_dataset("phase", data=np.array(phases, dtype="S"))
+        grp.create_dataset("time", data=[self.times[k] for k in phases])
+        grp.create_dataset("calls", data=[self.counts[k] for k in phases])
+
+
+def null_timer(phase):
+    """ Stands in for a PhaseTimer when timing is off. """
+    return contextlib.nullcontext()
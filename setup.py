@@ -22,7 +22,8 @@ def setup_pyqmc():
             "scipy",
             "pandas",
             "pyscf",
-            "h5py"
+            "h5py",
+            "cloudpickle"
         ],
         classifiers=[
             'Development Status :: 3 - Alpha',
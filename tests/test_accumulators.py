@@ -1,6 +1,7 @@
 import numpy as np
 from pyqmc.energy import energy
-from pyqmc.accumulators import LinearTransform
+from pyqmc.accumulators import LinearTransform, ChunkedAccumulator
+from pyqmc.memory import walker_subset, recompute_chunked
 
 
 def test_transform():
@@ -34,5 +35,88 @@ def test_transform():
     assert gradtrans.shape[0] == nconfig
 
 
+def test_chunked():
+    """ Chunked evaluation should match evaluating all walkers at once, 
+    and leave the wave function up to date with all the walkers. """
+    from pyscf import gto, scf
+    import pyqmc
+    from pyqmc.memory import estimate_memory
+
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="cc-pvdz", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = pyqmc.PySCFSlaterUHF(mol, mf)
+    enacc = pyqmc.EnergyAccumulator(mol)
+
+    nconfig = 20
+    configs = pyqmc.initial_guess(mol, nconfig)
+    wf.recompute(configs)
+    full = enacc(configs, wf)
+    fullavg = enacc.avg(configs, wf)
+
+    # The chunks resample copies of wf instead of recomputing it
+    recompute, calls = wf.recompute, []
+    wf.recompute = lambda c: calls.append(c) or recompute(c)
+    chunked = ChunkedAccumulator(enacc, chunk_size=6)
+    dat = chunked(configs, wf)
+    datavg = chunked.avg(configs, wf)
+    for k in full:
+        assert dat[k].shape == full[k].shape
+        assert np.allclose(dat[k], full[k])
+        assert np.isclose(datavg[k], fullavg[k])
+    assert len(calls) == 0
+    del wf.recompute
+    assert np.allclose(wf.value()[1], wf.recompute(configs)[1])
+
+    estimate = estimate_memory(wf, configs, {"energy": enacc}, nconf=10000)
+    assert estimate["energy"] > estimate_memory(wf, configs, {"energy": enacc})["energy"]
+    auto = ChunkedAccumulator(enacc, max_bytes=estimate["energy"] / 1000)
+    auto(configs, wf)
+    assert auto.chunk_size < nconfig
+
+    # The chunk copies only hold the state of their walkers
+    subset = walker_subset(wf, np.arange(6))
+    assert subset._aovals.shape[0] == 6 and subset._inverse[0].shape[0] == 6
+    assert np.allclose(subset.value()[1], wf.value()[1][:6])
+
+    value = wf.recompute(configs)
+    chunked_value = recompute_chunked(wf, configs, 7)
+    assert np.allclose(chunked_value, value)
+    assert np.allclose(wf.value()[1], value[1])
+
+
+def test_chunked_periodic():
+    """ Chunked evaluation and recompute should match the full ones for a periodic 
+    system, whose energy uses Ewald sums. """
+    from pyscf.pbc import gto, scf
+    import pyqmc
+    from pyqmc.slaterpbc import PySCFSlaterPBC, get_supercell
+    from pyqmc.jastrowspin import JastrowSpin
+    from pyqmc.multiplywf import MultiplyWF
+
+    cell = gto.M(
+        atom="H 0. 0. 0.; H 1. 1. 1.", basis="sto-3g", unit="bohr", a=np.eye(3) * 4
+    )
+    mf = scf.KRKS(cell).run()
+    supercell = get_supercell(cell, S=np.eye(3))
+    wf = MultiplyWF(PySCFSlaterPBC(supercell, mf), JastrowSpin(supercell))
+    wf.parameters["wf2bcoeff"][0, :] = 0.1
+    enacc = pyqmc.EnergyAccumulator(supercell)
+
+    nconfig = 10
+    configs = pyqmc.initial_guess(supercell, nconfig)
+    value = wf.recompute(configs)
+    full = enacc(configs, wf)
+    chunked = ChunkedAccumulator(enacc, chunk_size=4)
+    dat = chunked(configs, wf)
+    for k in full:
+        assert np.allclose(dat[k], full[k])
+
+    chunked_value = recompute_chunked(wf, configs, 3)
+    assert np.allclose(chunked_value[1], value[1])
+    assert np.allclose(enacc(configs, wf)["total"], full["total"])
+
+
 if __name__ == "__main__":
     test_transform()
+    test_chunked()
+    test_chunked_periodic()
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+from pyqmc.dasktools import _comb_teeth, _transfer_plan
+
+
+def test_global_comb():
+    """ Ensure that global branching gives each partition its share of the walkers, 
+    and that the transfers balance the partitions """
+    nconfig, npartitions = 400, 4
+    weightsums = np.array([50.0, 150.0, 100.0, 100.0])
+    teeth = _comb_teeth(weightsums, nconfig)
+    counts = [len(t) for t in teeth]
+    assert sum(counts) == nconfig
+    assert np.all(np.abs(np.array(counts) - weightsums) <= 1)
+    for t, w in zip(teeth, weightsums):
+        assert np.all((t >= 0) & (t < w))
+
+    target = nconfig // npartitions
+    plan = _transfer_plan(counts, target)
+    for source, destination, n in plan:
+        counts[source] -= n
+        counts[destination] += n
+    assert counts == [target] * npartitions
+
+
+def _h2():
+    from pyscf import gto, scf
+    from pyqmc.slateruhf import PySCFSlaterUHF
+    from pyqmc.jastrowspin import JastrowSpin
+    from pyqmc.multiplywf import MultiplyWF
+    from pyqmc.accumulators import EnergyAccumulator
+
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = MultiplyWF(PySCFSlaterUHF(mol, mf), JastrowSpin(mol))
+    wf.parameters["wf2bcoeff"][0, :] = 0.1
+    return mol, wf, {"energy": EnergyAccumulator(mol)}
+
+
+def test_dmc_worker():
+    """ Ensure that branching and moving walkers between DMCWorkers keeps the wave 
+    function state and local energies consistent with the walkers """
+    import copy
+    from pyqmc.dasktools import DMCWorker, _merge_walkers
+    from pyqmc.mc import initial_guess
+
+    mol, wf, acc = _h2()
+    np.random.seed(1)
+    configs = initial_guess(mol, 40)
+    workers = [
+        DMCWorker(copy.deepcopy(wf), c, np.ones(20), acc, ("energy", "total"))
+        for c in configs.split(2)
+    ]
+    weightsums = []
+    for w in workers:
+        df, weightsum = w.propagate(0.01, 1e8, 1e9, -1.0, 3, 0)
+        assert len(df) == 3
+        weightsums.append(weightsum)
+    weightsums = np.array(weightsums)
+    wavg = np.sum(weightsums) / 40
+    teeth = _comb_teeth(weightsums, 40)
+    counts = [w.comb(t, wavg) for w, t in zip(workers, teeth)]
+    assert sum(counts) == 40
+    received = {}
+    for source, destination, n in _transfer_plan(counts, 20):
+        received.setdefault(destination, []).append(workers[source].export(n))
+    for d, exported in received.items():
+        workers[d].receive(_merge_walkers(exported), wavg)
+
+    for w in workers:
+        assert w.configs.configs.shape[0] == 20
+        assert w.weights.shape == (20,) and w.eloc.shape == (20,)
+        assert np.allclose(w.weights, wavg)
+        sign, val = w.wf.value()
+        w.wf.recompute(w.configs)
+        sign_ref, val_ref = w.wf.value()
+        assert np.allclose(val, val_ref) and np.allclose(sign, sign_ref)
+        energy = acc["energy"](w.configs, w.wf)["total"]
+        assert np.allclose(w.eloc, energy)
+
+
+def test_distdmc(tmp_path):
+    """ Ensure that distdmc() returns the walkers and writes the same file layout as 
+    rundmc(), including the checkpoint """
+    distributed = pytest.importorskip("dask.distributed")
+    import h5py
+    from pyqmc.dasktools import distdmc
+    from pyqmc.mc import initial_guess
+
+    mol, wf, acc = _h2()
+    configs = initial_guess(mol, 40)
+    hdf_file = str(tmp_path / "distdmc.hdf5")
+    with distributed.Client(processes=False, n_workers=2, threads_per_worker=1) as client:
+        df, configs, weights = distdmc(
+            wf,
+            configs,
+            client=client,
+            npartitions=2,
+            nsteps=10,
+            branchtime=5,
+            accumulators=acc,
+            tstep=0.01,
+            hdf_file=hdf_file,
+        )
+    assert len(df) == 10
+    assert configs.configs.shape[0] == 40 and weights.shape == (40,)
+    with h5py.File(hdf_file, "r") as hdf:
+        for k in ["energytotal", "weight", "eref", "nconfig", "configs", "weights"]:
+            assert k in hdf
+        assert np.all(np.asarray(hdf["nconfig"]) == 40)
+        assert np.allclose(hdf["weights"], weights)
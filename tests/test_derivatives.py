@@ -61,6 +61,52 @@ def test_wfs():
 
 
 
+def test_testvalue_gradient():
+    """
+    Ensure that the fused testvalue_gradient() agrees with testvalue() and gradient().
+    """
+
+    from pyscf import gto, scf, mcscf
+    from pyqmc.slateruhf import PySCFSlaterUHF
+    from pyqmc.multislater import MultiSlater
+    from pyqmc.jastrowspin import JastrowSpin
+    from pyqmc.multiplywf import MultiplyWF
+    from pyqmc.multiplytnwf import MultiplyNWF
+    from pyqmc.manybody_jastrow import J3
+    import pyqmc
+
+    mol = gto.M(atom="Li 0. 0. 0.; H 0. 0. 1.5", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    mc = mcscf.CASCI(mf, ncas=2, nelecas=(1, 1))
+    mc.kernel()
+    epsilon = 1e-10
+    nconf = 10
+    epos = pyqmc.initial_guess(mol, nconf)
+    for wf in [
+        PySCFSlaterUHF(mol, mf),
+        MultiSlater(mol, mf, mc),
+        JastrowSpin(mol),
+        J3(mol),
+        MultiplyWF(PySCFSlaterUHF(mol, mf), JastrowSpin(mol)),
+        MultiplyNWF([PySCFSlaterUHF(mol, mf), JastrowSpin(mol), J3(mol)]),
+    ]:
+        for k in wf.parameters:
+            if "mo_coeff" not in k and k != "det_coeff":
+                wf.parameters[k] = 0.1 * np.random.rand(*wf.parameters[k].shape)
+        for k, item in testwf.test_testvalue_gradient(wf, epos).items():
+            print(type(wf).__name__, k, item)
+            assert item < epsilon
+        err = testwf.test_gradient_current(wf, epos)
+        print(type(wf).__name__, "gradient_current", err)
+        assert err < epsilon
+        for k, item in testwf.test_resample(wf, epos).items():
+            print(type(wf).__name__, "resample", k, item)
+            assert item < epsilon
+        for k, item in testwf.test_restore_state(wf, epos).items():
+            print(type(wf).__name__, "restore_state", k, item)
+            assert item < epsilon
+
+
 def test_pbc_wfs():
     """
     Ensure that the wave function objects are consistent in several situations.
@@ -110,6 +156,22 @@ def test_pbc_wfs():
             print(k, item)
             assert item < epsilon
 
+        for k, item in testwf.test_testvalue_gradient(wf, epos).items():
+            print(k, item)
+            assert item < epsilon
+
+        err = testwf.test_gradient_current(wf, epos)
+        print("gradient_current", err)
+        assert err < epsilon
+
+        for k, item in testwf.test_resample(wf, epos).items():
+            print("resample", k, item)
+            assert item < epsilon
+
+        for k, item in testwf.test_restore_state(wf, epos).items():
+            print("restore_state", k, item)
+            assert item < epsilon
+
 
 def test_func3d():
     """
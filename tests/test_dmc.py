@@ -71,5 +71,306 @@ def test():
     ), "energy not within {0} of -0.5: energy {1}".format(5 * err, np.mean(energy))
 
 
+def test_carry_state():
+    """ Ensure that resampling the wave function state at branching gives the same 
+    DMC run as recomputing it, without any recompute after the first step """
+    from pyscf import gto, scf
+    from pyqmc.slateruhf import PySCFSlaterUHF
+    from pyqmc.jastrowspin import JastrowSpin
+    from pyqmc.multiplywf import MultiplyWF
+    from pyqmc.dmc import rundmc
+    from pyqmc.mc import initial_guess
+    from pyqmc.accumulators import EnergyAccumulator
+    from pyqmc.timing import PhaseTimer
+
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = MultiplyWF(PySCFSlaterUHF(mol, mf), JastrowSpin(mol))
+    wf.parameters["wf2bcoeff"][0, :] = 0.1
+    configs = initial_guess(mol, 100)
+
+    dfs = []
+    for carry_state in [True, False]:
+        timer = PhaseTimer()
+        np.random.seed(1)
+        df, configs_, weights_ = rundmc(
+            wf,
+            configs.copy(),
+            nsteps=20,
+            branchtime=5,
+            accumulators={"energy": EnergyAccumulator(mol)},
+            tstep=0.01,
+            timer=timer,
+            carry_state=carry_state,
+        )
+        dfs.append(df)
+        nbranch = 4
+        assert timer.counts["recompute"] == (1 if carry_state else nbranch + 1)
+    assert np.allclose(dfs[0]["energytotal"], dfs[1]["energytotal"])
+    assert np.allclose(dfs[0]["weight"], dfs[1]["weight"])
+
+
+def test_birthdeath():
+    """ Ensure that birth/death branching keeps the population near its target and
+    agrees with the comb """
+    from pyscf import gto, scf
+    from pyqmc.slateruhf import PySCFSlaterUHF
+    from pyqmc.jastrowspin import JastrowSpin
+    from pyqmc.multiplywf import MultiplyWF
+    from pyqmc.dmc import rundmc
+    from pyqmc.mc import initial_guess
+    from pyqmc.accumulators import EnergyAccumulator
+
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = MultiplyWF(PySCFSlaterUHF(mol, mf), JastrowSpin(mol))
+    wf.parameters["wf2bcoeff"][0, :] = 0.1
+    nconfig = 200
+    configs = initial_guess(mol, nconfig)
+
+    energies = {}
+    for branching in ["comb", "birthdeath"]:
+        np.random.seed(2)
+        df, configs_, weights_ = rundmc(
+            wf,
+            configs.copy(),
+            nsteps=100,
+            branchtime=5,
+            accumulators={"energy": EnergyAccumulator(mol)},
+            tstep=0.02,
+            branching=branching,
+        )
+        if branching == "birthdeath":
+            assert df["nconfig"].nunique() > 1
+            assert np.all(np.abs(df["nconfig"] - nconfig) < 0.3 * nconfig)
+            assert configs_.configs.shape[0] == len(weights_)
+        else:
+            assert np.all(df["nconfig"] == nconfig)
+        warmup = 20
+        rb = reblock.reblock(df["energytotal"][warmup:], 10)
+        energies[branching] = (np.mean(rb), np.std(rb) / np.sqrt(len(rb)))
+    (ecomb, errcomb), (ebd, errbd) = energies["comb"], energies["birthdeath"]
+    assert abs(ecomb - ebd) < 5 * np.sqrt(errcomb ** 2 + errbd ** 2), energies
+
+
+def test_walker_pool():
+    """ Ensure that WalkerPool.take matches np.take while the population changes, and 
+    that it refuses an array it has already reused """
+    from pyqmc.coord import WalkerPool
+
+    pool = WalkerPool()
+    array = np.random.randn(10, 4, 3)
+    expected = array
+    for n in [10, 15, 8, 20]:
+        newinds = np.random.randint(expected.shape[1], size=n)
+        array = pool.take("a", array, newinds, axis=1)
+        expected = np.take(expected, newinds, axis=1)
+        assert np.allclose(array, expected)
+    pool.take("a", array, np.arange(2), axis=1)
+    with pytest.raises(ValueError):
+        pool.take("a", array, np.arange(2), axis=1)
+    with pytest.raises(IndexError):
+        pool.take("b", np.zeros((3, 2)), [0, 3])
+
+
+def test_tmoves():
+    """ Ensure that T-moves move each walker with the probability given by the 
+    nonlocal_tmoves() matrix elements, to one of its quadrature points with a positive 
+    transition weight """
+    from pyscf import gto, scf
+    from pyqmc.slateruhf import PySCFSlaterUHF
+    from pyqmc.dmc import tmove, rundmc
+    from pyqmc.mc import initial_guess
+    from pyqmc.accumulators import EnergyAccumulator
+
+    mol = gto.M(atom="C 0. 0. 0.", ecp="bfd", basis="bfd_vdz", spin=2, unit="bohr")
+    mf = scf.UHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    acc = EnergyAccumulator(mol)
+    tstep = 0.5
+    configs = initial_guess(mol, 1000)
+    wf.recompute(configs)
+    nmoved, mean, var = 0, 0.0, 0.0
+    for e in range(configs.configs.shape[1]):
+        # The same seed gives tmove() the same quadrature rotations
+        np.random.seed(e)
+        quadrature = acc.nonlocal_tmoves(configs, wf, e)
+        tweight = -tstep * np.real(quadrature["ratio"] * quadrature["weight"])
+        tweight = np.maximum(tweight, 0)
+        pmove = np.sum(tweight, axis=1) / (1 + np.sum(tweight, axis=1))
+        np.random.seed(e)
+        accept = tmove(wf, configs, acc, tstep, e)
+
+        # Moved walkers are at one of their points with a positive weight
+        dist = np.linalg.norm(
+            quadrature["epos"][accept] - configs.configs[accept, e, np.newaxis], axis=-1
+        )
+        closest = np.argmin(dist, axis=1)
+        assert np.allclose(np.amin(dist, axis=1), 0)
+        assert np.all(tweight[accept, closest] > 0)
+        nmoved += np.sum(accept)
+        mean += np.sum(pmove)
+        var += np.sum(pmove * (1 - pmove))
+    assert nmoved > 0
+    assert abs(nmoved - mean) < 5 * np.sqrt(var), (nmoved, mean, var)
+    phase, val = wf.value()
+    rphase, rval = wf.recompute(configs)
+    assert np.allclose(val, rval)
+
+    df, configs, weights = rundmc(
+        wf, configs.mask(np.arange(50)), nsteps=4, accumulators={"energy": acc}, tmoves=True
+    )
+    assert np.all((df["tmove_acceptance"] >= 0) & (df["tmove_acceptance"] <= 1))
+
+
+def test_tmove_zero_tstep():
+    """ Ensure that no electron is moved by a T-move with a zero time step """
+    from pyscf import gto, scf
+    from pyqmc.slateruhf import PySCFSlaterUHF
+    from pyqmc.dmc import tmove
+    from pyqmc.mc import initial_guess
+    from pyqmc.accumulators import EnergyAccumulator
+
+    mol = gto.M(atom="C 0. 0. 0.", ecp="bfd", basis="bfd_vdz", spin=2, unit="bohr")
+    mf = scf.UHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    configs = initial_guess(mol, 50)
+    wf.recompute(configs)
+    acc = EnergyAccumulator(mol)
+    before = configs.configs.copy()
+    for e in range(configs.configs.shape[1]):
+        accept = tmove(wf, configs, acc, 0.0, e)
+        assert not np.any(accept)
+    assert np.allclose(configs.configs, before)
+
+
+def test_extrapolate():
+    """ Ensure that the zero time step fit recovers a known linear dependence """
+    from pyqmc.timestep import extrapolate
+
+    tsteps = np.array([0.01, 0.02, 0.04])
+    fit = extrapolate(tsteps, -1.0 + 0.5 * tsteps, 0.001 * np.ones(3))
+    assert abs(fit["energy"] + 1.0) < 1e-10
+    assert abs(fit["coefficients"][1] - 0.5) < 1e-8
+    assert fit["error"] > 0
+
+
+def test_timestep_extrapolation():
+    """ Ensure that concurrent runs at several time steps extrapolate to the exact 
+    energy of the hydrogen atom """
+    from pyscf import gto, scf
+    from pyqmc.slateruhf import PySCFSlaterUHF
+    from pyqmc.jastrowspin import JastrowSpin
+    from pyqmc.multiplywf import MultiplyWF
+    from pyqmc.func3d import CutoffCuspFunction
+    from pyqmc.accumulators import EnergyAccumulator
+    from pyqmc.coord import OpenConfigs
+    from pyqmc.timestep import timestep_extrapolation
+
+    mol = gto.M(atom="H 0. 0. 0.", basis="sto-3g", unit="bohr", spin=1)
+    mf = scf.UHF(mol).run()
+    wf2 = JastrowSpin(mol, a_basis=[CutoffCuspFunction(5, 0.2)], b_basis=[])
+    wf2.parameters["acoeff"] = np.asarray([[[-1.0, 0]]])
+    wf = MultiplyWF(PySCFSlaterUHF(mol, mf), wf2)
+    configs = OpenConfigs(np.random.randn(100, 1, 3))
+
+    tsteps = [0.01, 0.02, 0.04]
+    result = timestep_extrapolation(
+        wf,
+        configs,
+        tsteps,
+        total_time=5,
+        accumulators={"energy": EnergyAccumulator(mol)},
+        seed=0,
+    )
+    summary = result["summary"]
+    assert list(summary["nsteps"]) == [500, 250, 125]
+    fit = result["extrapolated"]
+    assert abs(fit["energy"] + 0.5) < 5 * fit["error"], fit
+
+    # Seeding the global generator reproduces the runs, also without storing the steps
+    summaries = []
+    for i in range(2):
+        np.random.seed(1)
+        result = timestep_extrapolation(
+            wf,
+            configs.mask(np.arange(20)),
+            tsteps[1:],
+            total_time=0.4,
+            accumulators={"energy": EnergyAccumulator(mol)},
+            store_steps=False,
+        )
+        summaries.append(result["summary"])
+    assert np.all(summaries[0]["energy"] == summaries[1]["energy"])
+
+
+def test_intervals():
+    """ Ensure that an accumulator with an evaluation interval is weighted like the 
+    energy on the steps where it is evaluated, and NaN elsewhere """
+    from pyscf import gto, scf
+    from pyqmc.slateruhf import PySCFSlaterUHF
+    from pyqmc.dmc import rundmc
+    from pyqmc.mc import initial_guess
+    from pyqmc.accumulators import EnergyAccumulator
+
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    configs = initial_guess(mol, 50)
+    df, configs, weights = rundmc(
+        wf,
+        configs,
+        nsteps=20,
+        branchtime=5,
+        accumulators={
+            "energy": EnergyAccumulator(mol),
+            "sparse": EnergyAccumulator(mol),
+        },
+        intervals={"sparse": 4},
+        tstep=0.01,
+    )
+    evaluated = (df["step"] % 4 == 0).values
+    sparse = df["sparsetotal"].values.astype(float)
+    assert np.all(np.isnan(sparse[~evaluated]))
+    assert np.allclose(sparse[evaluated], df["energytotal"].values[evaluated])
+
+
+def test_stream(tmp_path):
+    """ Ensure that a run without stored steps returns reblocked statistics and writes 
+    every step to preallocated datasets trimmed to the steps taken """
+    import h5py
+    from pyscf import gto, scf
+    from pyqmc.slateruhf import PySCFSlaterUHF
+    from pyqmc.dmc import rundmc
+    from pyqmc.mc import initial_guess
+    from pyqmc.accumulators import EnergyAccumulator
+
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    configs = initial_guess(mol, 50)
+    hdf_file = str(tmp_path / "dmc.hdf5")
+    nsteps = 40
+    summary, configs, weights = rundmc(
+        wf,
+        configs,
+        nsteps=nsteps,
+        branchtime=5,
+        accumulators={"energy": EnergyAccumulator(mol)},
+        tstep=0.01,
+        hdf_file=hdf_file,
+        hdf_options=dict(buffer_size=8),
+        store_steps=False,
+    )
+    assert summary.loc["energytotal", "nsamples"] == nsteps
+    with h5py.File(hdf_file, "r") as hdf:
+        assert hdf["energytotal"].shape == (nsteps,)
+        assert np.allclose(hdf["step"], np.arange(nsteps))
+        assert np.isclose(np.mean(hdf["energytotal"]), summary.loc["energytotal", "mean"])
+        assert hdf["eref"].shape == (nsteps,)
+        assert hdf["weights"].shape == weights.shape
+
+
 if __name__ == "__main__":
     test()
+    test_carry_state()
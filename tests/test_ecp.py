@@ -31,5 +31,150 @@ def test_ecp():
     )
 
 
+def test_nonlocal_tmoves():
+    """ Ensure that the quadrature points returned for T-moves carry the wave function 
+    ratios at those points, and that their weights are the unmasked, unscaled quadrature 
+    weights of every walker """
+    from pyqmc import eval_ecp
+
+    mol = gto.M(atom="C 0. 0. 0.", ecp="bfd", basis="bfd_vdz")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    coords = initial_guess(mol, 20)
+    wf.recompute(coords)
+    acc = EnergyAccumulator(mol, threshold=1e-3)
+    evaluator = eval_ecp.ECPEvaluator(mol, threshold=1e-3, tolerance=None)
+    naip = evaluator.term_naip[0]
+    for e in range(coords.configs.shape[1]):
+        quadrature = acc.nonlocal_tmoves(coords, wf, e)
+        epos = coords.make_irreducible(e, quadrature["epos"])
+        assert np.allclose(quadrature["ratio"], wf.testvalue(e, epos))
+
+        np.random.seed(e)
+        quadrature = evaluator.nonlocal_tmoves(coords, wf, e)
+        np.random.seed(e)
+        weights, epos_rot = eval_ecp.get_rot(mol, coords, e, 0, naip)
+        l_list, v_l = eval_ecp.get_v_l(mol, coords, e, 0)
+        P_l = eval_ecp.get_P_l(mol, coords, weights, epos_rot, l_list, e, 0)
+        assert np.allclose(quadrature["epos"], epos_rot)
+        assert np.allclose(quadrature["weight"], np.einsum("ik,ijk->ij", v_l, P_l))
+
+
+def test_ecp_batched():
+    """ Ensure that evaluating all atoms in one batch per electron gives the same ECP 
+    as evaluating each electron-atom pair, with atoms that have different numbers of 
+    channels and quadrature points """
+    from pyqmc import eval_ecp
+
+    mol = gto.M(
+        atom="C 0. 0. 0.; Cl 0. 0. 3.3", ecp="bfd", basis="bfd_vdz", unit="bohr", spin=1
+    )
+    mf = scf.UHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    coords = initial_guess(mol, 20)
+    wf.recompute(coords)
+    threshold = 10
+
+    np.random.seed(0)
+    batched = eval_ecp.ecp(mol, coords, wf, threshold)
+    np.random.seed(0)
+    pairs = np.zeros(coords.configs.shape[0])
+    for e in range(coords.configs.shape[1]):
+        for at in range(len(mol._atom)):
+            pairs += eval_ecp.ecp_ea(mol, coords, wf, e, at, threshold)
+    assert np.allclose(batched, pairs)
+
+
+def test_ecp_evaluator():
+    """ Ensure that the nonlocal channels are negligible beyond the cutoff radius, that 
+    pairs beyond it make no wave function calls, and that the cutoff does not change 
+    the average ECP """
+    from pyqmc.eval_ecp import ECPEvaluator, ecp
+
+    mol = gto.M(atom="C 0. 0. 0.; C 0. 0. 2.5", ecp="bfd", basis="bfd_vdz", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    tolerance = 1e-8
+    evaluator = ECPEvaluator(mol, threshold=10, tolerance=tolerance)
+    r = np.linspace(evaluator.cutoff[0], 20, 200)
+    for l, func in evaluator.functors["C"].items():
+        if l != -1:
+            assert np.all(np.abs(func(r)) < tolerance)
+
+    class CountingWF:
+        def __init__(self, wf):
+            self.wf, self.calls = wf, 0
+
+        def testvalue(self, *args):
+            self.calls += 1
+            return self.wf.testvalue(*args)
+
+    far = initial_guess(mol, 10)
+    far.configs += np.array([0, 0, 10 + evaluator.cutoff[0]])
+    wf.recompute(far)
+    counting = CountingWF(wf)
+    local = ECPEvaluator(mol, threshold=10, tolerance=None)(far, wf)
+    assert np.allclose(evaluator(far, counting), local)
+    assert counting.calls == 0
+
+    coords = initial_guess(mol, 2000)
+    wf.recompute(coords)
+    withcut = evaluator(coords, wf)
+    nocut = ecp(mol, coords, wf, 10)
+    err = np.sqrt((np.var(withcut) + np.var(nocut)) / len(withcut))
+    assert abs(np.mean(withcut) - np.mean(nocut)) < 5 * err
+
+
+def test_quadrature_rules():
+    """ Ensure that each rule integrates Legendre polynomials exactly up to its degree, 
+    also after a random rotation, and that choosing rules per species and channel does 
+    not change the average ECP """
+    from numpy.polynomial.legendre import legval
+    from pyqmc.eval_ecp import QUADRATURE_RULES, ECPEvaluator, _rotation_frames
+
+    exact = {4: 2, 6: 3, 12: 5, 18: 5, 32: 9}
+    t = np.random.uniform(0, np.pi, size=3)
+    p = np.random.uniform(0, 2 * np.pi, size=3)
+    axis = np.random.randn(3)
+    axis /= np.linalg.norm(axis)
+    for n, (vectors, weights) in QUADRATURE_RULES.items():
+        assert vectors.shape == (n, 3)
+        assert np.allclose(np.linalg.norm(vectors, axis=1), 1)
+        assert abs(np.sum(weights) - 1) < 1e-12
+        rotated = np.matmul(vectors, _rotation_frames(t, p))  # 3 x n x 3
+        for l in range(1, exact[n] + 1):
+            P = legval(rotated.dot(axis), [0] * l + [1])
+            assert np.allclose(P.dot(weights), 0, atol=1e-12), (n, l)
+
+    mol = gto.M(
+        atom="C 0. 0. 0.; Cl 0. 0. 3.3", ecp="bfd", basis="bfd_vdz", unit="bohr", spin=1
+    )
+    mf = scf.UHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    coords = initial_guess(mol, 2000)
+    wf.recompute(coords)
+    default = ECPEvaluator(mol)(coords, wf)
+    chosen = ECPEvaluator(mol, quadrature={"C": 4, "Cl": {0: 6, 1: 32}})(coords, wf)
+    err = np.sqrt((np.var(default) + np.var(chosen)) / len(default))
+    assert abs(np.mean(default) - np.mean(chosen)) < 5 * err
+
+
+def test_all_electron():
+    """ Ensure that molecules without pseudopotentials have no ECP terms """
+    from pyqmc.eval_ecp import ECPEvaluator
+
+    mol = gto.M(atom="Li 0. 0. 0.; H 0. 0. 1.5", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    coords = initial_guess(mol, 10)
+    wf.recompute(coords)
+    evaluator = ECPEvaluator(mol)
+    assert evaluator.term_channels.shape == (0, 0)
+    assert np.all(evaluator(coords, wf) == 0)
+    assert evaluator.nonlocal_tmoves(coords, wf, 0)["ratio"].shape == (10, 0)
+    energy = EnergyAccumulator(mol)(coords, wf)
+    assert np.all(np.isfinite(energy["total"]))
+
+
 if __name__ == "__main__":
     test_ecp()
@@ -79,6 +79,139 @@ def test_ewald_CaF2():
     assert np.abs(etot / 4 + caf2_answer) < 1e-4
 
 
+def test_gpoints():
+    """ Ensure that the G vectors enumerated in a sphere are those of a dense grid with large weights """
+    cell = gto.Cell(atom="He 0. 0. 0.", basis="sto-3g", unit="bohr")
+    cell.build(a=[[2.0, 0.1, 0.0], [0.5, 2.2, 0.0], [0.3, -0.4, 2.5]])
+    ewald = pyqmc.ewald.Ewald(cell)
+
+    gmax = 20
+    XYZ = np.meshgrid(*[np.arange(-gmax, gmax + 1)] * 3, indexing="ij")
+    X, Y, Z = [x.ravel() for x in XYZ]
+    gpoints = np.stack((X, Y, Z), axis=-1)[X + 1e-6 * Y + 1e-12 * Z > 0]
+    gpoints = np.dot(gpoints, np.linalg.inv(ewald.latvec).T) * 2 * np.pi
+    gsquared = np.sum(gpoints ** 2, axis=1)
+    gweight = 4 * np.pi * np.exp(-gsquared / (4 * ewald.alpha ** 2))
+    gweight /= np.linalg.det(ewald.latvec) * gsquared
+    assert np.allclose(ewald.gpoints, gpoints[gweight > 1e-10])
+    assert np.allclose(ewald.gweight, gweight[gweight > 1e-10])
+
+
+def test_reciprocal_basis():
+    """ Ensure that the energy of a non-symmetric cell does not depend on which lattice vectors describe it """
+    latvec = np.array([[3.0, 0.2, 0.0], [0.0, 3.2, 0.0], [0.4, 0.0, 2.8]])
+    sheared = np.dot([[1, 0, 0], [1, 1, 0], [0, 1, 1]], latvec)
+    configs = np.random.rand(5, 3, 3) * 3.0
+    energies = []
+    for a in [latvec, sheared]:
+        cell = gto.Cell(atom="H 0. 0. 0.; He 1. 1. 1.", basis="sto-3g", unit="bohr")
+        cell.build(a=a, spin=1)
+        ewald = pyqmc.ewald.Ewald(cell, nlatvec=3)
+        energies.append(sum(ewald.energy(PeriodicConfigs(configs.copy(), a))))
+    assert np.allclose(energies[0], energies[1])
+
+
+def test_structure_factor():
+    """ Ensure that the cached structure factor gives the same energies after moves as a new Ewald object """
+    cell = gto.Cell(atom="H 0. 0. 0.; H 1. 1. 1.", basis="sto-3g", unit="bohr")
+    cell.build(a=np.eye(3) * 3.0)
+    ewald = pyqmc.ewald.Ewald(cell)
+    configs = PeriodicConfigs(np.random.rand(10, 2, 3) * 3.0, cell.lattice_vectors())
+    ewald.energy(configs)
+    for e in [0, 1, 0]:
+        accept = np.random.rand(10) > 0.5
+        step = np.random.randn(10, 3)
+        newpos = configs.make_irreducible(e, configs.configs[:, e] + step)
+        configs.move(e, newpos, accept)
+        for cached, new in zip(
+            ewald.energy(configs), pyqmc.ewald.Ewald(cell).energy(configs)
+        ):
+            assert np.allclose(cached, new)
+    epos = configs.make_irreducible(0, np.random.rand(10, 3) * 3.0)
+    assert np.allclose(
+        ewald.energy_with_test_pos(configs, epos),
+        pyqmc.ewald.Ewald(cell).energy_with_test_pos(configs, epos),
+    )
+    _, rho = ewald.structure_factor(configs)
+    e_exp = np.exp(1j * np.dot(configs.configs, ewald.gpoints.T))
+    assert np.allclose(rho, e_exp.sum(axis=1))
+
+    # Structure factors larger than the budget are not kept
+    uncached = pyqmc.ewald.Ewald(cell, structure_factor_bytes=0)
+    for cached, new in zip(ewald.energy(configs), uncached.energy(configs)):
+        assert np.allclose(cached, new)
+    assert uncached._e_exp is None
+
+
+def test_real_space_sum():
+    """ Ensure that the blocked real-space sum over the images within the cutoff matches the sum over all images """
+    from scipy.special import erfc
+
+    cell = gto.Cell(atom="H 0. 0. 0.; H 1. 1. 1.", basis="sto-3g", unit="bohr")
+    cell.build(a=[[3.0, 0.2, 0.0], [0.0, 3.2, 0.0], [0.4, 0.0, 2.8]])
+    ewald = pyqmc.ewald.Ewald(cell)
+    distances = np.random.randn(7, 5, 3)
+    rvec = distances[..., np.newaxis, :] + ewald.lattice_displacements
+    r = np.linalg.norm(rvec, axis=-1)
+    direct = np.sum(erfc(ewald.alpha * r) / r, axis=-1)
+    assert np.allclose(ewald.real_space_sum(distances, max_bytes=1000), direct)
+
+    # The images are cut off per displacement, whatever else is in the array
+    far = np.concatenate([distances[0, :1], [[30.0, 0.0, 0.0]]])
+    near = ewald.real_space_sum(distances[0, :1])
+    assert np.allclose(ewald.real_space_sum(far)[:1], near, rtol=1e-13, atol=0)
+
+
+def test_tuned_ewald():
+    """ Ensure that tuned parameters reproduce the default energies to the requested accuracy, 
+    and that many walkers move the choice towards smaller alphas """
+    cell = gto.Cell(atom="H 0. 0. 0.; H 1. 1. 1.", basis="sto-3g", unit="bohr")
+    cell.build(a=[[3.0, 0.2, 0.0], [0.0, 3.2, 0.0], [0.4, 0.0, 2.8]])
+    configs = PeriodicConfigs(np.random.rand(5, 2, 3) * 3.0, cell.lattice_vectors())
+    edefault = sum(pyqmc.ewald.Ewald(cell).energy(configs))
+    for accuracy in [1e-6, 1e-9]:
+        tuned = pyqmc.ewald.Ewald(cell, accuracy=accuracy, nconf=5)
+        assert tuned.tuning["error"] <= accuracy * (1 + 1e-6)
+        assert tuned.alpha == tuned.tuning["alpha"]
+        etuned = sum(tuned.energy(configs))
+        assert np.allclose(etuned, edefault, atol=10 * accuracy)
+
+    few = pyqmc.ewald.tune_ewald(cell, 1e-6, nconf=10)
+    many = pyqmc.ewald.tune_ewald(cell, 1e-6, nconf=10 ** 6, max_bytes=2 ** 28)
+    assert many["memory"] <= 2 ** 28
+    assert many["alpha"] <= few["alpha"]
+
+
+def test_pme():
+    """ Ensure that the particle-mesh reciprocal sums agree with the direct sums """
+    cell = gto.Cell(atom="H 0. 0. 0.; He 1. 1. 1.", basis="sto-3g", unit="bohr", spin=1)
+    cell.build(a=[[3.0, 0.2, 0.0], [0.0, 3.2, 0.0], [0.4, 0.0, 2.8]])
+    configs = PeriodicConfigs(np.random.rand(5, 3, 3) * 3.0, cell.lattice_vectors())
+    epos = configs.make_irreducible(0, np.random.rand(5, 3) * 3.0)
+    direct = pyqmc.ewald.Ewald(cell)
+    pme = pyqmc.ewald.Ewald(cell, reciprocal="pme")
+    for edirect, epme in zip(direct.energy(configs), pme.energy(configs)):
+        assert np.allclose(edirect, epme, atol=1e-5)
+    assert np.allclose(
+        direct.energy_separated(configs), pme.energy_separated(configs), atol=1e-5
+    )
+    assert np.allclose(
+        direct.energy_with_test_pos(configs, epos),
+        pme.energy_with_test_pos(configs, epos),
+        atol=1e-5,
+    )
+
+    # Madelung energy of the conventional rock salt cell, as in test_ewald_NaCl()
+    cell = gto.Cell(atom="H 0. 0. 0.", basis="sto-3g", unit="bohr", spin=1)
+    cell.build(a=(np.ones((3, 3)) - np.eye(3)), spin=1)
+    supercell = get_supercell(cell, np.ones((3, 3)) - 2 * np.eye(3))
+    configs = np.ones((1, 4, 3))
+    configs[:, 1:, :] = np.eye(3)
+    configs = PeriodicConfigs(configs, supercell.lattice_vectors())
+    ewald = pyqmc.ewald.Ewald(supercell, reciprocal="pme")
+    assert np.abs(sum(ewald.energy(configs)) / 4 + 1.74756) < 1e-4
+
+
 r"""
 https://en.wikipedia.org/wiki/Madelung_constant
 https://aip.scitation.org/doi/pdf/10.1063/1.1731810
@@ -113,3 +246,9 @@ For CaF2, Madelung constant (per F) is -2.51939, (per Ca is -5.03879)so the ener
 if __name__ == "__main__":
     test_ewald_NaCl()
     test_ewald_CaF2()
+    test_gpoints()
+    test_reciprocal_basis()
+    test_structure_factor()
+    test_real_space_sum()
+    test_tuned_ewald()
+    test_pme()
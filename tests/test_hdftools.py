@@ -0,0 +1,56 @@
+import shutil
+import numpy as np
+import h5py
+from pyqmc.hdftools import HDFWriter
+
+
+def test_writer_restart(tmp_path):
+    """ Ensure that a run continued after a writer was not closed appends after the rows 
+    written, not after the preallocated length """
+    hdf_file = str(tmp_path / "restart.hdf5")
+    crashed = str(tmp_path / "crashed.hdf5")
+    writer = HDFWriter(hdf_file, buffer_size=5, expected_rows=100)
+    for step in range(5):
+        writer.append({"step": step})
+    # The file as a run that stopped here, without close(), would leave it
+    shutil.copy(hdf_file, crashed)
+    writer.close()
+    with HDFWriter(crashed, buffer_size=5) as writer:
+        for step in range(5, 8):
+            writer.append({"step": step})
+    with h5py.File(crashed, "r") as hdf:
+        assert np.allclose(hdf["step"], np.arange(8))
+        assert hdf.attrs["nrows"] == 8
+
+
+def test_writer_checkpoint_due(tmp_path):
+    """ Ensure that checkpoint_due predicts when append() writes the checkpoint, and 
+    that close() writes the checkpoint it is given """
+    hdf_file = str(tmp_path / "checkpoint.hdf5")
+    writer = HDFWriter(hdf_file, buffer_size=1, checkpoint_every=3)
+    due = []
+    for step in range(6):
+        due.append(writer.checkpoint_due)
+        writer.append({"step": step}, {"configs": np.full(2, step)})
+    writer.close({"configs": np.full(2, 10)})
+    assert due == [False, False, True] * 2
+    with h5py.File(hdf_file, "r") as hdf:
+        assert np.allclose(hdf["configs"], 10)
+    assert not HDFWriter(None).checkpoint_due
+
+
+def test_writer_extend(tmp_path):
+    """ Ensure that extend() writes the rows, and writes a copy of the checkpoint when 
+    one falls due during them """
+    hdf_file = str(tmp_path / "extend.hdf5")
+    writer = HDFWriter(hdf_file, buffer_size=4, checkpoint_every=4)
+    configs = np.zeros(2)
+    for block in range(3):
+        configs[:] = block
+        writer.extend([{"step": 3 * block + i} for i in range(3)], {"configs": configs})
+    # The checkpoint fell due in the second block only
+    configs[:] = 5
+    writer.close()
+    with h5py.File(hdf_file, "r") as hdf:
+        assert np.allclose(hdf["step"], np.arange(9))
+        assert np.allclose(hdf["configs"], 1)
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+from pyqmc.reblock import (
+    optimally_reblocked,
+    opt_block,
+    OnlineBlocking,
+    mser_warmup,
+    TargetError,
+)
+
+
+def corr_data(N, L):
+    """
+        Creates correlated data. Taken from 
+        https://pyblock.readthedocs.io/en/latest/tutorial.html.
+    """
+    return np.convolve(np.random.randn(2 ** N), np.ones(2 ** L) / 10, "same")
+
+
+def test_online_blocking():
+    """
+    Ensure that streaming reblocking agrees with optimally_reblocked() on the same data,
+    including for array-valued quantities.
+    """
+    n = 11
+    cols = ["test_data1", "test_data2"]
+    test_data = pd.DataFrame(data={cols[0]: corr_data(n, 4), cols[1]: corr_data(n, 7)})
+    reblocked = optimally_reblocked(test_data[cols])
+
+    stats = OnlineBlocking()
+    for i in range(len(test_data)):
+        stats.add(
+            {
+                cols[0]: test_data[cols[0]][i],
+                cols[1]: test_data[cols[1]][i],
+                "array": test_data[cols].values[i],
+            }
+        )
+    assert len(stats) == 2 ** n
+    summary = stats.summary()
+    for j, c in enumerate(cols):
+        # optimally_reblocked() uses the same block size for every column
+        nblocks = reblocked["reblocks"].values[0]
+        stderr = stats._ladders[c].standard_errors()[nblocks]
+        assert np.isclose(summary.loc[c, "mean"], reblocked.loc[c, "mean"])
+        assert summary.loc[c, "reblocks"] == opt_block(test_data[[c]])[0]
+        assert np.isclose(stderr, reblocked.loc[c, "standard error"])
+        assert np.isclose(stats.result("array")["mean"][j], reblocked.loc[c, "mean"])
+        assert np.isclose(
+            stats.result("array")["standard error"][j], summary.loc[c, "standard error"]
+        )
+
+
+def test_target_error():
+    """
+    Ensure that the warmup is detected and excluded, and that TargetError stops 
+    once the error is small enough.
+    """
+    n, nwarmup = 2 ** 10, 100
+    data = corr_data(10, 2)
+    data[:nwarmup] += np.linspace(5, 0, nwarmup)
+    warmup = mser_warmup(data)
+    assert warmup is not None and nwarmup // 2 < warmup < 2 * nwarmup
+    assert mser_warmup(np.linspace(5, 0, 100)) is None
+
+    monitor = TargetError("x", 0.03, check_every=16)
+    for i, x in enumerate(data):
+        monitor.add({"x": x})
+        if monitor.done():
+            break
+    assert monitor.warmup is not None
+    assert len(monitor.statistics) == i + 1 - monitor.warmup
+    result = monitor.statistics.result("x")
+    assert result["standard error"] <= 0.03
+    assert abs(result["mean"]) < 5 * result["standard error"]
+
+    monitor = TargetError("x", 0.03, check_every=16, max_pending=64)
+    for x in np.linspace(5, 0, 1000):
+        monitor.add({"x": x})
+        monitor.done()
+    assert monitor.warmup is None
+    assert len(monitor._pending) <= 64 and len(monitor._trace) <= 64
+
+
+if __name__ == "__main__":
+    test_online_blocking()
+    test_target_error()
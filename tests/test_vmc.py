@@ -45,6 +45,396 @@ def test_vmc():
         )
 
 
+def test_vmc_all_electron():
+    """
+    Test that VMC with all-electron moves matches Hartree-Fock within error bars.
+    """
+    nconf = 1000
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="cc-pvdz", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    warmup = 30
+
+    coords = initial_guess(mol, nconf)
+    df, coords = vmc(
+        wf,
+        coords,
+        nsteps=300,
+        tstep=0.2,
+        accumulators={"energy": EnergyAccumulator(mol)},
+        move="all",
+    )
+
+    df = pd.DataFrame(df)
+    assert 0.2 < df["acceptance"].mean() < 1.0
+    df = reblock(df["energytotal"][warmup:], 20)
+    en = df.mean()
+    err = df.sem()
+    assert abs(en - mf.energy_tot()) < 5 * err, "pyscf {0}, vmc {1}, err {2}".format(
+        mf.energy_tot(), en, err
+    )
+
+
+def test_all_electron_move_state():
+    """
+    Test that after an all-electron move the wave function matches a recompute() for both 
+    the accepted and the rejected walkers, and that the returned drift is the one there.
+    """
+    from pyqmc.jastrowspin import JastrowSpin
+    from pyqmc.multiplywf import MultiplyWF
+    from pyqmc.mc import all_electron_move, limdrift, _drift_all
+
+    mol = gto.M(atom="Li 0. 0. 0.; H 0. 0. 1.5", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = MultiplyWF(PySCFSlaterUHF(mol, mf), JastrowSpin(mol))
+    for k in wf.parameters:
+        if "mo_coeff" not in k:
+            wf.parameters[k] = 0.1 * np.random.rand(*wf.parameters[k].shape)
+    configs = initial_guess(mol, 20)
+    wf.recompute(configs)
+    drift = lambda g: limdrift(g) * 0.5
+    grad = None
+    for step in range(3):
+        oldphase, oldval = wf.value()
+        accept, grad = all_electron_move(wf, configs, 0.5, drift, grad=grad)
+        phase, val = wf.value()
+        # The rejected walkers get back their state as it was, not through updates
+        reject = ~accept
+        assert np.allclose(val[reject], oldval[reject], rtol=1e-13, atol=0)
+        assert np.allclose(phase[reject], oldphase[reject], rtol=1e-13, atol=0)
+        assert np.allclose(grad, _drift_all(wf, configs, drift))
+        rphase, rval = wf.recompute(configs)
+        assert np.allclose(phase, rphase) and np.allclose(val, rval)
+
+
+class _MinimalWF:
+    """ Exposes only the methods of the documented wave function contract """
+
+    def __init__(self, wf):
+        self.wf = wf
+        self.parameters = wf.parameters
+
+    def recompute(self, configs):
+        return self.wf.recompute(configs)
+
+    def updateinternals(self, e, epos, mask=None):
+        self.wf.updateinternals(e, epos, mask=mask)
+
+    def value(self):
+        return self.wf.value()
+
+    def gradient(self, e, epos):
+        return self.wf.gradient(e, epos)
+
+    def testvalue(self, e, epos, mask=None):
+        return self.wf.testvalue(e, epos, mask=mask)
+
+    def laplacian(self, e, epos):
+        return self.wf.laplacian(e, epos)
+
+
+def test_vmc_minimal_wf():
+    """ Ensure that a wave function without gradient_current() and testvalue_gradient() 
+    gives the same VMC and DMC runs as one with them """
+    from pyqmc.dmc import rundmc
+
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    configs = initial_guess(mol, 20)
+    acc = {"energy": EnergyAccumulator(mol)}
+    dfs = {}
+    for wf in [PySCFSlaterUHF(mol, mf), _MinimalWF(PySCFSlaterUHF(mol, mf))]:
+        np.random.seed(1)
+        df, c = vmc(wf, configs.copy(), nsteps=5, accumulators=acc)
+        dmcdf, c, w = rundmc(wf, c, nsteps=5, accumulators=acc, tstep=0.01)
+        dfs.setdefault("vmc", []).append(pd.DataFrame(df)["energytotal"])
+        dfs.setdefault("dmc", []).append(dmcdf["energytotal"])
+    for k, (ref, minimal) in dfs.items():
+        assert np.allclose(ref, minimal), k
+
+
+def test_vmc_timing(tmp_path):
+    """
+    Test that the phase timer counts the calls in each phase and is written to the HDF file.
+    """
+    import h5py
+    from pyqmc.timing import PhaseTimer
+
+    nconf, nsteps = 10, 3
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    hdf_file = str(tmp_path / "vmc.hdf5")
+
+    timer = PhaseTimer()
+    coords = initial_guess(mol, nconf)
+    vmc(
+        wf,
+        coords,
+        nsteps=nsteps,
+        accumulators={"energy": EnergyAccumulator(mol)},
+        hdf_file=hdf_file,
+        timer=timer,
+    )
+    nelec = np.sum(mol.nelec)
+    for phase in ["gradient", "testvalue", "updateinternals"]:
+        assert timer.counts[phase] == nsteps * nelec
+    assert timer.counts["accumulator_energy"] == nsteps
+    assert timer.counts["hdf"] == nsteps + 1
+    summary = timer.summary()
+    assert np.all(summary["time"] >= 0)
+
+    with h5py.File(hdf_file, "r") as hdf:
+        phases = [p.decode() for p in hdf["timing/phase"]]
+        assert set(phases) == set(timer.times.keys())
+        assert np.all(np.array(hdf["timing/calls"]) > 0)
+
+
+def test_vmc_hdf(tmp_path):
+    """
+    Test that buffered HDF output contains every step and the final configurations.
+    """
+    import h5py
+
+    nconf, nsteps = 10, 11
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    hdf_file = str(tmp_path / "vmc.hdf5")
+
+    coords = initial_guess(mol, nconf)
+    df, coords = vmc(
+        wf,
+        coords,
+        nsteps=nsteps,
+        accumulators={"energy": EnergyAccumulator(mol)},
+        hdf_file=hdf_file,
+        hdf_options=dict(buffer_size=4, checkpoint_every=8, compression="gzip"),
+    )
+    df = pd.DataFrame(df)
+    with h5py.File(hdf_file, "r") as hdf:
+        assert hdf["energytotal"].shape == (nsteps,)
+        assert np.allclose(hdf["energytotal"], df["energytotal"])
+        assert np.allclose(hdf["step"], np.arange(nsteps))
+        assert np.all(hdf["configs"][...] == coords.configs)
+        assert hdf.attrs["tstep"] == 0.5
+
+
+def test_vmc_intervals(tmp_path):
+    """
+    Test that an accumulator with an evaluation interval is only evaluated on 
+    multiples of it, and is stored as NaN on the other steps, including the ones 
+    written before its first evaluation.
+    """
+    import h5py
+    from pyqmc.timing import PhaseTimer
+
+    nconf, nsteps, interval = 10, 11, 3
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    hdf_file = str(tmp_path / "vmc.hdf5")
+    timer = PhaseTimer()
+
+    coords = initial_guess(mol, nconf)
+    df, coords = vmc(
+        wf,
+        coords,
+        nsteps=nsteps,
+        stepoffset=1,
+        accumulators={
+            "energy": EnergyAccumulator(mol),
+            "sparse": EnergyAccumulator(mol),
+        },
+        intervals={"sparse": interval},
+        hdf_file=hdf_file,
+        hdf_options=dict(buffer_size=2),
+        timer=timer,
+    )
+    df = pd.DataFrame(df)
+    evaluated = df["step"] % interval == 0
+    assert timer.counts["accumulator_sparse"] == evaluated.sum()
+    assert timer.counts["accumulator_energy"] == nsteps
+    assert np.all(np.isnan(df["sparsetotal"][~evaluated]))
+    assert np.allclose(df["sparsetotal"][evaluated], df["energytotal"][evaluated])
+    with h5py.File(hdf_file, "r") as hdf:
+        assert hdf["sparsetotal"].shape == (nsteps,)
+        sparse = np.array(hdf["sparsetotal"])
+        assert np.all(np.isnan(sparse[~evaluated.values]))
+        assert np.allclose(sparse[evaluated.values], df["sparsetotal"][evaluated])
+
+
+def test_vmc_statistics():
+    """
+    Test that streaming statistics from vmc agree with the stored steps.
+    """
+    from pyqmc.reblock import OnlineBlocking
+
+    nconf, nsteps = 50, 64
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    coords = initial_guess(mol, nconf)
+
+    stats = OnlineBlocking()
+    df, coords = vmc(
+        wf,
+        coords,
+        nsteps=nsteps,
+        accumulators={"energy": EnergyAccumulator(mol)},
+        statistics=stats,
+    )
+    df = pd.DataFrame(df)
+    summary = stats.summary()
+    assert len(stats) == nsteps
+    for k in ["energytotal", "acceptance"]:
+        assert np.isclose(summary.loc[k, "mean"], df[k].mean())
+        assert summary.loc[k, "standard error"] > 0
+
+    df, coords = vmc(
+        wf,
+        coords,
+        nsteps=nsteps,
+        accumulators={"energy": EnergyAccumulator(mol)},
+        statistics=stats,
+        store_steps=False,
+    )
+    assert len(stats) == 2 * nsteps
+    assert df.loc["energytotal", "nsamples"] == 2 * nsteps
+
+    # Without statistics=, the summary of this run's steps is returned
+    df, coords = vmc(
+        wf,
+        coords,
+        nsteps=nsteps,
+        accumulators={"energy": EnergyAccumulator(mol)},
+        store_steps=False,
+    )
+    assert df.loc["energytotal", "nsamples"] == nsteps
+    assert df.loc["energytotal", "standard error"] > 0
+
+
+def test_vmc_target_error():
+    """
+    Test that vmc stops early once the target error is reached, and that the 
+    equilibration steps are left out of the statistics.
+    """
+    from pyqmc.reblock import OnlineBlocking
+
+    np.random.seed(7)
+    nconf, nsteps = 50, 500
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="sto-3g", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    coords = initial_guess(mol, nconf)
+
+    stats = OnlineBlocking()
+    target = 0.01
+    df, coords = vmc(
+        wf,
+        coords,
+        nsteps=nsteps,
+        accumulators={"energy": EnergyAccumulator(mol)},
+        statistics=stats,
+        target_error=target,
+        check_every=10,
+    )
+    assert len(df) < nsteps
+    assert len(df) % 10 == 0
+    assert 0 < len(stats) <= len(df)
+    result = stats.result("energytotal")
+    assert result["standard error"] <= target
+    energies = pd.DataFrame(df)["energytotal"].values
+    assert np.isclose(result["mean"], energies[-len(stats) :].mean())
+    equilibrated = pd.DataFrame(df)["equilibrated"].values
+    assert equilibrated.sum() == len(stats)
+    assert equilibrated[-len(stats) :].all()
+
+
+def test_vmc_threaded():
+    """
+    Test that threaded VMC returns one merged row per step and matches Hartree-Fock within error bars.
+    """
+    from pyqmc.threadtools import vmc_threaded
+
+    nconf, nsteps, warmup = 400, 100, 20
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="cc-pvdz", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    coords = initial_guess(mol, nconf)
+    start = coords.configs.copy()
+
+    df, coords = vmc_threaded(
+        wf,
+        coords,
+        accumulators={"energy": EnergyAccumulator(mol)},
+        nsteps=nsteps,
+        nsteps_per=50,
+        nthreads=4,
+    )
+    df = pd.DataFrame(df)
+    assert len(df) == nsteps
+    assert np.allclose(df["step"], np.arange(nsteps))
+    assert coords.configs.shape == start.shape
+    assert not np.allclose(coords.configs, start)
+    df = reblock(df["energytotal"][warmup:], 10)
+    en, err = df.mean(), df.sem()
+    assert abs(en - mf.energy_tot()) < 5 * err, "pyscf {0}, vmc {1}, err {2}".format(
+        mf.energy_tot(), en, err
+    )
+
+
+def test_vmc_processes():
+    """
+    Test that VMC in worker processes with shared-memory walkers moves the walkers 
+    and matches Hartree-Fock within error bars.
+    """
+    from pyqmc.processtools import LocalClient, distvmc
+
+    nconf, nsteps, warmup = 400, 100, 20
+    mol = gto.M(atom="H 0. 0. 0.; H 0. 0. 1.4", basis="cc-pvdz", unit="bohr")
+    mf = scf.RHF(mol).run()
+    wf = PySCFSlaterUHF(mol, mf)
+    coords = initial_guess(mol, nconf)
+    start = coords.configs.copy()
+
+    with LocalClient(nworkers=2) as client:
+        df, coords = distvmc(
+            wf,
+            coords,
+            accumulators={"energy": EnergyAccumulator(mol)},
+            nsteps=nsteps,
+            nsteps_per=50,
+            npartitions=4,
+            client=client,
+        )
+    df = pd.DataFrame(df)
+    assert len(df) == nsteps
+    assert not np.allclose(coords.configs, start)
+    df = reblock(df["energytotal"][warmup:], 10)
+    en, err = df.mean(), df.sem()
+    assert abs(en - mf.energy_tot()) < 5 * err, "pyscf {0}, vmc {1}, err {2}".format(
+        mf.energy_tot(), en, err
+    )
+
+
+def test_shared_blocks():
+    """ Test that a worker closes its mapping of a shared array when the parent 
+    reallocates the block for the same key """
+    import pyqmc.processtools as processtools
+
+    with processtools.LocalClient(nworkers=1) as client:
+        old = client.share_array("test", np.arange(4.0))
+        assert np.all(processtools._attach(old) == np.arange(4.0))
+        oldblock = processtools._blocks["test"]
+        new = client.share_array("test", np.arange(100.0))
+        assert new[1] != old[1]
+        assert np.all(processtools._attach(new) == np.arange(100.0))
+        assert processtools._blocks["test"].name == new[1]
+        assert oldblock.buf is None
+        processtools._release(processtools._blocks.pop("test"))
+
+
 def test_accumulator():
     """ Tests that the accumulator gets inserted into the data output correctly.
     """